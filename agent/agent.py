@@ -1,183 +1,841 @@
-import re
-import time
-from typing import Deque, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+from pydantic import ValidationError
+from agent.compaction import MemoryCluster
 from agent.models import (
     CreateAgentParams,
-    CreateVectorStore,
     ExpectedAgentMetadata,
-    SingleTaskListStorage,
+    CreateVectorStore,
     Task,
     VectorStore,
     VectorStoreAdd,
     VectorStoreQuery,
 )
+from agent.checkpoint import CheckpointLog, CheckpointState
+from agent.context import ContextBuilder
+from agent.parsing import (
+    StructuredOutputStats,
+    TaskLineParser,
+    TaskPlan,
+    clean_task_name,
+    parse_task_plan,
+)
+from agent.resources import RESULTS_STORE_NAME, AgentResources
+from agent.scheduler import TaskScheduler
+from agent.speculation import Speculation, SpeculationStats
+from agent.storage import PriorityTaskStorage
 from agent.prompts import (
-    execute_thought,
+    NO_NEW_TASKS,
+    TASK_PLAN_FORMAT,
+    CompiledPromptTemplates,
+    PromptTemplates,
     initial_task,
-    internal_thought,
-    task_creation,
-    task_prioritization,
 )
+from completions.cache import CompletionCache
 from completions.models import (
     ChatCompletionCreateParams,
     PromptMessage,
     PromptMessageRoleEnum,
 )
-from completions.flows import llm_call as create_completion
+from completions.router import JSON_ROUTES, ModelRouter, PhaseEnum
+from completions.tokens import count_prompt_tokens, count_tokens
+from config import get_config
+from tracing import tracer
 
 
 class Agent:
-    def __init__(self, params: CreateAgentParams) -> None:
-        self.tasks_storage = SingleTaskListStorage()
-        self.objective = params.objective
-        self.tasks_storage.append(
-            Task(
-                task_id=str(self.tasks_storage.next_task_id()),
-                task_name=initial_task(self.objective),
-            )
+    def __init__(
+        self, params: CreateAgentParams, resources: Optional[AgentResources] = None
+    ) -> None:
+        self.tasks_storage = PriorityTaskStorage(
+            duplicate_threshold=params.task_duplicate_threshold
         )
-        self.agent_id = "gentle_bot"
+        self.objective = params.objective
+        self.agent_id = params.agent_id
         self.vector_store = VectorStore(
             CreateVectorStore(
                 objective=self.objective,
-                results_store_name="semantic-search-prototype",
+                results_store_name=RESULTS_STORE_NAME,
                 agent_id=self.agent_id,
-            )
+                max_memories=params.max_memories,
+            ),
+            embedding_cache=resources.embedding_cache if resources else None,
+            index=resources.index if resources else None,
         )
+        self.gate = resources.gate if resources else None
         self.log = params.log
+        self.completion_cache = (
+            CompletionCache(
+                path=get_config().COMPLETION_CACHE_PATH,
+                embed=self.vector_store.embed,
+                similarity_threshold=params.completion_cache_similarity,
+            )
+            if params.completion_cache
+            else None
+        )
+        self.stream = params.stream
+        self.context_builder = ContextBuilder(
+            token_budget=params.context_token_budget,
+            memory_token_limit=params.memory_token_limit,
+            task_list_token_budget=params.task_list_token_budget,
+        )
+        self.prompt_tokens = 0
+        self.context_min_score = params.context_min_score
+        self.hybrid_retrieval = params.hybrid_retrieval
+        self.trace = params.trace_path is not None
+        if self.trace:
+            tracer.configure(params.trace_path)
+        self.workers = params.workers
+        self.speculate = params.speculate
+        self.structured_output = params.structured_output
+        self.structured_stats = StructuredOutputStats()
+        self.prompts = (
+            CompiledPromptTemplates if params.compiled_prompts else PromptTemplates
+        )(self.objective, structured=self.structured_output)
+        self.router = ModelRouter(
+            {**(JSON_ROUTES if self.structured_output else {}), **params.model_routes}
+        )
+        response_format = {"type": "json_object"} if self.structured_output else None
+        # Request settings per phase, only the prompt changes between calls
+        self.request_templates: Dict[PhaseEnum, Dict[str, Any]] = {
+            PhaseEnum.internal_thought: {"temperature": 0.8},
+            PhaseEnum.execute_thought: {"temperature": 0.7},
+            PhaseEnum.task_creation: {
+                "temperature": 0.6,
+                "response_format": response_format,
+            },
+            PhaseEnum.task_prioritization: {
+                "temperature": 0.6,
+                "response_format": response_format,
+            },
+            # Keeps summaries, and so the metadata stored with them, short
+            PhaseEnum.memory_summary: {
+                "temperature": 0.3,
+                "max_tokens": self.context_builder.memory_token_limit,
+            },
+        }
+        self.speculation: Optional[Speculation] = None
+        self.speculation_stats = SpeculationStats()
+        self.prioritize_every = params.prioritize_every
+        self.reprioritize_change_ratio = params.reprioritize_change_ratio
+        self.max_iterations = params.max_iterations
+        self.iterations = 0
+        self.checkpoint: Optional[CheckpointLog] = None
+        if params.checkpoint_path:
+            self.checkpoint = CheckpointLog(params.checkpoint_path)
+            self.vector_store.on_flushed = self.checkpoint.embedded
+            self.vector_store.on_compacted = self.checkpoint.compacted
+        if self.checkpoint is not None and self.checkpoint.start(self.objective):
+            self.__resume(self.checkpoint.state)
+        else:
+            self.__enqueue_tasks([initial_task(self.objective)])
 
     def run(self):
-        loop = True
-        while loop:
-            if not self.tasks_storage.is_empty():
-                if self.log:
-                    print(f"***Tasks left:***\n {len(self.tasks_storage.tasks)}\n---")
+        try:
+            while self.tasks_storage.peek() is not None:
+                if self.iterations_exhausted():
+                    print("Reached the iteration limit.")
+                    return
                 # Get task from storage
-                task = self.tasks_storage.popleft()
-                if self.log:
-                    print(f"***Current task:***\n {task.task_name}\n---")
-                # Execute task
-                execute_thought = self.execute_task(task)
-                # Create new tasks and add to storage
-                self.create_tasks(task, execute_thought)
-                # Prioritize task list
-                self.prioritize_tasks()
-                # Sleep for a bit to not hit API limits
-                time.sleep(3)
-            else:
-                # No tasks left, exit
-                print("Done.")
-                loop = False
-                break
+                task = self.next_task()
+                with tracer.span("agent.task", task_id=task.task_id):
+                    # Execute task
+                    execute_thought = self.execute_task(task)
+                    self.release_dependents(task, execute_thought)
+                    # Create new tasks and add to storage
+                    self.create_tasks(task, execute_thought)
+                    self.complete_task(task)
+                    self.compact_memories()
+                    # Rerank the task list once enough has changed
+                    if self.prioritization_due():
+                        self.prioritize_tasks()
+            # No tasks left, exit
+            print("Done.")
+        finally:
+            # Upsert whatever is still sitting in the write-behind buffer
+            self.vector_store.flush()
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+            self.__log_stats()
 
-    def __get_context(
-        self, query: str, filter: Optional[Dict[str, str | List[str]]] = None
-    ) -> List[ExpectedAgentMetadata]:
-        context = self.vector_store.query(
-            VectorStoreQuery(
-                query=query,
-                filter=filter,
+    async def arun(self):
+        # Same loop as run, but memory writes are flushed in the background
+        # while the following context fetches and completions are in flight,
+        # and up to `workers` tasks are executed at once
+        try:
+            await TaskScheduler(self, workers=self.workers, gate=self.gate).run()
+            print("Done.")
+        finally:
+            # The run is over, not a miss: no other task was picked instead
+            self.__cancel_speculation()
+            await self.vector_store.aflush()
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+            self.__log_stats()
+
+    def close(self):
+        # Releases what the agent opened itself, shared resources are closed
+        # by their owner
+        if self.completion_cache is not None:
+            self.completion_cache.close()
+
+    def iterations_exhausted(self) -> bool:
+        return (
+            self.max_iterations is not None and self.iterations >= self.max_iterations
+        )
+
+    def next_task(self) -> Task:
+        self.iterations += 1
+        if self.log:
+            print(f"***Tasks left:***\n {len(self.tasks_storage)}\n---")
+        task = self.tasks_storage.popleft()
+        if self.speculation is not None and self.speculation.task != task:
+            self.__discard_speculation()
+        if self.checkpoint is not None:
+            self.checkpoint.pop(task)
+        if self.log:
+            print(f"***Current task:***\n {task.task_name}\n---")
+        return task
+
+    def prioritization_due(self) -> bool:
+        queued = len(self.tasks_storage)
+        if queued < 2:
+            return False
+        if (
+            self.prioritize_every is not None
+            and self.tasks_storage.popped_since_ranking >= self.prioritize_every
+        ):
+            return True
+        return (
+            self.tasks_storage.added_since_ranking
+            >= self.reprioritize_change_ratio * queued
+        )
+
+    def release_dependents(self, task: Task, execute_thought: str):
+        # Tasks waiting on this one can run now, they need its result rather
+        # than the tasks it is about to create
+        self.tasks_storage.finish(task, execute_thought)
+
+    def complete_task(self, task: Task):
+        self.tasks_storage.graph.complete(task.task_id)
+        if self.checkpoint is not None:
+            self.checkpoint.complete(task)
+
+    def speculate_next(self):
+        # Must be called from the event loop running arun
+        if not self.speculate or self.speculation is not None:
+            return
+        task = self.tasks_storage.peek()
+        if task is None or self.__resumed_result(task, "INTERNAL_THOUGHT") is not None:
+            return
+        speculation = Speculation(task)
+        speculation.start(self.__speculative_thought(speculation))
+        self.speculation = speculation
+        self.speculation_stats.started += 1
+
+    async def __speculative_thought(self, speculation: Speculation) -> str:
+        task = speculation.task
+        with tracer.span("agent.speculative_thought", task_id=task.task_id):
+            context = await self.__aget_context(task)
+            completion_in = self.__internal_thought_params(task, context)
+            speculation.prompt_tokens = count_prompt_tokens(completion_in)
+            # Not streamed, nothing is shown until the thought is used
+            return await self.router.acomplete(
+                PhaseEnum.internal_thought, completion_in, cache=self.completion_cache
             )
+
+    async def __speculated_thought(self, task: Task) -> Optional[str]:
+        speculation = self.speculation
+        if speculation is None or speculation.task != task:
+            return None
+        self.speculation = None
+        assert speculation.thought is not None
+        try:
+            thought = await speculation.thought
+        except Exception:
+            # Think again the regular way
+            self.speculation_stats.misses += 1
+            return None
+        self.speculation_stats.hits += 1
+        return thought
+
+    def __discard_speculation(self):
+        if self.speculation is not None:
+            self.speculation_stats.misses += 1
+            self.__cancel_speculation()
+
+    def __cancel_speculation(self):
+        speculation = self.speculation
+        if speculation is None:
+            return
+        self.speculation = None
+        self.speculation_stats.wasted_prompt_tokens += speculation.prompt_tokens
+        thought = speculation.completed_thought()
+        if thought is not None:
+            self.speculation_stats.wasted_completion_tokens += count_tokens(thought)
+        elif speculation.thought is not None:
+            speculation.thought.cancel()
+
+    def compact_memories(self):
+        if not self.vector_store.compaction_due():
+            return
+        with tracer.span("agent.compact_memories"):
+            self.vector_store.compact(self.__summarize_memories)
+
+    async def acompact_memories(self):
+        if not self.vector_store.compaction_due():
+            return
+        with tracer.span("agent.compact_memories"):
+            await self.vector_store.acompact(self.__asummarize_memories)
+
+    def __summarize_memories(self, cluster: MemoryCluster) -> str:
+        return self.router.complete(
+            PhaseEnum.memory_summary,
+            self.__memory_summary_params(cluster),
+            cache=self.__exact_completion_cache(),
+            validate=bool,
         )
-        return [c.metadata for c in context]
 
-    def __internal_thought(self, task: Task):
-        # Get all possible thoughts and actions to inform the internal thought
-        context = self.__get_context(query=self.objective)
-        internal_thought_prompt = internal_thought(
-            objective=self.objective, task=task.task_name, context=context
-        )
-        thought: str = create_completion(
-            completion_in=ChatCompletionCreateParams(
-                temperature=0.8,
-                messages=[
-                    PromptMessage(
-                        role=PromptMessageRoleEnum.user, content=internal_thought_prompt
-                    )
-                ],
+    async def __asummarize_memories(self, cluster: MemoryCluster) -> str:
+        return await self.router.acomplete(
+            PhaseEnum.memory_summary,
+            self.__memory_summary_params(cluster),
+            cache=self.__exact_completion_cache(),
+            validate=bool,
+        )
+
+    def __memory_summary_params(
+        self, cluster: MemoryCluster
+    ) -> ChatCompletionCreateParams:
+        memories = self.context_builder.pack_memories_for_summary(
+            [ExpectedAgentMetadata(**m) for m in cluster.metadata]
+        )
+        return self.__count_prompt_tokens(
+            "Memory Summary",
+            self.__request(
+                PhaseEnum.memory_summary, self.prompts.memory_summary(memories)
             ),
         )
-        self.vector_store.add(
-            params=VectorStoreAdd(
-                task=task,
-                result=thought,
-                result_id=f"result_{task.task_id}",
-                metadata={"thought_type": "INTERNAL_THOUGHT"},
+
+    def __resume(self, state: CheckpointState):
+        # Pick up where the checkpointed run stopped: interrupted tasks are
+        # back at the front of the queue, and memories that never reached the
+        # index are buffered again (their embeddings are usually cached)
+        self.tasks_storage.replace(state.tasks, state.priorities, state.insertions)
+        self.tasks_storage.task_id_counter = state.task_id_counter
+        self.iterations = state.completed
+        self.vector_store.restore(state.memory_ids)
+        for add in state.unembedded.values():
+            self.vector_store.add(add)
+        print(
+            f"***Resumed from checkpoint:***\n {state.completed} tasks done, "
+            f"{len(state.tasks)} left\n---"
+        )
+
+    def __resumed_result(self, task: Task, thought_type: str) -> Optional[str]:
+        if self.checkpoint is None:
+            return None
+        return self.checkpoint.resumed_result(task, thought_type)
+
+    def __remember(self, task: Task, result: str, thought_type: str):
+        memory = self.__memory(task, result, thought_type)
+        if self.checkpoint is not None:
+            self.checkpoint.result(memory)
+        self.vector_store.add(params=memory)
+
+    async def __aremember(self, task: Task, result: str, thought_type: str):
+        memory = self.__memory(task, result, thought_type)
+        if self.checkpoint is not None:
+            self.checkpoint.result(memory)
+        await self.vector_store.aadd(params=memory)
+
+    def __log_stats(self):
+        if self.trace:
+            print(f"***Trace summary:***\n{tracer.summary()}\n---")
+        if not self.log:
+            return
+        print(f"***Prompt tokens sent:***\n {self.prompt_tokens}\n---")
+        stats = self.vector_store.embedding_cache.stats
+        print(
+            f"***Embedding cache:***\n {stats.hits} hits, "
+            f"{stats.misses} misses, "
+            f"{stats.memory_evictions + stats.disk_evictions} evictions\n---"
+        )
+        dedup_stats = self.tasks_storage.dedup.stats
+        print(
+            f"***Task dedup:***\n {dedup_stats.hits} duplicates "
+            f"({dedup_stats.merged} merged into queued tasks, "
+            f"{dedup_stats.dropped} already executed), "
+            f"{dedup_stats.misses} new tasks\n---"
+        )
+        if self.speculate:
+            speculation_stats = self.speculation_stats
+            print(
+                f"***Speculation:***\n {speculation_stats.hits} hits, "
+                f"{speculation_stats.misses} misses "
+                f"({speculation_stats.hit_rate:.0%} hit rate), "
+                f"{speculation_stats.wasted_prompt_tokens} prompt and "
+                f"{speculation_stats.wasted_completion_tokens} completion "
+                f"tokens wasted\n---"
             )
+        print(f"***Models:***\n{self.router.summary()}\n---")
+        critical_path = self.tasks_storage.graph.critical_path()
+        print(
+            f"***Critical path:***\n {len(critical_path.task_names)} tasks, "
+            f"{critical_path.seconds:.2f}s of {critical_path.total_seconds:.2f}s "
+            f"task time ({critical_path.parallelism:.1f}x parallelism)\n---"
         )
-        if self.log:
-            print(f"***Internal Thought:***\n {thought}\n---")
-        return thought
+        if self.structured_output:
+            structured_stats = self.structured_stats
+            print(
+                f"***Structured output:***\n {structured_stats.parsed} parsed, "
+                f"{structured_stats.repaired} repaired, "
+                f"{structured_stats.failed} failed\n---"
+            )
+        compaction_stats = self.vector_store.compactor.stats
+        if compaction_stats.compactions:
+            print(
+                f"***Memory compaction:***\n {compaction_stats.compactions} "
+                f"compactions summarized {compaction_stats.memories_summarized} "
+                f"memories into {compaction_stats.summaries_written} summaries, "
+                f"{compaction_stats.clusters_skipped} clusters skipped, "
+                f"{len(self.vector_store.compactor)} memories left\n---"
+            )
+        if self.completion_cache is not None:
+            completion_stats = self.completion_cache.stats
+            print(
+                f"***Completion cache:***\n {completion_stats.exact_hits} exact hits, "
+                f"{completion_stats.semantic_hits} similar hits, "
+                f"{completion_stats.misses} misses, "
+                f"{completion_stats.evictions} evictions\n---"
+            )
 
-    def __execute_thought(self, task: Task, internal_thought: str):
-        context = self.__get_context(
-            query=self.objective,
+    def __get_context(
+        self, task: Task, filter: Optional[Dict[str, str | List[str]]] = None
+    ) -> List[str]:
+        with tracer.span("agent.context"):
+            context = self.vector_store.query(
+                VectorStoreQuery(
+                    query=task.task_name,
+                    filter=filter,
+                    min_score=self.context_min_score,
+                    hybrid=self.hybrid_retrieval,
+                )
+            )
+            return self.context_builder.pack_memories(
+                context, pinned=self.tasks_storage.graph.dependency_results(task)
+            )
+
+    async def __aget_context(
+        self, task: Task, filter: Optional[Dict[str, str | List[str]]] = None
+    ) -> List[str]:
+        with tracer.span("agent.context"):
+            context = await self.vector_store.aquery(
+                VectorStoreQuery(
+                    query=task.task_name,
+                    filter=filter,
+                    min_score=self.context_min_score,
+                    hybrid=self.hybrid_retrieval,
+                )
+            )
+            return self.context_builder.pack_memories(
+                context, pinned=self.tasks_storage.graph.dependency_results(task)
+            )
+
+    def __internal_thought(self, task: Task):
+        resumed = self.__resumed_result(task, "INTERNAL_THOUGHT")
+        if resumed is not None:
+            return resumed
+        with tracer.span("agent.internal_thought"):
+            # Get all possible thoughts and actions to inform the internal thought
+            context = self.__get_context(task)
+            thought = self.__complete_thought(
+                PhaseEnum.internal_thought,
+                self.__internal_thought_params(task, context),
+                "Internal Thought",
+            )
+            self.__remember(task, thought, "INTERNAL_THOUGHT")
+            if self.log and not self.stream:
+                print(f"***Internal Thought:***\n {thought}\n---")
+            return thought
+
+    async def __ainternal_thought(self, task: Task):
+        resumed = self.__resumed_result(task, "INTERNAL_THOUGHT")
+        if resumed is not None:
+            return resumed
+        speculated = await self.__speculated_thought(task)
+        if speculated is not None:
+            await self.__aremember(task, speculated, "INTERNAL_THOUGHT")
+            if self.log:
+                print(f"***Internal Thought (speculated):***\n {speculated}\n---")
+            return speculated
+        with tracer.span("agent.internal_thought"):
+            context = await self.__aget_context(task)
+            thought = await self.__acomplete_thought(
+                PhaseEnum.internal_thought,
+                self.__internal_thought_params(task, context),
+                "Internal Thought",
+            )
+            await self.__aremember(task, thought, "INTERNAL_THOUGHT")
+            if self.log and not self.stream:
+                print(f"***Internal Thought:***\n {thought}\n---")
+            return thought
+
+    def __internal_thought_params(
+        self, task: Task, context: List[str]
+    ) -> ChatCompletionCreateParams:
+        internal_thought_prompt = self.prompts.internal_thought(
+            task=task.task_name, context=context
+        )
+        return self.__count_prompt_tokens(
+            "Internal Thought",
+            self.__request(PhaseEnum.internal_thought, internal_thought_prompt),
         )
-        execute_thought_prompt = execute_thought(
-            objective=self.objective,
+
+    def __execute_thought(self, task: Task, internal_thought: str):
+        resumed = self.__resumed_result(task, "EXECUTE_THOUGHT")
+        if resumed is not None:
+            return resumed
+        with tracer.span("agent.execute_thought"):
+            context = self.__get_context(task)
+            # TODO: Make this have function calls and deal with that
+            response = self.__complete_thought(
+                PhaseEnum.execute_thought,
+                self.__execute_thought_params(task, internal_thought, context),
+                "Execute Thought",
+            )
+            self.__remember(task, response, "EXECUTE_THOUGHT")
+            if self.log and not self.stream:
+                print(f"***Execute Thought:***\n {response}\n---")
+            return response
+
+    async def __aexecute_thought(self, task: Task, internal_thought: str):
+        resumed = self.__resumed_result(task, "EXECUTE_THOUGHT")
+        if resumed is not None:
+            return resumed
+        with tracer.span("agent.execute_thought"):
+            context = await self.__aget_context(task)
+            response = await self.__acomplete_thought(
+                PhaseEnum.execute_thought,
+                self.__execute_thought_params(task, internal_thought, context),
+                "Execute Thought",
+            )
+            await self.__aremember(task, response, "EXECUTE_THOUGHT")
+            if self.log and not self.stream:
+                print(f"***Execute Thought:***\n {response}\n---")
+            return response
+
+    def __execute_thought_params(
+        self, task: Task, internal_thought: str, context: List[str]
+    ) -> ChatCompletionCreateParams:
+        execute_thought_prompt = self.prompts.execute_thought(
             task=task.task_name,
             internal_thought=internal_thought,
             context=context,
         )
-        # TODO: Make this have function calls and deal with that
-        response: str = create_completion(
-            completion_in=ChatCompletionCreateParams(
-                temperature=0.7,
-                messages=[
-                    PromptMessage(
-                        role=PromptMessageRoleEnum.user, content=execute_thought_prompt
-                    )
-                ],
-            ),
+        return self.__count_prompt_tokens(
+            "Execute Thought",
+            self.__request(PhaseEnum.execute_thought, execute_thought_prompt),
         )
-        self.vector_store.add(
-            params=VectorStoreAdd(
-                task=task,
-                result=response,
-                result_id=f"result_{task.task_id}",
-                metadata={"thought_type": "EXECUTE_THOUGHT"},
+
+    def __complete_thought(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams, title: str
+    ) -> str:
+        if not self.stream:
+            return self.router.complete(
+                phase, completion_in, cache=self.completion_cache
+            )
+        if self.log:
+            print(f"***{title}:***\n ", end="", flush=True)
+        deltas = []
+        for delta in self.router.stream(
+            phase, completion_in, cache=self.completion_cache
+        ):
+            deltas.append(delta)
+            if self.log:
+                print(delta, end="", flush=True)
+        if self.log:
+            print("\n---")
+        return "".join(deltas)
+
+    async def __acomplete_thought(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams, title: str
+    ) -> str:
+        if not self.stream:
+            return await self.router.acomplete(
+                phase, completion_in, cache=self.completion_cache
+            )
+        # Concurrent workers would interleave their deltas, so only a single
+        # worker prints thoughts as they stream
+        print_deltas = self.log and self.workers == 1
+        if print_deltas:
+            print(f"***{title}:***\n ", end="", flush=True)
+        deltas = []
+        async for delta in self.router.astream(
+            phase, completion_in, cache=self.completion_cache
+        ):
+            deltas.append(delta)
+            if print_deltas:
+                print(delta, end="", flush=True)
+        if print_deltas:
+            print("\n---")
+        elif self.log:
+            print(f"***{title}:***\n {''.join(deltas)}\n---")
+        return "".join(deltas)
+
+    def __request(self, phase: PhaseEnum, prompt: str) -> ChatCompletionCreateParams:
+        # Validating the whole request in one constructor call is cheaper
+        # than copying a prebuilt model (measured in benchmarks.validation)
+        messages = [PromptMessage(role=PromptMessageRoleEnum.user, content=prompt)]
+        if self.prompts.system is not None:
+            # The same first message on every call, a cacheable prefix
+            messages.insert(
+                0,
+                PromptMessage(
+                    role=PromptMessageRoleEnum.system, content=self.prompts.system
+                ),
             )
+        return ChatCompletionCreateParams(
+            messages=messages, **self.request_templates[phase]
         )
+
+    def __count_prompt_tokens(
+        self, phase: str, completion_in: ChatCompletionCreateParams
+    ) -> ChatCompletionCreateParams:
+        prompt_tokens = count_prompt_tokens(completion_in)
+        self.prompt_tokens += prompt_tokens
         if self.log:
-            print(f"***Execute Thought:***\n {response}\n---")
-        return response
+            print(f"***{phase} prompt tokens:***\n {prompt_tokens}\n---")
+        return completion_in
+
+    def __memory(self, task: Task, result: str, thought_type: str) -> VectorStoreAdd:
+        return VectorStoreAdd(
+            task=task,
+            result=result,
+            # One memory per thought, the execute thought must not overwrite
+            # the internal thought of the same task
+            result_id=f"result_{task.task_id}_{thought_type.lower()}",
+            metadata={"thought_type": thought_type},
+        )
 
     def __strip_task_response(self, response: str) -> List[str]:
-        new_tasks = response.split("\n") if "\n" in response else [response]
-        new_tasks_list = []
-        for task_string in new_tasks:
-            task_parts = task_string.strip().split(".", 1)
-            if len(task_parts) == 2:
-                task_id = "".join(s for s in task_parts[0] if s.isnumeric())
-                task_name = re.sub(r"[^\w\s_]+", "", task_parts[1]).strip()
-                if task_name.strip() and task_id.isnumeric():
-                    new_tasks_list.append(task_name)
-
-        return new_tasks_list
+        parser = TaskLineParser()
+        return parser.feed(response) + parser.close()
 
     def execute_task(self, task: Task):
         internal_thought = self.__internal_thought(task)
         execute_thought = self.__execute_thought(task, internal_thought)
         return execute_thought
 
+    async def aexecute_task(self, task: Task):
+        internal_thought = await self.__ainternal_thought(task)
+        execute_thought = await self.__aexecute_thought(task, internal_thought)
+        return execute_thought
+
     def create_tasks(self, task: Task, execute_thought: str) -> Deque[Task]:
-        task_creation_prompt = task_creation(
-            objective=self.objective,
+        with tracer.span("agent.create_tasks"):
+            completion_in = self.__task_creation_params(task, execute_thought)
+            if self.structured_output:
+                plan = self.__plan(PhaseEnum.task_creation, completion_in)
+                return self.__add_new_tasks(
+                    self.__append_tasks(plan.ordered_names(), task, plan.dependencies())
+                )
+            if not self.stream:
+                response: str = self.router.complete(
+                    PhaseEnum.task_creation,
+                    completion_in,
+                    cache=self.completion_cache,
+                    validate=self.__valid_task_creation,
+                )
+                return self.__add_new_tasks(
+                    self.__append_tasks(self.__strip_task_response(response), task)
+                )
+            # Enqueue each task as soon as its numbered line has streamed in
+            parser = TaskLineParser()
+            new_tasks_list: List[str] = []
+            deltas: List[str] = []
+            for delta in self.router.stream(
+                PhaseEnum.task_creation, completion_in, cache=self.completion_cache
+            ):
+                deltas.append(delta)
+                new_tasks_list += self.__append_tasks(parser.feed(delta), task)
+            new_tasks_list += self.__append_tasks(parser.close(), task)
+            if not self.__valid_task_creation("".join(deltas)):
+                escalated = self.router.escalate(
+                    PhaseEnum.task_creation,
+                    completion_in,
+                    cache=self.completion_cache,
+                    validate=self.__valid_task_creation,
+                )
+                if escalated is not None:
+                    new_tasks_list += self.__append_tasks(
+                        self.__strip_task_response(escalated), task
+                    )
+            return self.__add_new_tasks(new_tasks_list)
+
+    async def acreate_tasks(
+        self,
+        task: Task,
+        execute_thought: str,
+        on_tasks_added: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Deque[Task]:
+        with tracer.span("agent.create_tasks"):
+            completion_in = self.__task_creation_params(task, execute_thought)
+            if self.structured_output:
+                plan = await self.__aplan(PhaseEnum.task_creation, completion_in)
+                return self.__add_new_tasks(
+                    await self.__aappend_tasks(
+                        plan.ordered_names(), task, plan.dependencies()
+                    )
+                )
+            if not self.stream:
+                response: str = await self.router.acomplete(
+                    PhaseEnum.task_creation,
+                    completion_in,
+                    cache=self.completion_cache,
+                    validate=self.__valid_task_creation,
+                )
+                return self.__add_new_tasks(
+                    await self.__aappend_tasks(
+                        self.__strip_task_response(response), task
+                    )
+                )
+            # Tasks are enqueued, and idle workers woken up to dispatch them, as
+            # each numbered line streams in
+            parser = TaskLineParser()
+            new_tasks_list: List[str] = []
+            deltas: List[str] = []
+            async for delta in self.router.astream(
+                PhaseEnum.task_creation, completion_in, cache=self.completion_cache
+            ):
+                deltas.append(delta)
+                added = await self.__aappend_tasks(parser.feed(delta), task)
+                if added and on_tasks_added is not None:
+                    await on_tasks_added()
+                new_tasks_list += added
+            new_tasks_list += await self.__aappend_tasks(parser.close(), task)
+            if not self.__valid_task_creation("".join(deltas)):
+                escalated = await self.router.aescalate(
+                    PhaseEnum.task_creation,
+                    completion_in,
+                    cache=self.completion_cache,
+                    validate=self.__valid_task_creation,
+                )
+                if escalated is not None:
+                    new_tasks_list += await self.__aappend_tasks(
+                        self.__strip_task_response(escalated), task
+                    )
+            return self.__add_new_tasks(new_tasks_list)
+
+    def __valid_task_creation(self, response: str) -> bool:
+        # A numbered task list, or the agreed way of saying there is none
+        return bool(self.__strip_task_response(response)) or NO_NEW_TASKS in " ".join(
+            response.split()
+        )
+
+    def __task_creation_params(
+        self, task: Task, execute_thought: str
+    ) -> ChatCompletionCreateParams:
+        task_creation_prompt = self.prompts.task_creation(
             previous_execute_thought=execute_thought,
             previous_task=task.task_name,
-            task_list=self.tasks_storage.get_task_names(),
-        )
-        response: str = create_completion(
-            completion_in=ChatCompletionCreateParams(
-                temperature=0.6,
-                messages=[
-                    PromptMessage(
-                        role=PromptMessageRoleEnum.user, content=task_creation_prompt
-                    )
-                ],
+            task_list=self.context_builder.pack_task_list(
+                self.tasks_storage.get_task_names()
             ),
         )
-        new_tasks_list = self.__strip_task_response(response)
+        return self.__count_prompt_tokens(
+            "Task Creation",
+            self.__request(PhaseEnum.task_creation, task_creation_prompt),
+        )
+
+    def __plan(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams
+    ) -> TaskPlan:
+        cache = self.__plan_cache(phase)
+        response = self.router.complete(
+            phase, completion_in, cache=cache, validate=self.__valid_plan
+        )
+        plan = self.__parse_plan(response)
+        if plan is None:
+            # One repair attempt, showing the model what was wrong
+            plan = self.__repaired_plan(
+                self.router.repair(phase, self.__repair_params(completion_in, response))
+            )
+        return plan if plan is not None else TaskPlan()
+
+    async def __aplan(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams
+    ) -> TaskPlan:
+        cache = self.__plan_cache(phase)
+        response = await self.router.acomplete(
+            phase, completion_in, cache=cache, validate=self.__valid_plan
+        )
+        plan = self.__parse_plan(response)
+        if plan is None:
+            plan = self.__repaired_plan(
+                await self.router.arepair(
+                    phase, self.__repair_params(completion_in, response)
+                )
+            )
+        return plan if plan is not None else TaskPlan()
+
+    def __plan_cache(self, phase: PhaseEnum) -> Optional[CompletionCache]:
+        if phase == PhaseEnum.task_prioritization:
+            return self.__exact_completion_cache()
+        return self.completion_cache
+
+    def __valid_plan(self, response: str) -> bool:
+        return self.__parse_plan(response, count=False) is not None
+
+    def __parse_plan(self, response: str, count: bool = True) -> Optional[TaskPlan]:
+        try:
+            plan = parse_task_plan(response)
+        except ValidationError:
+            return None
+        if count:
+            self.structured_stats.parsed += 1
+        return plan
+
+    def __repaired_plan(self, response: str) -> Optional[TaskPlan]:
+        try:
+            plan = parse_task_plan(response)
+        except ValidationError:
+            self.structured_stats.failed += 1
+            return None
+        self.structured_stats.repaired += 1
+        return plan
+
+    def __repair_params(
+        self, completion_in: ChatCompletionCreateParams, response: str
+    ) -> ChatCompletionCreateParams:
+        try:
+            parse_task_plan(response)
+            error = ""
+        except ValidationError as e:
+            error = "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}"
+                for err in e.errors()[:3]
+            )
+        return self.__count_prompt_tokens(
+            "Plan Repair",
+            completion_in.model_copy(
+                update={
+                    "messages": completion_in.messages
+                    + [
+                        PromptMessage(
+                            role=PromptMessageRoleEnum.assistant, content=response
+                        ),
+                        PromptMessage(
+                            role=PromptMessageRoleEnum.user,
+                            content=f"That response is not valid ({error}). "
+                            f"Reply with only the corrected JSON object of the "
+                            f"form {TASK_PLAN_FORMAT}",
+                        ),
+                    ]
+                }
+            ),
+        )
+
+    def __add_new_tasks(self, new_tasks_list: List[str]) -> Deque[Task]:
         if self.log:
             newline_char = "\n"
             print(
@@ -186,45 +844,170 @@ class Agent:
                 ---"""
             )
 
-        for task_name in new_tasks_list:
-            self.tasks_storage.append(
-                Task(
-                    task_id=str(self.tasks_storage.next_task_id()), task_name=task_name
+        return self.tasks_storage.tasks
+
+    def __append_tasks(
+        self,
+        new_tasks_list: List[str],
+        created_by: Optional[Task] = None,
+        dependencies: Optional[Dict[str, List[str]]] = None,
+    ) -> List[str]:
+        return self.__enqueue_tasks(
+            new_tasks_list,
+            created_by,
+            self.__task_vectors(new_tasks_list),
+            dependencies,
+        )
+
+    async def __aappend_tasks(
+        self,
+        new_tasks_list: List[str],
+        created_by: Optional[Task] = None,
+        dependencies: Optional[Dict[str, List[str]]] = None,
+    ) -> List[str]:
+        return self.__enqueue_tasks(
+            new_tasks_list,
+            created_by,
+            await self.__atask_vectors(new_tasks_list),
+            dependencies,
+        )
+
+    def __task_vectors(self, task_names: List[str]) -> Optional[List[List[float]]]:
+        if not task_names:
+            return None
+        texts = self.__task_vector_texts(task_names)
+        return self.__set_objective_vector(
+            task_names, self.vector_store.embed_many(texts)
+        )
+
+    async def __atask_vectors(
+        self, task_names: List[str]
+    ) -> Optional[List[List[float]]]:
+        if not task_names:
+            return None
+        texts = self.__task_vector_texts(task_names)
+        return self.__set_objective_vector(
+            task_names, await self.vector_store.aembed_many(texts)
+        )
+
+    def __task_vector_texts(self, task_names: List[str]) -> List[str]:
+        # The objective is embedded along with the first created tasks
+        if self.tasks_storage.objective_vector is None:
+            return task_names + [self.objective]
+        return task_names
+
+    def __set_objective_vector(
+        self, task_names: List[str], vectors: List[List[float]]
+    ) -> List[List[float]]:
+        if len(vectors) > len(task_names):
+            self.tasks_storage.set_objective(vectors[-1])
+        return vectors[: len(task_names)]
+
+    def __enqueue_tasks(
+        self,
+        new_tasks_list: List[str],
+        created_by: Optional[Task] = None,
+        vectors: Optional[List[List[float]]] = None,
+        dependencies: Optional[Dict[str, List[str]]] = None,
+    ) -> List[str]:
+        # Returns the names of the tasks that were not dropped as duplicates.
+        # Dependencies are task names, resolved against the tasks enqueued so
+        # far, so a task cannot wait on one enqueued after it.
+        added: List[Task] = []
+        for i, task_name in enumerate(new_tasks_list):
+            task = Task(
+                task_id=str(self.tasks_storage.next_task_id()),
+                task_name=task_name,
+                depends_on=self.tasks_storage.graph.resolve(
+                    (dependencies or {}).get(task_name, [])
+                ),
+            )
+            if self.tasks_storage.append(
+                task,
+                vectors[i] if vectors else None,
+                created_by.task_id if created_by else None,
+            ):
+                added.append(task)
+        if self.checkpoint is not None:
+            self.checkpoint.append(
+                added,
+                created_by,
+                self.tasks_storage.priorities(added),
+                self.tasks_storage.insertions,
+            )
+        return [t.task_name for t in added]
+
+    def prioritize_tasks(self):
+        with tracer.span("agent.prioritize_tasks"):
+            if self.structured_output:
+                return self.__rerank_tasks(
+                    self.__plan(
+                        PhaseEnum.task_prioritization,
+                        self.__task_prioritization_params(),
+                    ).ordered_names()
                 )
+            response: str = self.router.complete(
+                PhaseEnum.task_prioritization,
+                self.__task_prioritization_params(),
+                cache=self.__exact_completion_cache(),
+                validate=self.__valid_task_ranking,
             )
+            return self.__rerank_tasks(self.__strip_task_response(response))
 
-        return self.tasks_storage.tasks
+    async def aprioritize_tasks(self):
+        with tracer.span("agent.prioritize_tasks"):
+            if self.structured_output:
+                return self.__rerank_tasks(
+                    (
+                        await self.__aplan(
+                            PhaseEnum.task_prioritization,
+                            self.__task_prioritization_params(),
+                        )
+                    ).ordered_names()
+                )
+            response: str = await self.router.acomplete(
+                PhaseEnum.task_prioritization,
+                self.__task_prioritization_params(),
+                cache=self.__exact_completion_cache(),
+                validate=self.__valid_task_ranking,
+            )
+            return self.__rerank_tasks(self.__strip_task_response(response))
 
-    def prioritize_tasks(self):
-        task_prioritization_prompt = task_prioritization(
-            self.objective, self.tasks_storage.get_task_names()
-        )
-        response: str = create_completion(
-            completion_in=ChatCompletionCreateParams(
-                temperature=0.6,
-                messages=[
-                    PromptMessage(
-                        role=PromptMessageRoleEnum.user,
-                        content=task_prioritization_prompt,
-                    )
-                ],
-            ),
+    def __valid_task_ranking(self, response: str) -> bool:
+        return bool(self.__strip_task_response(response))
+
+    def __exact_completion_cache(self) -> Optional[CompletionCache]:
+        # A ranking of a similar task list is not a ranking of this one
+        if self.completion_cache is None:
+            return None
+        return self.completion_cache.exact_only()
+
+    def __task_prioritization_params(self) -> ChatCompletionCreateParams:
+        task_prioritization_prompt = self.prompts.task_prioritization(
+            self.tasks_storage.get_task_names()
+        )
+        return self.__count_prompt_tokens(
+            "Task Prioritization",
+            self.__request(PhaseEnum.task_prioritization, task_prioritization_prompt),
         )
-        new_tasks_list = self.__strip_task_response(response)
+
+    def __rerank_tasks(self, ranked_names: List[str]) -> Deque[Task]:
+        # The ranking only reorders tasks that are still queued, keeping their
+        # ids. Tasks claimed by other workers while the LLM was ranking are
+        # skipped, tasks they added keep their local priority, and names the
+        # LLM made up or reworded are ignored.
+        queued = {clean_task_name(t.task_name): t for t in self.tasks_storage.tasks}
+        ranked = [queued.pop(name) for name in ranked_names if name in queued]
         if self.log:
             newline_char = "\n"
             print(
                 f"""***New Tasks Prioritized:***\n
-                {newline_char.join(new_tasks_list)}\n
+                {newline_char.join(t.task_name for t in ranked)}\n
                 ---"""
             )
-        self.tasks_storage.replace(
-            [
-                Task(
-                    task_id=str(self.tasks_storage.next_task_id()), task_name=task_name
-                )
-                for task_name in new_tasks_list
-            ]
-        )
+        self.tasks_storage.reorder(ranked)
+        if self.checkpoint is not None:
+            tasks = list(self.tasks_storage.tasks)
+            self.checkpoint.replace(tasks, self.tasks_storage.priorities(tasks))
 
         return self.tasks_storage.tasks
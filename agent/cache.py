@@ -0,0 +1,137 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha256(
+        f"{model}\x00{normalize_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+class EmbeddingCacheStats(BaseModel):
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+
+# In-memory LRU in front of an optional SQLite tier storing float32 blobs
+class EmbeddingCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 100_000,
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.stats = EmbeddingCacheStats()
+        self.__memory: OrderedDict[str, List[float]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db: Optional[sqlite3.Connection] = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+            self.__db.commit()
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = embedding_key(model, text)
+        with self.__lock:
+            vector = self.__memory.get(key)
+            if vector is not None:
+                self.__memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return vector
+            vector = self.__read_disk(key)
+            if vector is not None:
+                self.stats.disk_hits += 1
+                self.__remember(key, vector)
+                return vector
+            self.stats.misses += 1
+            return None
+
+    def put(self, model: str, text: str, vector: List[float]):
+        key = embedding_key(model, text)
+        with self.__lock:
+            self.__remember(key, vector)
+            self.__write_disk(key, model, vector)
+
+    def __len__(self) -> int:
+        return len(self.__memory)
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+    def __remember(self, key: str, vector: List[float]):
+        self.__memory[key] = vector
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.max_memory_entries:
+            self.__memory.popitem(last=False)
+            self.stats.memory_evictions += 1
+
+    def __read_disk(self, key: str) -> Optional[List[float]]:
+        if self.__db is None:
+            return None
+        row = self.__db.execute(
+            "SELECT vector FROM embeddings WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.__db.execute(
+            "UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self.__db.commit()
+        return array("f", row[0]).tolist()
+
+    def __write_disk(self, key: str, model: str, vector: List[float]):
+        if self.__db is None:
+            return
+        self.__db.execute(
+            "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) "
+            "VALUES (?, ?, ?, ?)",
+            (key, model, array("f", vector).tobytes(), time.time()),
+        )
+        (count,) = self.__db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_disk_entries
+        if overflow > 0:
+            self.__db.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            self.stats.disk_evictions += overflow
+        self.__db.commit()
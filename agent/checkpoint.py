@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+from typing import Any, Dict, IO, List, Optional
+
+from pydantic import BaseModel
+
+from agent.models import Task, VectorStoreAdd
+
+DEFAULT_COMPACT_EVERY = 500
+
+
+class CheckpointState(BaseModel):
+    objective: Optional[str] = None
+    task_id_counter: int = 0
+    completed: int = 0
+    tasks: List[Task] = []
+    # Priority keys of queued and unfinished tasks, and the queue's insertion
+    # count they were computed against
+    priorities: Dict[str, float] = {}
+    insertions: int = 0
+    # Tasks popped from the queue whose task creation has not finished
+    in_progress: Dict[str, Task] = {}
+    # Thought results of unfinished tasks, by task id and thought type
+    results: Dict[str, Dict[str, str]] = {}
+    # Parent task id of tasks created by unfinished tasks
+    created_by: Dict[str, str] = {}
+    # Memories recorded but not yet upserted to the vector index
+    unembedded: Dict[str, VectorStoreAdd] = {}
+    # Ids of the memories in the vector index, in compaction order
+    memory_ids: List[str] = []
+
+    @property
+    def empty(self) -> bool:
+        return self.objective is None
+
+    def apply(self, event: Dict[str, Any]):
+        match event["type"]:
+            case "snapshot":
+                restored = CheckpointState(**event["state"])
+                for field in CheckpointState.model_fields:
+                    setattr(self, field, getattr(restored, field))
+            case "start":
+                self.objective = event["objective"]
+            case "append":
+                for task in event["tasks"]:
+                    self.__add(Task(**task), event.get("created_by"))
+                self.priorities.update(event.get("priorities", {}))
+                self.insertions = max(self.insertions, event.get("insertions", 0))
+            case "pop":
+                task = Task(**event["task"])
+                self.tasks = [t for t in self.tasks if t.task_id != task.task_id]
+                self.in_progress[task.task_id] = task
+            case "result":
+                add = VectorStoreAdd(**event["add"])
+                thought_type = add.metadata.get("thought_type", "")
+                self.results.setdefault(add.task.task_id, {})[thought_type] = add.result
+                self.unembedded[add.result_id] = add
+            case "embedded":
+                for result_id in event["result_ids"]:
+                    self.unembedded.pop(result_id, None)
+                self.__move_to_end(event["result_ids"])
+            case "compacted":
+                summary_id = event["summary_id"]
+                if summary_id is None:
+                    # Skipped clusters go to the end, as in MemoryCompactor
+                    self.__move_to_end(event["ids"])
+                else:
+                    removed = set(event["ids"])
+                    self.memory_ids = [summary_id] + [
+                        id for id in self.memory_ids if id not in removed
+                    ]
+            case "complete":
+                task_id = event["task_id"]
+                self.in_progress.pop(task_id, None)
+                self.results.pop(task_id, None)
+                self.priorities.pop(task_id, None)
+                self.created_by = {
+                    child: parent
+                    for child, parent in self.created_by.items()
+                    if parent != task_id
+                }
+                self.completed += 1
+            case "replace":
+                self.tasks = []
+                for task in event["tasks"]:
+                    self.__add(Task(**task), None)
+                live = set(self.in_progress) | {t.task_id for t in self.tasks}
+                self.results = {k: v for k, v in self.results.items() if k in live}
+                self.priorities = {
+                    k: v for k, v in self.priorities.items() if k in self.in_progress
+                }
+                self.priorities.update(event.get("priorities", {}))
+            case "requeue":
+                # Unfinished tasks go back to the front of the queue on resume,
+                # and tasks they were still streaming in are dropped so their
+                # task creation can run again from scratch
+                requeued = list(self.in_progress.values())
+                self.in_progress = {}
+                self.tasks = requeued + [
+                    t for t in self.tasks if t.task_id not in self.created_by
+                ]
+                self.created_by = {}
+                live = {t.task_id for t in self.tasks}
+                self.priorities = {
+                    k: v for k, v in self.priorities.items() if k in live
+                }
+                if self.priorities:
+                    top = max(self.priorities.values())
+                    for task in requeued:
+                        self.priorities[task.task_id] = top
+
+    def __move_to_end(self, ids: List[str]):
+        moved = set(ids)
+        self.memory_ids = [id for id in self.memory_ids if id not in moved]
+        self.memory_ids += list(dict.fromkeys(ids))
+
+    def __add(self, task: Task, created_by: Optional[str]):
+        self.tasks.append(task)
+        self.task_id_counter = max(self.task_id_counter, int(task.task_id))
+        if created_by is not None:
+            self.created_by[task.task_id] = created_by
+
+
+# Append-only log of everything that changes the agent's progress: queue
+# mutations, thought results and which memories reached the vector index.
+# Every event is fsync'd before the agent moves on, and the log is
+# periodically compacted into a single snapshot of the replayed state.
+class CheckpointLog:
+    def __init__(self, path: str, compact_every: int = DEFAULT_COMPACT_EVERY):
+        self.path = path
+        self.compact_every = compact_every
+        self.state = CheckpointState()
+        self.events_since_compaction = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(path):
+            self.__replay()
+        self.file: IO[str] = open(path, "a")
+
+    def start(self, objective: str) -> bool:
+        # Returns whether there is earlier progress to resume
+        if not self.state.empty and self.state.objective != objective:
+            raise ValueError(
+                f"Checkpoint {self.path} belongs to the objective "
+                f'"{self.state.objective}"'
+            )
+        if self.state.empty:
+            self.__write({"type": "start", "objective": objective})
+            return False
+        self.__write({"type": "requeue"})
+        return True
+
+    def append(
+        self,
+        tasks: List[Task],
+        created_by: Optional[Task] = None,
+        priorities: Optional[Dict[str, float]] = None,
+        insertions: int = 0,
+    ):
+        if tasks:
+            self.__write(
+                {
+                    "type": "append",
+                    "tasks": [t.model_dump() for t in tasks],
+                    "created_by": created_by.task_id if created_by else None,
+                    "priorities": priorities or {},
+                    "insertions": insertions,
+                }
+            )
+
+    def pop(self, task: Task):
+        self.__write({"type": "pop", "task": task.model_dump()})
+
+    def result(self, add: VectorStoreAdd):
+        self.__write({"type": "result", "add": add.model_dump()})
+
+    def embedded(self, result_ids: List[str]):
+        if result_ids:
+            self.__write({"type": "embedded", "result_ids": result_ids})
+
+    def compacted(self, ids: List[str], summary_id: Optional[str]):
+        self.__write({"type": "compacted", "ids": ids, "summary_id": summary_id})
+
+    def complete(self, task: Task):
+        self.__write({"type": "complete", "task_id": task.task_id})
+
+    def replace(self, tasks: List[Task], priorities: Optional[Dict[str, float]] = None):
+        self.__write(
+            {
+                "type": "replace",
+                "tasks": [t.model_dump() for t in tasks],
+                "priorities": priorities or {},
+            }
+        )
+
+    def resumed_result(self, task: Task, thought_type: str) -> Optional[str]:
+        return self.state.results.get(task.task_id, {}).get(thought_type)
+
+    def close(self):
+        with self.lock:
+            self.__compact()
+            self.file.close()
+
+    def __write(self, event: Dict[str, Any]):
+        with self.lock:
+            self.state.apply(event)
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.events_since_compaction += 1
+            if self.events_since_compaction >= self.compact_every:
+                self.__compact()
+
+    def __replay(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final write from a crash, everything before it
+                    # was fsync'd
+                    break
+                self.state.apply(event)
+
+    def __compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(
+                json.dumps({"type": "snapshot", "state": self.state.model_dump()})
+                + "\n"
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__fsync_directory()
+        if not self.file.closed:
+            self.file.close()
+        self.file = open(self.path, "a")
+        self.events_since_compaction = 0
+
+    def __fsync_directory(self):
+        # Make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,129 @@
+import math
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from pydantic import BaseModel
+
+from agent.indexes import VectorRecord, unit_normalize
+
+DEFAULT_MEMORIES_PER_SUMMARY = 8
+KMEANS_ROUNDS = 5
+
+
+class MemoryCluster(BaseModel):
+    ids: List[str]
+    metadata: List[Dict[str, str]]
+    # Original memories folded into this cluster, counting through summaries
+    summarized: int
+
+
+class CompactionStats(BaseModel):
+    compactions: int = 0
+    memories_summarized: int = 0
+    summaries_written: int = 0
+    # Clusters kept as they were because the summary came back empty
+    clusters_skipped: int = 0
+
+
+# Tracks the memories upserted to a namespace, oldest first, so they can be
+# compacted without listing the index (Pinecone cannot list ids). Once the
+# namespace holds more than max_memories, everything but the newest
+# keep_recent memories is clustered by embedding similarity and each cluster
+# is replaced by one summary memory, so the namespace stays bounded. The
+# order is checkpointed and restored on resume; a run without a checkpoint
+# only knows the memories it upserted itself.
+class MemoryCompactor:
+    def __init__(
+        self,
+        max_memories: Optional[int],
+        keep_recent: Optional[int] = None,
+        memories_per_summary: int = DEFAULT_MEMORIES_PER_SUMMARY,
+    ):
+        self.max_memories = max_memories
+        self.keep_recent = (
+            keep_recent if keep_recent is not None else (max_memories or 0) // 4
+        )
+        self.memories_per_summary = max(2, memories_per_summary)
+        self.memories: OrderedDict[
+            str, Tuple[npt.NDArray[np.float32], Dict[str, str]]
+        ] = OrderedDict()
+        self.stats = CompactionStats()
+
+    def __len__(self) -> int:
+        return len(self.memories)
+
+    @property
+    def due(self) -> bool:
+        return self.max_memories is not None and len(self) > self.max_memories
+
+    def record(self, batch: List[VectorRecord]):
+        for id, values, metadata in batch:
+            self.memories.pop(id, None)
+            self.memories[id] = (
+                unit_normalize(np.asarray(values, dtype=np.float32)),
+                metadata,
+            )
+
+    def clusters(self) -> List[MemoryCluster]:
+        old = list(self.memories.items())[: max(0, len(self) - self.keep_recent)]
+        if len(old) < 2:
+            return []
+        ids = [id for id, _ in old]
+        matrix = np.stack([vector for _, (vector, _) in old])
+        labels = self.__kmeans(matrix, math.ceil(len(old) / self.memories_per_summary))
+        clusters = []
+        for label in np.unique(labels):
+            rows = np.flatnonzero(labels == label).tolist()
+            # Uneven clusters are split so no summary prompt grows unbounded
+            for start in range(0, len(rows), 2 * self.memories_per_summary):
+                chunk = rows[start : start + 2 * self.memories_per_summary]
+                if len(chunk) < 2:
+                    continue
+                metadata = [old[row][1][1] for row in chunk]
+                clusters.append(
+                    MemoryCluster(
+                        ids=[ids[row] for row in chunk],
+                        metadata=metadata,
+                        summarized=sum(int(m.get("summarized", 1)) for m in metadata),
+                    )
+                )
+        return clusters
+
+    def replace(self, cluster: MemoryCluster, summary: VectorRecord):
+        for id in cluster.ids:
+            self.memories.pop(id, None)
+        self.record([summary])
+        # Summaries stand in for old memories, so they are the first to be
+        # compacted again
+        self.memories.move_to_end(summary[0], last=False)
+        self.stats.memories_summarized += len(cluster.ids)
+        self.stats.summaries_written += 1
+
+    def skip(self, cluster: MemoryCluster):
+        # The originals stay, and count as the newest memories so the next
+        # compaction does not retry the same cluster right away
+        for id in cluster.ids:
+            if id in self.memories:
+                self.memories.move_to_end(id)
+        self.stats.clusters_skipped += 1
+
+    def next_summary_id(self) -> str:
+        # Unique across runs, a resumed run must not overwrite old summaries
+        return f"summary_{uuid.uuid4().hex[:12]}"
+
+    def __kmeans(self, matrix: npt.NDArray[np.float32], k: int) -> npt.NDArray[np.intp]:
+        # Spherical k-means seeded with evenly spaced memories, which is
+        # deterministic and good enough to group memories on the same subject
+        seeds = np.linspace(0, len(matrix) - 1, num=k).round().astype(np.intp)
+        centroids = matrix[seeds]
+        labels = np.zeros(len(matrix), dtype=np.intp)
+        for _ in range(KMEANS_ROUNDS):
+            labels = np.argmax(matrix @ centroids.T, axis=1)
+            for label in range(k):
+                members = matrix[labels == label]
+                if len(members):
+                    centroids[label] = unit_normalize(members.mean(axis=0))
+        return labels
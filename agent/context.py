@@ -0,0 +1,84 @@
+import re
+from typing import List, Optional, Set
+
+from agent.models import ExpectedAgentMetadata, VectorStoreQueryResult
+from agent.prompts import stringify_context
+from completions.tokens import count_tokens, truncate_tokens
+
+TRUNCATION_MARKER = " [...]"
+
+
+# Packs retrieved memories into the prompt by relevance until the token
+# budget is spent, skipping near-identical memories and truncating any
+# single memory that would crowd out the rest
+class ContextBuilder:
+    def __init__(
+        self,
+        token_budget: int,
+        memory_token_limit: int,
+        task_list_token_budget: int,
+        duplicate_threshold: float = 0.9,
+        model: str = "gpt-3.5-turbo",
+    ):
+        self.token_budget = token_budget
+        self.memory_token_limit = memory_token_limit
+        self.task_list_token_budget = task_list_token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.model = model
+
+    def pack_memories(
+        self,
+        memories: List[VectorStoreQueryResult],
+        pinned: Optional[List[ExpectedAgentMetadata]] = None,
+    ) -> List[str]:
+        # Pinned memories, like the results of the tasks a task depends on,
+        # go first whatever their relevance
+        packed: List[str] = []
+        seen: List[Set[str]] = []
+        used_tokens = 0
+        ranked = sorted(memories, key=lambda m: m.score, reverse=True)
+        for metadata in (pinned or []) + [m.metadata for m in ranked]:
+            words = self.__words(metadata.task + " " + metadata.result)
+            if any(self.__is_duplicate(words, s) for s in seen):
+                continue
+            rendered = stringify_context(self.__truncate(metadata))
+            tokens = count_tokens(rendered, self.model)
+            if used_tokens + tokens > self.token_budget:
+                break
+            packed.append(rendered)
+            seen.append(words)
+            used_tokens += tokens
+        return packed
+
+    def pack_memories_for_summary(
+        self, memories: List[ExpectedAgentMetadata]
+    ) -> List[str]:
+        # Every memory of a cluster goes in, oldest first, each truncated
+        return [stringify_context(self.__truncate(m)) for m in memories]
+
+    def pack_task_list(self, task_names: List[str]) -> List[str]:
+        packed: List[str] = []
+        used_tokens = 0
+        for task_name in task_names:
+            tokens = count_tokens(task_name, self.model) + 1
+            if used_tokens + tokens > self.task_list_token_budget:
+                packed.append(f"(and {len(task_names) - len(packed)} more tasks)")
+                break
+            packed.append(task_name)
+            used_tokens += tokens
+        return packed
+
+    def __words(self, text: str) -> Set[str]:
+        return set(re.findall(r"\w+", text.lower()))
+
+    def __is_duplicate(self, a: Set[str], b: Set[str]) -> bool:
+        # Jaccard similarity of the two word sets
+        if not a or not b:
+            return a == b
+        return len(a & b) / len(a | b) >= self.duplicate_threshold
+
+    def __truncate(self, metadata: ExpectedAgentMetadata) -> ExpectedAgentMetadata:
+        result = truncate_tokens(metadata.result, self.memory_token_limit, self.model)
+        if result == metadata.result:
+            return metadata
+        return metadata.model_copy(update={"result": result + TRUNCATION_MARKER})
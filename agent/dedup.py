@@ -0,0 +1,67 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+from pydantic import BaseModel
+
+from agent.parsing import task_name_key
+
+DEFAULT_DUPLICATE_THRESHOLD = 0.92
+
+
+class TaskDedupStats(BaseModel):
+    # New tasks folded into an equivalent queued task
+    merged: int = 0
+    # New tasks dropped because an equivalent task was already executed
+    dropped: int = 0
+    misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.merged + self.dropped
+
+
+# Every task name the agent has queued this run, pending or executed, with
+# unit-normalized embeddings in one growable float32 matrix. Lookups are an
+# exact name match or a brute-force cosine search, which is a single
+# matrix-vector product at the sizes a task queue reaches.
+class TaskDedupIndex:
+    def __init__(self, threshold: Optional[float] = DEFAULT_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.stats = TaskDedupStats()
+        self.names: Dict[str, str] = {}
+        self.ids: List[str] = []
+        self.matrix: Optional[npt.NDArray[np.float32]] = None
+
+    def find(
+        self, task_name: str, vector: Optional[npt.NDArray[np.float32]]
+    ) -> Optional[str]:
+        # Returns the id of an equivalent task, if there is one
+        task_id = self.names.get(task_name_key(task_name))
+        if task_id is not None or vector is None or self.threshold is None:
+            return task_id
+        if self.matrix is None or not self.ids:
+            return None
+        scores = self.matrix[: len(self.ids)] @ vector
+        best = int(np.argmax(scores))
+        return self.ids[best] if scores[best] >= self.threshold else None
+
+    def add(
+        self, task_id: str, task_name: str, vector: Optional[npt.NDArray[np.float32]]
+    ):
+        self.names.setdefault(task_name_key(task_name), task_id)
+        if vector is None:
+            return
+        self.__reserve(len(self.ids) + 1, len(vector))
+        assert self.matrix is not None
+        self.matrix[len(self.ids)] = vector
+        self.ids.append(task_id)
+
+    def __reserve(self, size: int, dimension: int):
+        if self.matrix is not None and size <= len(self.matrix):
+            return
+        capacity = max(size, 2 * len(self.ids), 64)
+        matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        if self.matrix is not None:
+            matrix[: len(self.ids)] = self.matrix[: len(self.ids)]
+        self.matrix = matrix
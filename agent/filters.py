@@ -0,0 +1,54 @@
+from typing import Any, Mapping, Optional
+
+
+# Evaluates a Pinecone style metadata filter locally. Plain values mean
+# equality, lists mean membership, and operator dicts ($eq, $ne, $in, $nin,
+# $gt, $gte, $lt, $lte) as well as top level $and/$or are supported.
+def matches_filter(
+    metadata: Mapping[str, Any], filter: Optional[Mapping[str, Any]]
+) -> bool:
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, f) for f in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, f) for f in condition):
+                return False
+        elif not __matches_condition(metadata.get(key), condition):
+            return False
+    return True
+
+
+def __matches_condition(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict):
+        return all(
+            __matches_operator(value, operator, operand)
+            for operator, operand in condition.items()
+        )
+    if isinstance(condition, list):
+        return value in condition
+    return bool(value == condition)
+
+
+def __matches_operator(value: Any, operator: str, operand: Any) -> bool:
+    match operator:
+        case "$eq":
+            return bool(value == operand)
+        case "$ne":
+            return bool(value != operand)
+        case "$in":
+            return value in operand
+        case "$nin":
+            return value not in operand
+        case "$gt":
+            return value is not None and value > operand
+        case "$gte":
+            return value is not None and value >= operand
+        case "$lt":
+            return value is not None and value < operand
+        case "$lte":
+            return value is not None and value <= operand
+        case _:
+            raise ValueError(f"Unsupported filter operator: {operator}")
@@ -0,0 +1,191 @@
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set
+
+from pydantic import BaseModel
+
+from agent.models import ExpectedAgentMetadata, Task
+from agent.parsing import task_name_key
+
+DEFAULT_MAX_RESULTS = 256
+
+
+class CriticalPath(BaseModel):
+    task_names: List[str] = []
+    # Longest chain of tasks waiting on each other, no number of workers runs
+    # the objective faster than this
+    seconds: float = 0.0
+    # Time spent on all tasks, what a single worker would take
+    total_seconds: float = 0.0
+
+    @property
+    def parallelism(self) -> float:
+        return self.total_seconds / self.seconds if self.seconds else 1.0
+
+
+class TaskNode:
+    __slots__ = (
+        "task",
+        "created_by",
+        "waiting_on",
+        "dependents",
+        "started",
+        "executed",
+        "completed",
+    )
+
+    def __init__(self, task: Task, created_by: Optional[str]):
+        self.task = task
+        self.created_by = created_by
+        # Dependencies that have not finished executing yet
+        self.waiting_on: Set[str] = set()
+        self.dependents: Set[str] = set()
+        self.started: Optional[float] = None
+        # Seconds from start until executed, and until its tasks were created
+        self.executed: Optional[float] = None
+        self.completed: Optional[float] = None
+
+
+# Dependency edges between tasks, from Task.depends_on. A task is ready once
+# every task it depends on has executed, and the executed results are kept so
+# they can go into their dependents' context. New tasks can only depend on
+# tasks added before them, which keeps the graph acyclic. Finished tasks keep
+# their node so the critical path covers the whole objective; besides the
+# dependencies, a task also waits for the task that created it.
+class TaskGraph:
+    def __init__(self, max_results: int = DEFAULT_MAX_RESULTS):
+        self.max_results = max_results
+        self.nodes: Dict[str, TaskNode] = {}
+        self.ids_by_name: Dict[str, str] = {}
+        self.results: OrderedDict[str, str] = OrderedDict()
+
+    def add(self, tasks: List[Task], created_by: Optional[str] = None):
+        added = [task for task in tasks if task.task_id not in self.nodes]
+        for task in added:
+            self.nodes[task.task_id] = TaskNode(task, created_by)
+            self.ids_by_name[task_name_key(task.task_name)] = task.task_id
+        for task in added:
+            node = self.nodes[task.task_id]
+            for dependency_id in task.depends_on:
+                dependency = self.nodes.get(dependency_id)
+                # Unknown dependencies executed before a resume
+                if dependency is None or dependency.executed is not None:
+                    continue
+                node.waiting_on.add(dependency_id)
+                dependency.dependents.add(task.task_id)
+
+    def resolve(self, task_names: List[str]) -> List[str]:
+        ids = (self.ids_by_name.get(task_name_key(name)) for name in task_names)
+        return list(dict.fromkeys(id for id in ids if id is not None))
+
+    def is_ready(self, task_id: str) -> bool:
+        node = self.nodes.get(task_id)
+        return node is None or not node.waiting_on
+
+    def start(self, task_id: str):
+        node = self.nodes.get(task_id)
+        if node is not None:
+            node.started = time.perf_counter()
+
+    def finish(self, task_id: str, result: str) -> List[str]:
+        # Returns the dependents that became ready
+        node = self.nodes.get(task_id)
+        if node is None or node.executed is not None:
+            return []
+        node.executed = self.__elapsed(node)
+        # Tasks created later can depend on this one too
+        self.results[task_id] = result
+        if len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+        ready = []
+        for dependent_id in node.dependents:
+            dependent = self.nodes[dependent_id]
+            dependent.waiting_on.discard(task_id)
+            if not dependent.waiting_on:
+                ready.append(dependent_id)
+        return ready
+
+    def complete(self, task_id: str):
+        node = self.nodes.get(task_id)
+        if node is not None and node.completed is None:
+            node.completed = self.__elapsed(node)
+
+    def dependency_results(self, task: Task) -> List[ExpectedAgentMetadata]:
+        return [
+            ExpectedAgentMetadata(
+                task=self.nodes[id].task.task_name,
+                result=self.results[id],
+                thought_type="EXECUTE_THOUGHT",
+            )
+            for id in task.depends_on
+            if id in self.results and id in self.nodes
+        ]
+
+    def critical_path(self) -> CriticalPath:
+        if not self.nodes:
+            return CriticalPath()
+        finished = [n for n in self.nodes.values() if n.completed is not None]
+        # Unfinished tasks count as an average task
+        executed = self.__mean([n.executed or 0.0 for n in finished])
+        completed = self.__mean([n.completed or 0.0 for n in finished])
+        # Dependents can start once a task has executed, the tasks it creates
+        # once it has completed
+        executed_at: Dict[str, float] = {}
+        completed_at: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for id in self.__topological_order():
+            node = self.nodes[id]
+            waits = [
+                (executed_at[d], d) for d in node.task.depends_on if d in self.nodes
+            ]
+            if node.created_by is not None and node.created_by in self.nodes:
+                waits.append((completed_at[node.created_by], node.created_by))
+            start, previous[id] = max(waits, default=(0.0, None))
+            executed_at[id] = start + (
+                node.executed if node.executed is not None else executed
+            )
+            completed_at[id] = start + (
+                node.completed if node.completed is not None else completed
+            )
+        last: Optional[str] = max(completed_at, key=lambda id: completed_at[id])
+        path: List[str] = []
+        while last is not None:
+            path.append(self.nodes[last].task.task_name)
+            last = previous[last]
+        return CriticalPath(
+            task_names=path[::-1],
+            seconds=max(completed_at.values()),
+            total_seconds=sum(
+                n.completed if n.completed is not None else completed
+                for n in self.nodes.values()
+            ),
+        )
+
+    def __elapsed(self, node: TaskNode) -> float:
+        if node.started is None:
+            return 0.0
+        return time.perf_counter() - node.started
+
+    def __mean(self, values: List[float]) -> float:
+        return sum(values) / len(values) if values else 0.0
+
+    def __topological_order(self) -> List[str]:
+        dependents: Dict[str, List[str]] = {}
+        indegree = dict.fromkeys(self.nodes, 0)
+        for id, node in self.nodes.items():
+            waits_on = [d for d in node.task.depends_on if d in self.nodes]
+            if node.created_by is not None and node.created_by in self.nodes:
+                waits_on.append(node.created_by)
+            for dependency_id in waits_on:
+                dependents.setdefault(dependency_id, []).append(id)
+                indegree[id] += 1
+        queue: Deque[str] = deque(id for id, count in indegree.items() if not count)
+        order = []
+        while queue:
+            id = queue.popleft()
+            order.append(id)
+            for dependent_id in dependents.get(id, []):
+                indegree[dependent_id] -= 1
+                if not indegree[dependent_id]:
+                    queue.append(dependent_id)
+        return order
@@ -0,0 +1,474 @@
+import hashlib
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pinecone
+
+from agent.filters import matches_filter
+
+# Logged record changes a local namespace keeps before rewriting records.json
+LOG_COMPACT_MIN = 256
+
+# (id, vector, metadata) as accepted by pinecone.Index.upsert
+VectorRecord = Tuple[str, List[float], Dict[str, str]]
+
+
+class VectorIndexBackendEnum(str, Enum):
+    pinecone = "pinecone"
+    local = "local"
+
+
+class VectorIndex(ABC):
+    # Query results use the same {"matches": [{id, score, metadata, values}]}
+    # shape as the Pinecone client so backends are interchangeable
+    @abstractmethod
+    def upsert(self, vectors: List[VectorRecord], namespace: str):
+        ...
+
+    @abstractmethod
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: str,
+        filter: Optional[Dict[str, Any]] = None,
+        include_metadata: bool = True,
+        include_values: bool = False,
+    ) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def delete(self, ids: List[str], namespace: str):
+        ...
+
+    @abstractmethod
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, Any]:
+        # {"vectors": {id: {id, values, metadata}}}, ids not found are left out
+        ...
+
+
+class PineconeIndex(VectorIndex):
+    def __init__(
+        self,
+        name: str,
+        api_key: str,
+        environment: str,
+        dimension: int = 1536,
+        provisioning_cache_path: Optional[str] = None,
+    ):
+        pinecone.init(api_key=api_key, environment=environment)
+        # Indexes known to exist are remembered on disk, so later startups
+        # skip listing (and possibly creating) them
+        provisioned = ProvisioningCache(provisioning_cache_path)
+        if not provisioned.contains(environment, name):
+            if name not in pinecone.list_indexes():
+                pinecone.create_index(
+                    name=name,
+                    metric="cosine",
+                    dimension=dimension,
+                    pod_type="p1",
+                )
+            provisioned.add(environment, name)
+        self.index = pinecone.Index(name)
+
+    def upsert(self, vectors: List[VectorRecord], namespace: str):
+        self.index.upsert(vectors, namespace=namespace)
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: str,
+        filter: Optional[Dict[str, Any]] = None,
+        include_metadata: bool = True,
+        include_values: bool = False,
+    ) -> Dict[str, Any]:
+        result: Dict[str, Any] = self.index.query(
+            vector=vector,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            include_values=include_values,
+            namespace=namespace,
+            filter=filter,
+        )
+        return result
+
+    def delete(self, ids: List[str], namespace: str):
+        self.index.delete(ids=ids, namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, Any]:
+        fetched = self.index.fetch(ids=ids, namespace=namespace)
+        return {
+            "vectors": {
+                id: {
+                    "id": id,
+                    "values": list(vector["values"]),
+                    "metadata": dict(vector.get("metadata") or {}),
+                }
+                for id, vector in fetched["vectors"].items()
+            },
+            "namespace": namespace,
+        }
+
+
+class ProvisioningCache:
+    def __init__(self, path: Optional[str]):
+        self.path = path
+
+    def contains(self, environment: str, name: str) -> bool:
+        return name in self.__load().get(environment, [])
+
+    def add(self, environment: str, name: str):
+        if not self.path:
+            return
+        provisioned = self.__load()
+        names = provisioned.setdefault(environment, [])
+        if name not in names:
+            names.append(name)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(provisioned, f)
+        os.replace(tmp_path, self.path)
+
+    def __load(self) -> Dict[str, List[str]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                provisioned: Dict[str, List[str]] = json.load(f)
+            return provisioned
+        except (OSError, ValueError):
+            return {}
+
+
+# Creates the wrapped index (for Pinecone: init, listing and provisioning,
+# all network round trips) on a background thread, so startup does not wait
+# for it and callers only block if they use the index before it is ready
+class LazyIndex(VectorIndex):
+    def __init__(self, create: Callable[[], VectorIndex]):
+        self.create = create
+        self.lock = threading.Lock()
+        self.future: Optional[Future[VectorIndex]] = None
+
+    def warm_up(self) -> "Future[VectorIndex]":
+        with self.lock:
+            if self.future is None:
+                self.future = Future()
+                threading.Thread(target=self.__create, daemon=True).start()
+            return self.future
+
+    @property
+    def ready(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def upsert(self, vectors: List[VectorRecord], namespace: str):
+        self.__index().upsert(vectors, namespace=namespace)
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: str,
+        filter: Optional[Dict[str, Any]] = None,
+        include_metadata: bool = True,
+        include_values: bool = False,
+    ) -> Dict[str, Any]:
+        return self.__index().query(
+            vector,
+            top_k=top_k,
+            namespace=namespace,
+            filter=filter,
+            include_metadata=include_metadata,
+            include_values=include_values,
+        )
+
+    def delete(self, ids: List[str], namespace: str):
+        self.__index().delete(ids, namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, Any]:
+        return self.__index().fetch(ids, namespace=namespace)
+
+    def __index(self) -> VectorIndex:
+        return self.warm_up().result()
+
+    def __create(self):
+        assert self.future is not None
+        try:
+            self.future.set_result(self.create())
+        except BaseException as e:
+            self.future.set_exception(e)
+
+
+# Vectors live in a memory-mapped matrix, ids and metadata in records.json.
+# Changes since records.json was written are appended to a log, which is
+# folded into a new records.json once it outgrows the namespace, so a flush
+# costs its own size rather than the namespace's. Each records.json names the
+# generation of the log that continues it, so a crash while compacting never
+# replays a log twice.
+class LocalNamespace:
+    def __init__(self, directory: str, namespace: str, dimension: int):
+        self.directory = directory
+        self.records_path = os.path.join(directory, "records.json")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.namespace = namespace
+        self.dimension = dimension
+        self.ids: List[str] = []
+        self.metadata: List[Dict[str, str]] = []
+        self.rows: Dict[str, int] = {}
+        self.capacity = 0
+        self.matrix: Optional[np.memmap[Any, np.dtype[np.float32]]] = None
+        self.generation = 0
+        self.logged = 0
+        if os.path.exists(self.records_path):
+            with open(self.records_path) as f:
+                records = json.load(f)
+            self.dimension = records["dimension"]
+            self.ids = records["ids"]
+            self.metadata = records["metadata"]
+            self.generation = records.get("generation", 0)
+            self.rows = {id: row for row, id in enumerate(self.ids)}
+        if os.path.exists(self.log_path):
+            self.__replay()
+        if os.path.exists(self.vectors_path):
+            self.capacity = os.path.getsize(self.vectors_path) // (4 * self.dimension)
+            self.matrix = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(self.capacity, self.dimension),
+            )
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def upsert(self, vectors: List[VectorRecord]):
+        self.__reserve(self.count + len(vectors))
+        assert self.matrix is not None
+        for id, values, metadata in vectors:
+            row = self.__set(id, metadata)
+            self.matrix[row] = unit_normalize(np.asarray(values, dtype=np.float32))
+        self.__log(
+            {"type": "upsert", "records": [[id, m] for id, _, m in vectors]},
+            len(vectors),
+        )
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        filter: Optional[Dict[str, Any]],
+        include_metadata: bool,
+        include_values: bool,
+    ) -> List[Dict[str, Any]]:
+        if self.matrix is None or self.count == 0 or top_k <= 0:
+            return []
+        matrix = self.matrix[: self.count]
+        scores = matrix @ unit_normalize(np.asarray(vector, dtype=np.float32))
+        if filter:
+            mask = np.fromiter(
+                (matches_filter(m, filter) for m in self.metadata),
+                dtype=bool,
+                count=self.count,
+            )
+            candidates = np.flatnonzero(mask)
+        else:
+            candidates = np.arange(self.count)
+        if len(candidates) > top_k:
+            top = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+            candidates = candidates[top]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            {
+                "id": self.ids[row],
+                "score": float(scores[row]),
+                "metadata": self.metadata[row] if include_metadata else {},
+                "values": matrix[row].tolist() if include_values else [],
+            }
+            for row in ranked
+        ]
+
+    def fetch(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        if self.matrix is None:
+            return {}
+        return {
+            id: {
+                "id": id,
+                "values": self.matrix[self.rows[id]].tolist(),
+                "metadata": self.metadata[self.rows[id]],
+            }
+            for id in ids
+            if id in self.rows
+        }
+
+    def delete(self, ids: List[str]):
+        if self.matrix is None:
+            return
+        for id in ids:
+            self.__remove(id, self.matrix)
+        self.__log({"type": "delete", "ids": ids}, len(ids))
+
+    def __set(self, id: str, metadata: Dict[str, str]) -> int:
+        row = self.rows.get(id)
+        if row is None:
+            row = self.count
+            self.rows[id] = row
+            self.ids.append(id)
+            self.metadata.append(dict(metadata))
+        else:
+            self.metadata[row] = dict(metadata)
+        return row
+
+    def __remove(
+        self, id: str, matrix: Optional["np.memmap[Any, np.dtype[np.float32]]"]
+    ):
+        row = self.rows.pop(id, None)
+        if row is None:
+            return
+        # Move the last record into the freed row to keep rows dense. When
+        # replaying the log the matrix already holds the moved vectors.
+        last = self.count - 1
+        if row != last:
+            moved = self.ids[last]
+            self.ids[row] = moved
+            self.metadata[row] = self.metadata[last]
+            if matrix is not None:
+                matrix[row] = matrix[last]
+            self.rows[moved] = row
+        self.ids.pop()
+        self.metadata.pop()
+
+    def __replay(self):
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final write from a crash
+                    break
+                if change["type"] == "upsert":
+                    for id, metadata in change["records"]:
+                        self.__set(id, metadata)
+                    self.logged += len(change["records"])
+                else:
+                    for id in change["ids"]:
+                        self.__remove(id, None)
+                    self.logged += len(change["ids"])
+
+    def __log(self, change: Dict[str, Any], size: int):
+        assert self.matrix is not None
+        # Vectors are flushed before the records pointing at them are logged
+        self.matrix.flush()
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(change) + "\n")
+        self.logged += size
+        if self.logged > max(LOG_COMPACT_MIN, self.count):
+            self.__persist()
+
+    def __reserve(self, size: int):
+        if size <= self.capacity:
+            return
+        capacity = max(size, self.capacity * 2, 64)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dimension * 4)
+        self.capacity = capacity
+        self.matrix = np.memmap(
+            self.vectors_path,
+            dtype=np.float32,
+            mode="r+",
+            shape=(self.capacity, self.dimension),
+        )
+
+    def __persist(self):
+        assert self.matrix is not None
+        self.matrix.flush()
+        tmp_path = self.records_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "namespace": self.namespace,
+                    "dimension": self.dimension,
+                    "ids": self.ids,
+                    "metadata": self.metadata,
+                    "generation": self.generation + 1,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.records_path)
+        # Everything logged is in records.json now
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.generation += 1
+        self.logged = 0
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.directory, f"records.{self.generation}.log")
+
+
+# In-process index keeping one unit-normalized float32 matrix per namespace,
+# memory-mapped from disk, so cosine top-k is a single matrix-vector product
+class LocalIndex(VectorIndex):
+    def __init__(self, path: str, dimension: int = 1536):
+        self.path = path
+        self.dimension = dimension
+        self.namespaces: Dict[str, LocalNamespace] = {}
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors: List[VectorRecord], namespace: str):
+        if not vectors:
+            return
+        with self.lock:
+            self.__namespace(namespace).upsert(vectors)
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: str,
+        filter: Optional[Dict[str, Any]] = None,
+        include_metadata: bool = True,
+        include_values: bool = False,
+    ) -> Dict[str, Any]:
+        with self.lock:
+            matches = self.__namespace(namespace).query(
+                vector, top_k, filter, include_metadata, include_values
+            )
+        return {"matches": matches, "namespace": namespace}
+
+    def delete(self, ids: List[str], namespace: str):
+        if not ids:
+            return
+        with self.lock:
+            self.__namespace(namespace).delete(ids)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, Any]:
+        with self.lock:
+            vectors = self.__namespace(namespace).fetch(ids)
+        return {"vectors": vectors, "namespace": namespace}
+
+    def __namespace(self, namespace: str) -> LocalNamespace:
+        local_namespace = self.namespaces.get(namespace)
+        if local_namespace is None:
+            directory = os.path.join(
+                self.path, hashlib.sha1(namespace.encode("utf-8")).hexdigest()
+            )
+            local_namespace = LocalNamespace(directory, namespace, self.dimension)
+            self.namespaces[namespace] = local_namespace
+        return local_namespace
+
+
+def unit_normalize(vector: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
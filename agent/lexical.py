@@ -0,0 +1,107 @@
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, Mapping, Optional
+
+from pydantic import BaseModel
+
+from agent.filters import matches_filter
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from how in is it of on or that the this to "
+    "what with".split()
+)
+
+
+class LexicalMatch(BaseModel):
+    id: str
+    score: float
+    # Share of the distinct query terms found in the memory
+    coverage: float
+    metadata: Dict[str, str]
+
+
+# In-memory inverted index over memory text, scored with BM25. It answers
+# keyword lookups without an embedding call and gives hybrid retrieval a
+# second ranking to fuse with the vector one.
+class LexicalIndex:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.terms: Dict[str, Counter[str]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.metadata: Dict[str, Dict[str, str]] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def add(self, id: str, text: str, metadata: Dict[str, str]):
+        self.remove([id])
+        terms = Counter(tokenize(text))
+        self.terms[id] = terms
+        self.metadata[id] = metadata
+        self.lengths[id] = sum(terms.values())
+        self.total_length += self.lengths[id]
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[id] = count
+
+    def remove(self, ids: List[str]):
+        for id in ids:
+            terms = self.terms.pop(id, None)
+            if terms is None:
+                continue
+            del self.metadata[id]
+            self.total_length -= self.lengths.pop(id)
+            for term in terms:
+                postings = self.postings[term]
+                del postings[id]
+                if not postings:
+                    del self.postings[term]
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        filter: Optional[Mapping[str, Any]] = None,
+    ) -> List[LexicalMatch]:
+        query_terms = set(tokenize(query))
+        if not query_terms or not self.terms or top_k <= 0:
+            return []
+        documents = len(self.terms)
+        average_length = self.total_length / documents
+        scores: Dict[str, float] = {}
+        hits: Dict[str, int] = {}
+        for term in query_terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for id, count in postings.items():
+                norm = count + self.k1 * (
+                    1 - self.b + self.b * self.lengths[id] / average_length
+                )
+                scores[id] = scores.get(id, 0.0) + idf * count * (self.k1 + 1) / norm
+                hits[id] = hits.get(id, 0) + 1
+        matches: List[LexicalMatch] = []
+        for id in sorted(scores, key=lambda i: scores[i], reverse=True):
+            if not matches_filter(self.metadata[id], filter):
+                continue
+            matches.append(
+                LexicalMatch(
+                    id=id,
+                    score=scores[id],
+                    coverage=hits[id] / len(query_terms),
+                    metadata=self.metadata[id],
+                )
+            )
+            if len(matches) == top_k:
+                break
+        return matches
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS]
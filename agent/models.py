@@ -1,29 +1,122 @@
+import asyncio
+import json
+import os
 import re
-import pinecone
+import time
+import numpy as np
+import numpy.typing as npt
 import openai
-from typing import Deque, Dict, List, Optional
-from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
 from pydantic import BaseModel
-from config import Config
+from agent.cache import EmbeddingCache, normalize_text
+from completions.router import PhaseEnum
+from agent.compaction import (
+    DEFAULT_MEMORIES_PER_SUMMARY,
+    MemoryCluster,
+    MemoryCompactor,
+)
+from agent.filters import matches_filter
+from agent.lexical import LexicalIndex, LexicalMatch
+from agent.indexes import (
+    LazyIndex,
+    LocalIndex,
+    PineconeIndex,
+    VectorIndex,
+    VectorIndexBackendEnum,
+    VectorRecord,
+    unit_normalize,
+)
+from config import get_config
+from tracing import Span, tracer
 
-config = Config()
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Reciprocal rank fusion constant, damps the weight of the very first ranks
+RRF_K = 60
+# Ids per index fetch when restoring memories on resume
+FETCH_BATCH_SIZE = 100
 
 
 # Pydantic models
 class Task(BaseModel):
     task_id: str
     task_name: str
+    # Ids of tasks that have to execute before this one
+    depends_on: List[str] = []
 
 
 class CreateAgentParams(BaseModel):
     objective: str
     log: bool = False
+    # Stream completions, printing thoughts and enqueueing created tasks as
+    # they arrive
+    stream: bool = False
+    # Serve repeated prompts from the on-disk completion cache, and with a
+    # similarity threshold also prompts whose embeddings are that close
+    completion_cache: bool = False
+    completion_cache_similarity: Optional[float] = None
+    # Token budgets for memories packed into thought prompts, for any single
+    # memory, and for the pending task list sent with task creation
+    context_token_budget: int = 1500
+    memory_token_limit: int = 300
+    task_list_token_budget: int = 1000
+    # Memories are retrieved for the current task by fusing vector search
+    # with a local BM25 index; vector matches scoring below the threshold
+    # are left out of the prompt
+    hybrid_retrieval: bool = True
+    context_min_score: Optional[float] = None
+    # Write spans to this JSONL file and print a latency summary at the end
+    trace_path: Optional[str] = None
+    # Stop after executing this many tasks, even if some are still pending
+    max_iterations: Optional[int] = None
+    # Log progress to this file and resume from it when it already exists
+    checkpoint_path: Optional[str] = None
+    # Async mode only: tasks executed concurrently
+    workers: int = 1
+    # Async mode only: start the internal thought of the task at the head of
+    # the queue while task creation and prioritization wait on the LLM, and
+    # keep it if that task is picked next
+    speculate: bool = False
+    # Tasks are ordered locally by similarity to the objective and age. The
+    # LLM reranks the queue only every `prioritize_every` executed tasks, or
+    # once tasks added since the last ranking reach this share of the queue.
+    prioritize_every: Optional[int] = None
+    reprioritize_change_ratio: float = 0.5
+    # New tasks this similar to a queued one are dropped as duplicates
+    task_duplicate_threshold: Optional[float] = 0.92
+    # Task creation and prioritization ask for a JSON task plan with
+    # priorities and dependencies instead of a numbered list. Task creation
+    # is then not streamed.
+    structured_output: bool = False
+    # Send prompts compiled once per objective: compacted instructions, with
+    # the objective in a system message every call starts with
+    compiled_prompts: bool = False
+    # Models per phase, overriding the defaults. Each phase tries its models
+    # in order, moving on only when the output is unusable.
+    model_routes: Dict[PhaseEnum, List[str]] = {}
+    # Once the vector namespace holds more than this many memories, all but
+    # the newest quarter are clustered and each cluster replaced by a summary
+    max_memories: Optional[int] = 200
+    # Prefix of the vector index namespace the agent's memories are kept in
+    agent_id: str = "gentle_bot"
 
 
 class CreateVectorStore(BaseModel):
     objective: str
     results_store_name: str
     agent_id: str
+    # Defaults to the VECTOR_STORE_BACKEND environment variable
+    backend: Optional[VectorIndexBackendEnum] = None
+    # Write-behind buffer flushes once it holds this many adds or once the
+    # oldest pending add is older than this many seconds
+    max_pending: int = 8
+    max_pending_age: float = 30.0
+    # Queries made while the index is still being provisioned only see
+    # pending adds, unless they should wait for it
+    wait_for_index: bool = False
+    # Memory compaction, off unless a limit is set
+    max_memories: Optional[int] = None
+    memories_per_summary: int = DEFAULT_MEMORIES_PER_SUMMARY
 
 
 class VectorStoreAdd(BaseModel):
@@ -37,6 +130,16 @@ class VectorStoreQuery(BaseModel):
     query: str
     top_results_num: int = 5
     filter: Optional[Dict[str, str | List[str]]] = None
+    # Vector matches less similar to the query than this are dropped
+    min_score: Optional[float] = None
+    # Also rank memories by BM25 over their text and fuse both rankings.
+    # Lexical matches holding at least `lexical_coverage` of the query terms
+    # are confident: they shrink the vector query, and once they fill the
+    # results no embedding or vector query is made at all.
+    hybrid: bool = True
+    lexical_coverage: float = 0.75
+    # Matched vectors are neither transferred nor kept unless asked for
+    include_values: bool = False
 
 
 class ExpectedAgentMetadata(BaseModel):
@@ -45,94 +148,525 @@ class ExpectedAgentMetadata(BaseModel):
     thought_type: str
 
 
-class VectorStoreQueryResult(BaseModel):
-    id: str
-    score: float
-    metadata: ExpectedAgentMetadata
-    values: List[float]
+# Built for every match of every query, so a slotted class rather than a
+# validated model. The matched vector is only attached when the query asked
+# for it, as a float32 array.
+class VectorStoreQueryResult:
+    __slots__ = ("id", "score", "metadata", "values")
 
+    def __init__(
+        self,
+        id: str,
+        score: float,
+        metadata: ExpectedAgentMetadata,
+        values: Optional[npt.NDArray[np.float32]] = None,
+    ):
+        self.id = id
+        self.score = score
+        self.metadata = metadata
+        self.values = values
 
-# Util classes
-class SingleTaskListStorage:
-    def __init__(self):
-        self.tasks: Deque[Task] = deque([])
-        self.task_id_counter = 0
-
-    def append(self, task: Task):
-        self.tasks.append(task)
+    def with_score(self, score: float) -> "VectorStoreQueryResult":
+        return VectorStoreQueryResult(self.id, score, self.metadata, self.values)
 
-    def replace(self, tasks: List[Task]):
-        self.tasks = deque(tasks)
 
-    def popleft(self):
-        return self.tasks.popleft()
-
-    def is_empty(self):
-        return False if self.tasks else True
+class PendingVectorStoreAdd(BaseModel):
+    result_id: str
+    text: str
+    metadata: Dict[str, str]
+    added_at: float
+    vector: Optional[List[float]] = None
 
-    def next_task_id(self):
-        self.task_id_counter += 1
-        return self.task_id_counter
 
-    def get_task_names(self):
-        return [t.task_name for t in self.tasks]
+# Util functions
+def records_bytes(records: List[VectorRecord]) -> int:
+    # Approximate payload size: float32 values plus JSON encoded metadata
+    return sum(4 * len(values) + len(json.dumps(meta)) for _, values, meta in records)
 
 
+# Util classes
 class VectorStore:
-    def __init__(self, params: CreateVectorStore):
+    # The embedding cache and index are built per store unless shared ones
+    # are passed in; the namespace keeps each objective's memories apart
+    def __init__(
+        self,
+        params: CreateVectorStore,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        index: Optional[LazyIndex] = None,
+    ):
+        config = get_config()
         if not openai.api_key:
             openai.api_key = config.OPENAI_API_KEY
         if not openai.organization:
             openai.organization = config.OPENAI_ORG_KEY
 
-        pinecone.init(
-            api_key=config.PINECONE_API_KEY, environment=config.PINECONE_ENVIRONMENT
-        )
         self.namespace = params.agent_id + re.sub(
             re.compile("[^\x00-\x7F]+"), "", params.objective
         )
-        if params.results_store_name not in pinecone.list_indexes():
-            pinecone.create_index(
-                name=params.results_store_name,
-                metric="cosine",
-                dimension=1536,
-                pod_type="p1",
-            )
-        self.index = pinecone.Index(params.results_store_name)
+        self.index = index or lazy_vector_index(
+            params.backend, params.results_store_name
+        )
+        self.index.warm_up()
+        self.wait_for_index = params.wait_for_index
+        self.embedding_cache = embedding_cache or EmbeddingCache(
+            path=config.EMBEDDING_CACHE_PATH
+        )
+        self.max_pending = params.max_pending
+        self.max_pending_age = params.max_pending_age
+        self.pending: OrderedDict[str, PendingVectorStoreAdd] = OrderedDict()
+        self.compactor = MemoryCompactor(
+            params.max_memories, memories_per_summary=params.memories_per_summary
+        )
+        self.compacting = False
+        self.lexical = LexicalIndex()
+        # Called with the ids of pending adds once they reached the index
+        self.on_flushed: Optional[Callable[[List[str]], None]] = None
+        # Called with the ids of a compacted cluster and the id of the summary
+        # that replaced them, or None when the cluster was skipped
+        self.on_compacted: Optional[Callable[[List[str], Optional[str]], None]] = None
+        self.__background_flush: Optional[asyncio.Task[None]] = None
+
+    def embed(self, text: str) -> List[float]:
+        return self.embed_many([text])[0]
+
+    async def aembed(self, text: str) -> List[float]:
+        return (await self.aembed_many([text]))[0]
 
-    def embed(self, text: str) -> list:  # type: ignore
-        text = text.replace("\n", " ")
-        return openai.Embedding.create(  # type: ignore
-            input=[text], model="text-embedding-ada-002"
-        )["data"][0]["embedding"]
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        with tracer.span("vector_store.embed", inputs=len(texts)) as span:
+            vectors, missing = self.__cached_embeddings(texts)
+            span.set(cached=len(texts) - len(missing))
+            if missing:
+                response = openai.Embedding.create(
+                    input=[normalize_text(t) for t in missing], model=EMBEDDING_MODEL
+                )
+                vectors = self.__merge_embeddings(texts, vectors, missing, response)
+            return [v for v in vectors if v is not None]
+
+    async def aembed_many(self, texts: List[str]) -> List[List[float]]:
+        with tracer.span("vector_store.embed", inputs=len(texts)) as span:
+            vectors, missing = self.__cached_embeddings(texts)
+            span.set(cached=len(texts) - len(missing))
+            if missing:
+                response = await openai.Embedding.acreate(
+                    input=[normalize_text(t) for t in missing], model=EMBEDDING_MODEL
+                )
+                vectors = self.__merge_embeddings(texts, vectors, missing, response)
+            return [v for v in vectors if v is not None]
 
     def add(self, params: VectorStoreAdd):
-        vector = self.embed(params.result)
+        with tracer.span("vector_store.add"):
+            self.__buffer(params)
+            if self.__should_flush():
+                self.flush()
+
+    async def aadd(self, params: VectorStoreAdd):
+        with tracer.span("vector_store.add"):
+            self.__buffer(params)
+            # Flush in the background so the upsert overlaps whatever runs next
+            if self.__should_flush() and (
+                self.__background_flush is None or self.__background_flush.done()
+            ):
+                self.__background_flush = asyncio.create_task(self.aflush())
+
+    def flush(self):
+        if not self.pending:
+            return
+        with tracer.span("vector_store.upsert") as span:
+            pending = list(self.pending.values())
+            self.__embed_pending(pending)
+            batch = self.__upsert_batch(pending)
+            span.set(records=len(batch), bytes=records_bytes(batch))
+            self.index.upsert(batch, namespace=self.namespace)
+            self.compactor.record(batch)
+            self.__discard_flushed(pending)
+
+    async def aflush(self):
+        background_flush = self.__background_flush
+        if (
+            background_flush is not None
+            and background_flush is not asyncio.current_task()
+        ):
+            self.__background_flush = None
+            await background_flush
+        if not self.pending:
+            return
+        with tracer.span("vector_store.upsert") as span:
+            pending = list(self.pending.values())
+            await self.__aembed_pending(pending)
+            batch = self.__upsert_batch(pending)
+            span.set(records=len(batch), bytes=records_bytes(batch))
+            await asyncio.to_thread(self.index.upsert, batch, namespace=self.namespace)
+            self.compactor.record(batch)
+            self.__discard_flushed(pending)
+
+    def restore(self, ids: List[str]):
+        # Memories a previous run upserted, oldest first, so they can still
+        # be compacted and keyword matched. Vectors are fetched back from the
+        # index; ids it no longer has are dropped.
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            batch = ids[start : start + FETCH_BATCH_SIZE]
+            fetched = self.index.fetch(batch, namespace=self.namespace)["vectors"]
+            records: List[VectorRecord] = [
+                (id, fetched[id]["values"], fetched[id]["metadata"])
+                for id in batch
+                if id in fetched
+            ]
+            self.compactor.record(records)
+            for id, _, metadata in records:
+                text = metadata.get("result", "")
+                if metadata.get("thought_type") != "SUMMARY":
+                    text = metadata.get("task", "") + " " + text
+                self.lexical.add(id, text, metadata)
+
+    def compaction_due(self) -> bool:
+        return self.compactor.due and not self.compacting
+
+    def compact(self, summarize: Callable[[MemoryCluster], str]):
+        self.compacting = True
+        try:
+            # Everything pending is flushed first so it can be compacted too
+            self.flush()
+            with tracer.span("vector_store.compact") as span:
+                clusters = self.compactor.clusters()
+                for cluster in clusters:
+                    summary = summarize(cluster)
+                    if not summary.strip():
+                        self.__skip_cluster(cluster)
+                        continue
+                    record = self.__summary_record(
+                        cluster, summary, self.embed(summary)
+                    )
+                    # Upsert before deleting, so a crash in between only
+                    # leaves a duplicate behind
+                    self.index.upsert([record], namespace=self.namespace)
+                    self.index.delete(cluster.ids, namespace=self.namespace)
+                    self.__replace_cluster(cluster, record)
+                self.__record_compaction(clusters, span)
+        finally:
+            self.compacting = False
+
+    async def acompact(self, summarize: Callable[[MemoryCluster], Awaitable[str]]):
+        self.compacting = True
+        try:
+            await self.aflush()
+            with tracer.span("vector_store.compact") as span:
+                clusters = self.compactor.clusters()
+                for cluster in clusters:
+                    summary = await summarize(cluster)
+                    if not summary.strip():
+                        self.__skip_cluster(cluster)
+                        continue
+                    record = self.__summary_record(
+                        cluster, summary, await self.aembed(summary)
+                    )
+                    await asyncio.to_thread(
+                        self.index.upsert, [record], namespace=self.namespace
+                    )
+                    await asyncio.to_thread(
+                        self.index.delete, cluster.ids, namespace=self.namespace
+                    )
+                    self.__replace_cluster(cluster, record)
+                self.__record_compaction(clusters, span)
+        finally:
+            self.compacting = False
+
+    def query(self, params: VectorStoreQuery) -> List[VectorStoreQueryResult]:
+        if self.pending and self.__should_flush():
+            self.flush()
+        with tracer.span("vector_store.query", top_k=params.top_results_num) as span:
+            lexical = self.__lexical_matches(params, span)
+            top_k = self.__dense_top_k(lexical, params)
+            span.set(vector_top_k=top_k)
+            if top_k == 0:
+                return self.__fuse([], lexical, params)
+            pending = list(self.pending.values())
+            (query_vector,) = self.__embed_pending(pending, extra=[params.query])
+            query_result = (
+                self.index.query(
+                    vector=query_vector,
+                    top_k=top_k,
+                    include_metadata=True,
+                    include_values=params.include_values,
+                    namespace=self.namespace,
+                    filter=params.filter,
+                )
+                if self.__index_ready(span)
+                else {"matches": []}
+            )
+            dense = self.__query_results(query_result, query_vector, params, span)
+            return self.__fuse(dense, lexical, params)
+
+    async def aquery(self, params: VectorStoreQuery) -> List[VectorStoreQueryResult]:
+        if self.pending and self.__should_flush():
+            await self.aflush()
+        with tracer.span("vector_store.query", top_k=params.top_results_num) as span:
+            lexical = self.__lexical_matches(params, span)
+            top_k = self.__dense_top_k(lexical, params)
+            span.set(vector_top_k=top_k)
+            if top_k == 0:
+                return self.__fuse([], lexical, params)
+            pending = list(self.pending.values())
+            (query_vector,) = await self.__aembed_pending(pending, extra=[params.query])
+            query_result = (
+                await asyncio.to_thread(
+                    self.index.query,
+                    vector=query_vector,
+                    top_k=top_k,
+                    include_metadata=True,
+                    include_values=params.include_values,
+                    namespace=self.namespace,
+                    filter=params.filter,
+                )
+                if self.__index_ready(span)
+                else {"matches": []}
+            )
+            dense = self.__query_results(query_result, query_vector, params, span)
+            return self.__fuse(dense, lexical, params)
+
+    def __lexical_matches(
+        self, params: VectorStoreQuery, span: Span
+    ) -> List[LexicalMatch]:
+        if not params.hybrid:
+            return []
+        matches = self.lexical.search(
+            params.query, top_k=params.top_results_num, filter=params.filter
+        )
+        span.set(lexical_matches=len(matches))
+        return matches
+
+    def __dense_top_k(
+        self, lexical: List[LexicalMatch], params: VectorStoreQuery
+    ) -> int:
+        # Confident keyword matches take the place of vector matches
+        confident = sum(m.coverage >= params.lexical_coverage for m in lexical)
+        return max(0, params.top_results_num - confident)
+
+    def __fuse(
+        self,
+        dense: List[VectorStoreQueryResult],
+        lexical: List[LexicalMatch],
+        params: VectorStoreQuery,
+    ) -> List[VectorStoreQueryResult]:
+        if not lexical:
+            return dense
+        # Reciprocal rank fusion: raw cosine and BM25 scores are not
+        # comparable, their ranks are
+        fused: Dict[str, VectorStoreQueryResult] = {}
+        scores: Dict[str, float] = {}
+        for rank, result in enumerate(dense):
+            fused[result.id] = result
+            scores[result.id] = 1 / (RRF_K + rank + 1)
+        for rank, match in enumerate(lexical):
+            fused.setdefault(
+                match.id,
+                VectorStoreQueryResult(
+                    id=match.id,
+                    score=0.0,
+                    metadata=ExpectedAgentMetadata(**match.metadata),
+                ),
+            )
+            scores[match.id] = scores.get(match.id, 0.0) + 1 / (RRF_K + rank + 1)
+        ranked = sorted(fused, key=lambda id: scores[id], reverse=True)
+        return [
+            fused[id].with_score(scores[id]) for id in ranked[: params.top_results_num]
+        ]
+
+    def __index_ready(self, span: Span) -> bool:
+        # While the index is still warming up, the first queries fall back to
+        # the pending adds instead of holding up the first completions
+        if self.wait_for_index or self.index.ready:
+            return True
+        span.set(cold=True)
+        return False
+
+    def __summary_record(
+        self, cluster: MemoryCluster, summary: str, vector: List[float]
+    ) -> VectorRecord:
+        metadata = {
+            "task": f"{cluster.summarized} earlier memories",
+            "result": summary,
+            "thought_type": "SUMMARY",
+            "summarized": str(cluster.summarized),
+        }
+        return (self.compactor.next_summary_id(), vector, metadata)
+
+    def __replace_cluster(self, cluster: MemoryCluster, record: VectorRecord):
+        self.compactor.replace(cluster, record)
+        self.lexical.remove(cluster.ids)
+        self.lexical.add(record[0], record[2]["result"], record[2])
+        if self.on_compacted is not None:
+            self.on_compacted(cluster.ids, record[0])
+
+    def __skip_cluster(self, cluster: MemoryCluster):
+        self.compactor.skip(cluster)
+        if self.on_compacted is not None:
+            self.on_compacted(cluster.ids, None)
+
+    def __record_compaction(self, clusters: List[MemoryCluster], span: Span):
+        self.compactor.stats.compactions += 1
+        span.set(
+            clusters=len(clusters),
+            memories=sum(len(c.ids) for c in clusters),
+            remaining=len(self.compactor),
+        )
+
+    def __cached_embeddings(
+        self, texts: List[str]
+    ) -> Tuple[List[Optional[List[float]]], List[str]]:
+        vectors = [self.embedding_cache.get(EMBEDDING_MODEL, text) for text in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        return vectors, missing
+
+    def __merge_embeddings(
+        self,
+        texts: List[str],
+        vectors: List[Optional[List[float]]],
+        missing: List[str],
+        response: Any,
+    ) -> List[Optional[List[float]]]:
+        embedded: Dict[str, List[float]] = {}
+        for item in response["data"]:
+            embedded[missing[item["index"]]] = item["embedding"]
+            self.embedding_cache.put(
+                EMBEDDING_MODEL, missing[item["index"]], item["embedding"]
+            )
+        return [v if v is not None else embedded[t] for t, v in zip(texts, vectors)]
+
+    def __buffer(self, params: VectorStoreAdd):
         metadata = {"task": params.task.task_name, "result": params.result}
         metadata.update(params.metadata)
+        self.lexical.add(
+            params.result_id, params.task.task_name + " " + params.result, metadata
+        )
 
-        self.index.upsert(
-            [(params.result_id, vector, metadata)],
-            namespace=self.namespace,
+        # Later adds with the same id replace earlier ones, as an upsert would
+        self.pending.pop(params.result_id, None)
+        self.pending[params.result_id] = PendingVectorStoreAdd(
+            result_id=params.result_id,
+            text=params.result,
+            metadata=metadata,
+            added_at=time.monotonic(),
         )
 
-    def query(self, params: VectorStoreQuery) -> List[VectorStoreQueryResult]:
-        query_vector = self.embed(params.query)
-        query_result = self.index.query(
-            vector=query_vector,
-            top_k=params.top_results_num,
-            include_metadata=True,
-            namespace=self.namespace,
-            filter=params.filter,
+    def __should_flush(self) -> bool:
+        if len(self.pending) >= self.max_pending:
+            return True
+        oldest = next(iter(self.pending.values()), None)
+        return (
+            oldest is not None
+            and time.monotonic() - oldest.added_at >= self.max_pending_age
+        )
+
+    def __upsert_batch(
+        self, pending: List[PendingVectorStoreAdd]
+    ) -> List[VectorRecord]:
+        return [(p.result_id, p.vector, p.metadata) for p in pending if p.vector]
+
+    def __discard_flushed(self, pending: List[PendingVectorStoreAdd]):
+        # Entries replaced while the upsert was in flight stay pending
+        flushed = [p.result_id for p in pending if self.pending.get(p.result_id) is p]
+        for result_id in flushed:
+            del self.pending[result_id]
+        if self.on_flushed is not None:
+            self.on_flushed(flushed)
+
+    def __embed_pending(
+        self, pending: List[PendingVectorStoreAdd], extra: Optional[List[str]] = None
+    ) -> List[List[float]]:
+        # Embeds pending adds together with any extra texts in a single request
+        unembedded = [p for p in pending if p.vector is None]
+        vectors = self.embed_many([p.text for p in unembedded] + (extra or []))
+        return self.__assign_pending_vectors(unembedded, vectors)
+
+    async def __aembed_pending(
+        self, pending: List[PendingVectorStoreAdd], extra: Optional[List[str]] = None
+    ) -> List[List[float]]:
+        unembedded = [p for p in pending if p.vector is None]
+        vectors = await self.aembed_many([p.text for p in unembedded] + (extra or []))
+        return self.__assign_pending_vectors(unembedded, vectors)
+
+    def __assign_pending_vectors(
+        self, unembedded: List[PendingVectorStoreAdd], vectors: List[List[float]]
+    ) -> List[List[float]]:
+        for p, vector in zip(unembedded, vectors):
+            p.vector = vector
+        return vectors[len(unembedded) :]
+
+    def __query_results(
+        self,
+        query_result: Dict[str, Any],
+        query_vector: List[float],
+        params: VectorStoreQuery,
+        span: Span,
+    ) -> List[VectorStoreQueryResult]:
+        span.set(
+            matches=len(query_result["matches"]),
+            bytes=records_bytes(
+                [
+                    (m["id"], m.get("values", []), m.get("metadata", {}))
+                    for m in query_result["matches"]
+                ]
+            ),
         )
         results = [
             VectorStoreQueryResult(
                 id=item["id"],
                 score=item["score"],
-                metadata=item["metadata"],
-                values=item["values"],
+                metadata=ExpectedAgentMetadata(**item["metadata"]),
+                values=(
+                    np.asarray(item["values"], dtype=np.float32)
+                    if params.include_values and item.get("values")
+                    else None
+                ),
             )
             for item in query_result["matches"]
+            if item["id"] not in self.pending
         ]
+        # Serve read-after-write for adds that have not been flushed yet
+        pending = [
+            p
+            for p in self.pending.values()
+            if p.vector is not None and matches_filter(p.metadata, params.filter)
+        ]
+        if pending:
+            vectors = np.asarray([p.vector for p in pending], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1.0
+            query = unit_normalize(np.asarray(query_vector, dtype=np.float32))
+            scores = (vectors @ query) / norms
+            results.extend(
+                VectorStoreQueryResult(
+                    id=p.result_id,
+                    score=float(score),
+                    metadata=ExpectedAgentMetadata(**p.metadata),
+                    values=vector if params.include_values else None,
+                )
+                for p, score, vector in zip(pending, scores, vectors)
+            )
         sorted_results = sorted(results, key=lambda x: x.score, reverse=True)
-        return sorted_results
+        if params.min_score is not None:
+            sorted_results = [r for r in sorted_results if r.score >= params.min_score]
+        return sorted_results[: params.top_results_num]
+
+
+def create_vector_index(backend: VectorIndexBackendEnum, name: str) -> VectorIndex:
+    config = get_config()
+    match backend:
+        case VectorIndexBackendEnum.pinecone:
+            return PineconeIndex(
+                name,
+                api_key=config.PINECONE_API_KEY,
+                environment=config.PINECONE_ENVIRONMENT,
+                provisioning_cache_path=config.PINECONE_INDEX_CACHE_PATH,
+            )
+        case VectorIndexBackendEnum.local:
+            return LocalIndex(os.path.join(config.LOCAL_VECTOR_STORE_PATH, name))
+
+
+def lazy_vector_index(
+    backend: Optional[VectorIndexBackendEnum], name: str
+) -> LazyIndex:
+    # Defaults to the VECTOR_STORE_BACKEND environment variable
+    resolved = backend or VectorIndexBackendEnum(get_config().VECTOR_STORE_BACKEND)
+    return LazyIndex(lambda: create_vector_index(resolved, name))
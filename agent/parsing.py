@@ -0,0 +1,88 @@
+import re
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+
+def clean_task_name(task_name: str) -> str:
+    return re.sub(r"[^\w\s_]+", "", task_name).strip()
+
+
+def task_name_key(task_name: str) -> str:
+    # Case and spacing do not tell tasks apart
+    return " ".join(clean_task_name(task_name).lower().split())
+
+
+def parse_task_line(line: str) -> Optional[str]:
+    task_parts = line.strip().split(".", 1)
+    if len(task_parts) == 2:
+        task_id = "".join(s for s in task_parts[0] if s.isnumeric())
+        task_name = clean_task_name(task_parts[1])
+        if task_name.strip() and task_id.isnumeric():
+            return task_name
+    return None
+
+
+# Parses a numbered task list as it streams in, returning each task as soon
+# as its line is complete
+class TaskLineParser:
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, delta: str) -> List[str]:
+        self.buffer += delta
+        *lines, self.buffer = self.buffer.split("\n")
+        return self.__parse(lines)
+
+    def close(self) -> List[str]:
+        lines, self.buffer = [self.buffer], ""
+        return self.__parse(lines)
+
+    def __parse(self, lines: List[str]) -> List[str]:
+        return [t for t in (parse_task_line(line) for line in lines) if t]
+
+
+class PlannedTask(BaseModel):
+    name: str = Field(min_length=1)
+    # 1 is the most urgent
+    priority: Optional[int] = Field(default=None, ge=1)
+    # Names of tasks that have to finish first
+    depends_on: List[str] = []
+
+
+# Task list requested as JSON (structured output mode) from task creation
+# and prioritization
+class TaskPlan(BaseModel):
+    tasks: List[PlannedTask] = []
+
+    def ordered_names(self) -> List[str]:
+        # By priority, ties and unprioritized tasks in the order listed
+        ranked = sorted(
+            enumerate(self.tasks),
+            key=lambda e: (e[1].priority is None, e[1].priority or 0, e[0]),
+        )
+        names = (clean_task_name(task.name) for _, task in ranked)
+        return list(dict.fromkeys(name for name in names if name))
+
+    def dependencies(self) -> Dict[str, List[str]]:
+        # Cleaned task names to the cleaned names they depend on
+        return {
+            clean_task_name(task.name): [
+                name for name in map(clean_task_name, task.depends_on) if name
+            ]
+            for task in self.tasks
+            if task.depends_on
+        }
+
+
+class StructuredOutputStats(BaseModel):
+    parsed: int = 0
+    # Invalid responses fixed by the repair retry
+    repaired: int = 0
+    # Invalid even after the repair retry
+    failed: int = 0
+
+
+def parse_task_plan(response: str) -> TaskPlan:
+    # Raises a ValidationError for malformed JSON as well as for a wrong shape
+    return TaskPlan.model_validate_json(response)
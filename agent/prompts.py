@@ -1,7 +1,13 @@
-from typing import List
+import re
+from typing import List, Optional
 
 from agent.models import ExpectedAgentMetadata
 
+# What task creation answers when there is nothing left to do
+NO_NEW_TASKS = "There are no tasks to add at this time"
+
+TASK_PLAN_FORMAT = """{"tasks": [{"name": "...", "priority": 1, "depends_on": []}]}"""
+
 
 def stringify_context(metadata: ExpectedAgentMetadata) -> str:
     match metadata.thought_type:
@@ -11,6 +17,9 @@ def stringify_context(metadata: ExpectedAgentMetadata) -> str:
         case "EXECUTE_THOUGHT":
             return f"""Based on the task "{metadata.task}", 
             you executed the response "{metadata.result}" """
+        case "SUMMARY":
+            return f"""Summarizing {metadata.task}, 
+            you noted "{metadata.result}" """
         case _:
             return f"""Based on the task "{metadata.task}", 
             you had the thought "{metadata.result}" """
@@ -26,15 +35,17 @@ def initial_task(objective: str) -> str:
     #. First task
     #. Second task
     The number of each entry must be followed by a period. 
-    If your list is empty, write "There are no tasks to add at this time."
+    If your list is empty, write "{NO_NEW_TASKS}."
     Unless your list is empty, do not include any headers before your 
     numbered list or follow your numbered list with any other output.
     """
 
 
-def internal_thought(
-    objective: str, task: str, context: List[ExpectedAgentMetadata]
-) -> str:
+def render_memories(context: List[str]) -> str:
+    return "\n    ".join(f"- {' '.join(c.split())}" for c in context)
+
+
+def internal_thought(objective: str, task: str, context: List[str]) -> str:
     description = f"""
     You have been given the following objective: {objective}. 
     Related to that objective, you have been given the following task: 
@@ -46,7 +57,7 @@ def internal_thought(
         f"""
     For some context, here are your memories related to the query.
     MEMORIES sorted in relevance:
-    {[stringify_context(c) for c in context]}
+    {render_memories(context)}
     """
         if len(context) > 0
         else ""
@@ -66,7 +77,7 @@ def execute_thought(
     objective: str,
     task: str,
     internal_thought: str,
-    context: List[ExpectedAgentMetadata],
+    context: List[str],
 ) -> str:
     description = f"""
     Perform one task based on the following objective: {objective}
@@ -79,7 +90,7 @@ def execute_thought(
         f"""
     For some context, here are your memories related to the query.
     MEMORIES sorted in relevance:
-    {[stringify_context(c) for c in context]}
+    {render_memories(context)}
     """
         if len(context) > 0
         else ""
@@ -97,7 +108,9 @@ def task_creation(
     previous_execute_thought: str,
     previous_task: str,
     task_list: List[str],
-):
+    structured: bool = False,
+) -> str:
+    newline_char = "\n"
     description = f"""
     You are to use the result from an execution agent to create new 
     tasks with the following objective: {objective}.
@@ -108,30 +121,40 @@ def task_creation(
 
     thoughts = (
         f"""For some context, here are your current incomplete tasks:
-        {"/n".join(task_list)}"""
+        {newline_char.join(task_list)}"""
         if len(task_list) > 0
         else ""
     )
 
-    call_to_action = """Return one task per line in your response. 
+    call_to_action = f"""Return one task per line in your response. 
     The result must be a numbered list in the format:
     
     #. First task
     #. Second task
     
     The number of each entry must be followed by a period. 
-    If your list is empty, write "There are no tasks to add at this time."
+    If your list is empty, write "{NO_NEW_TASKS}."
     Unless your list is empty, do not include any headers 
     before your numbered list or follow your numbered list with any other output.
     """
 
+    if structured:
+        call_to_action = f"""Respond with a JSON object of the form
+    {TASK_PLAN_FORMAT}
+    where priority 1 is the most urgent and depends_on names the tasks that 
+    must be finished first. Use an empty tasks list if there is nothing to add.
+    """
+
     return description + thoughts + call_to_action
 
 
-def task_prioritization(objective: str, task_list: List[str]):
+def task_prioritization(
+    objective: str, task_list: List[str], structured: bool = False
+) -> str:
+    newline_char = "\n"
     description = f"""
     You are tasked with prioritizing the following tasks: 
-    {"/n".join(task_list)} 
+    {newline_char.join(task_list)} 
     Consider the ultimate objective of your team: {objective}.
     """
 
@@ -151,4 +174,218 @@ def task_prioritization(objective: str, task_list: List[str]):
     your list with any other output.
     """
 
+    if structured:
+        call_to_action = f"""
+    Rank the tasks from highest to lowest priority, where prerequisites and 
+    tasks essential to the objective come first. Do not remove any tasks. 
+    Respond with a JSON object of the form
+    {TASK_PLAN_FORMAT}
+    listing every task, with priority 1 for the most important one.
+    """
+
     return description + call_to_action
+
+
+def memory_summary(objective: str, memories: List[str]) -> str:
+    return f"""
+    You are working towards the following objective: {objective}
+    Condense these older memories into one memory:
+    {render_memories(memories)}
+    Write a few sentences that keep the facts, decisions and results that 
+    matter for the objective and drop anything repeated. Return only the 
+    condensed memory.
+    """
+
+
+# The prompts above for one objective, as sent by default
+class PromptTemplates:
+    def __init__(self, objective: str, structured: bool = False):
+        self.objective = objective
+        self.structured = structured
+        # Sent as the first message of every call, if any
+        self.system: Optional[str] = None
+
+    def internal_thought(self, task: str, context: List[str]) -> str:
+        return internal_thought(self.objective, task, context)
+
+    def execute_thought(
+        self, task: str, internal_thought: str, context: List[str]
+    ) -> str:
+        return execute_thought(self.objective, task, internal_thought, context)
+
+    def task_creation(
+        self, previous_execute_thought: str, previous_task: str, task_list: List[str]
+    ) -> str:
+        return task_creation(
+            self.objective,
+            previous_execute_thought,
+            previous_task,
+            task_list,
+            structured=self.structured,
+        )
+
+    def task_prioritization(self, task_list: List[str]) -> str:
+        return task_prioritization(
+            self.objective, task_list, structured=self.structured
+        )
+
+    def memory_summary(self, memories: List[str]) -> str:
+        return memory_summary(self.objective, memories)
+
+
+# Same prompts, compiled once per objective. The objective moves into a system
+# message shared by every call, each phase's static instructions come next
+# and the per call details last, so consecutive calls share the longest
+# possible prefix for provider-side prompt caching. The static text is
+# compacted when compiled: no indentation, and wrapped lines are joined.
+class CompiledPromptTemplates(PromptTemplates):
+    def __init__(self, objective: str, structured: bool = False):
+        super().__init__(objective, structured)
+        self.system = compact(
+            f"""
+            You are an autonomous agent working towards the following 
+            objective: {objective}
+            """
+        )
+        self.internal_thought_instructions = compact(
+            """
+            Think about the task below and plan the actions you would take, 
+            based on your past thoughts and actions. This is your internal 
+            thought, it is not shown to the outside world.
+            """
+        )
+        self.execute_thought_instructions = compact(
+            """
+            Perform the task below, using the thought you had about it. 
+            Return your response to the task.
+            """
+        )
+        list_format = """
+            #. First task
+            #. Second task
+            The number of each entry must be followed by a period. 
+            """
+        json_format = f"""
+            {TASK_PLAN_FORMAT}
+            Priority 1 is the most urgent, depends_on names the tasks that 
+            must be finished first.
+            """
+        self.task_creation_instructions = compact(
+            """
+            Use the result of the last completed task to create new tasks 
+            for the objective that are not among the incomplete tasks.
+            """
+            + (
+                """
+            Respond with a JSON object of the form
+            """
+                + json_format
+                + """
+            Use an empty tasks list if there is nothing to add.
+            """
+                if structured
+                else """
+            Return one task per line as a numbered list in the format:
+            """
+                + list_format
+                + f"""
+            If your list is empty, write "{NO_NEW_TASKS}." Otherwise, do 
+            not add any headers or any other output.
+            """
+            )
+        )
+        self.task_prioritization_instructions = compact(
+            """
+            You are tasked with prioritizing the tasks below, highest priority 
+            first: tasks that are prerequisites of others or essential to the 
+            objective. Do not remove any tasks.
+            """
+            + (
+                """
+            Respond with a JSON object listing every task, of the form
+            """
+                + json_format
+                if structured
+                else """
+            Return the ranked tasks as a numbered list, consecutively 
+            numbered starting with 1, in the format:
+            """
+                + list_format
+                + """
+            Do not add any headers or any other output.
+            """
+            )
+        )
+        self.memory_summary_instructions = compact(
+            """
+            Condense these older memories into one memory: a few sentences 
+            that keep the facts, decisions and results that matter for the 
+            objective and drop anything repeated. Return only the condensed 
+            memory.
+            """
+        )
+
+    def internal_thought(self, task: str, context: List[str]) -> str:
+        return "\n".join(
+            [self.internal_thought_instructions, f"Task: {task}"]
+            + self.__memories(context)
+        )
+
+    def execute_thought(
+        self, task: str, internal_thought: str, context: List[str]
+    ) -> str:
+        return "\n".join(
+            [
+                self.execute_thought_instructions,
+                f"Task: {task}",
+                f"Your thought: {internal_thought}",
+            ]
+            + self.__memories(context)
+        )
+
+    def task_creation(
+        self, previous_execute_thought: str, previous_task: str, task_list: List[str]
+    ) -> str:
+        lines = [
+            self.task_creation_instructions,
+            f"Last completed task: {previous_task}",
+            f"Its result: {previous_execute_thought}",
+        ]
+        if task_list:
+            lines += ["Incomplete tasks:"] + task_list
+        return "\n".join(lines)
+
+    def task_prioritization(self, task_list: List[str]) -> str:
+        return "\n".join(
+            [self.task_prioritization_instructions, "Tasks to rank:"] + task_list
+        )
+
+    def memory_summary(self, memories: List[str]) -> str:
+        return "\n".join(
+            [self.memory_summary_instructions, "Memories:"]
+            + [f"- {' '.join(m.split())}" for m in memories]
+        )
+
+    def __memories(self, context: List[str]) -> List[str]:
+        if not context:
+            return []
+        return ["Memories, most relevant first:"] + [
+            f"- {' '.join(c.split())}" for c in context
+        ]
+
+
+def compact(text: str) -> str:
+    # Joins wrapped lines and drops indentation and trailing spaces; list
+    # entries and JSON examples keep their own line
+    lines: List[str] = []
+    joinable = False
+    for line in (" ".join(line.split()) for line in text.splitlines()):
+        if not line:
+            continue
+        own_line = re.match(r"(#|\d+)\. |- |\{", line) is not None
+        if joinable and not own_line:
+            lines[-1] += " " + line
+        else:
+            lines.append(line)
+        joinable = not own_line
+    return "\n".join(lines)
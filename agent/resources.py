@@ -0,0 +1,43 @@
+from typing import Optional
+
+from agent.cache import EmbeddingCache
+from agent.indexes import LazyIndex, VectorIndexBackendEnum
+from agent.models import lazy_vector_index
+from agent.scheduler import FairGate
+from config import get_config
+
+RESULTS_STORE_NAME = "semantic-search-prototype"
+
+
+# What agents hosted in one process share instead of each building their
+# own: the embedding cache, the vector index (each agent still keeps its
+# memories in its own namespace) and optionally a gate that hands out task
+# slots fairly across agents
+class AgentResources:
+    def __init__(
+        self,
+        embedding_cache: EmbeddingCache,
+        index: LazyIndex,
+        gate: Optional[FairGate] = None,
+    ):
+        self.embedding_cache = embedding_cache
+        self.index = index
+        self.gate = gate
+
+    @classmethod
+    def create(
+        cls,
+        slots: Optional[int] = None,
+        backend: Optional[VectorIndexBackendEnum] = None,
+        results_store_name: str = RESULTS_STORE_NAME,
+    ) -> "AgentResources":
+        index = lazy_vector_index(backend, results_store_name)
+        index.warm_up()
+        return cls(
+            EmbeddingCache(path=get_config().EMBEDDING_CACHE_PATH),
+            index,
+            FairGate(slots) if slots else None,
+        )
+
+    def close(self):
+        self.embedding_cache.close()
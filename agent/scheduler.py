@@ -0,0 +1,135 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Deque, Hashable, Optional
+
+from agent.models import Task
+from tracing import tracer
+
+if TYPE_CHECKING:
+    from agent.agent import Agent
+
+
+# Deals out a fixed number of task slots across tenants round robin: when a
+# slot frees up it goes to the tenant that has waited longest since its last
+# turn, not to whichever tenant queued the most work
+class FairGate:
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.in_use = 0
+        self.waiting: OrderedDict[Hashable, Deque[asyncio.Future[None]]] = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, tenant: Hashable) -> AsyncIterator[None]:
+        await self.__acquire(tenant)
+        try:
+            yield
+        finally:
+            self.__release()
+
+    async def __acquire(self, tenant: Hashable):
+        if self.in_use < self.slots and not self.waiting:
+            self.in_use += 1
+            return
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(tenant, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Hand back a slot that was granted just as the waiter went away
+            if future.done() and not future.cancelled():
+                self.__release()
+            raise
+
+    def __release(self):
+        self.in_use -= 1
+        while self.in_use < self.slots and self.waiting:
+            tenant, waiters = self.waiting.popitem(last=False)
+            future = waiters.popleft()
+            # The tenant goes to the back of the line for its next waiter
+            if waiters:
+                self.waiting[tenant] = waiters
+            if not future.done():
+                self.in_use += 1
+                future.set_result(None)
+
+
+# Drains the agent's task storage with a pool of asyncio workers. Each worker
+# runs one ready task through execute and task creation, releasing the tasks
+# that depend on it as soon as it has executed; an LLM reranking of the
+# queue runs in between, at most one at a time, whenever the agent says one
+# is due. Storage mutations are synchronous, so they never interleave inside
+# the single event loop.
+class TaskScheduler:
+    def __init__(self, agent: "Agent", workers: int, gate: Optional[FairGate] = None):
+        self.agent = agent
+        self.workers = max(1, workers)
+        self.gate = gate
+        self.in_flight = 0
+        self.prioritizing = False
+        self.changed = asyncio.Condition()
+
+    async def run(self):
+        workers = [asyncio.create_task(self.__worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def __worker(self):
+        while True:
+            task = await self.__claim()
+            if task is None:
+                return
+            try:
+                if self.gate is None:
+                    await self.__run_task(task)
+                else:
+                    async with self.gate.slot(self.agent):
+                        await self.__run_task(task)
+                await self.__maybe_prioritize()
+            finally:
+                self.in_flight -= 1
+                await self.__notify()
+
+    async def __run_task(self, task: Task):
+        with tracer.span("agent.task", task_id=task.task_id):
+            execute_thought = await self.agent.aexecute_task(task)
+            self.agent.release_dependents(task, execute_thought)
+            await self.__notify()
+            # The head of the queue usually runs next, think ahead while
+            # task creation waits on the LLM
+            self.agent.speculate_next()
+            await self.agent.acreate_tasks(
+                task, execute_thought, on_tasks_added=self.__notify
+            )
+            self.agent.complete_task(task)
+            await self.__notify()
+            await self.agent.acompact_memories()
+
+    async def __claim(self) -> Optional[Task]:
+        async with self.changed:
+            # Every ready task is claimed at once, up to the number of workers
+            while self.agent.tasks_storage.peek() is None:
+                if self.in_flight == 0:
+                    return None
+                await self.changed.wait()
+            if self.agent.iterations_exhausted():
+                return None
+            self.in_flight += 1
+            return self.agent.next_task()
+
+    async def __notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def __maybe_prioritize(self):
+        if self.prioritizing or not self.agent.prioritization_due():
+            return
+        self.prioritizing = True
+        try:
+            self.agent.speculate_next()
+            await self.agent.aprioritize_tasks()
+        finally:
+            self.prioritizing = False
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Any, Coroutine, Optional
+
+from pydantic import BaseModel
+
+from agent.models import Task
+
+
+class SpeculationStats(BaseModel):
+    started: int = 0
+    # Speculated thoughts used because their task was picked next
+    hits: int = 0
+    # Speculated thoughts thrown away because another task was picked
+    misses: int = 0
+    # Tokens spent on thrown away thoughts
+    wasted_prompt_tokens: int = 0
+    wasted_completion_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        settled = self.hits + self.misses
+        return self.hits / settled if settled else 0.0
+
+
+# An internal thought computed ahead of time for the task at the head of the
+# queue, while the previous task is still creating tasks or the queue is
+# being reranked. It is only remembered once that task actually runs next.
+class Speculation:
+    def __init__(self, task: Task):
+        self.task = task
+        self.prompt_tokens = 0
+        self.thought: Optional[asyncio.Task[str]] = None
+
+    def start(self, thought: Coroutine[Any, Any, str]):
+        self.thought = asyncio.create_task(thought)
+        # A thought that is thrown away is never awaited, so retrieve its
+        # exception here or asyncio logs it as never retrieved
+        self.thought.add_done_callback(retrieve_exception)
+
+    def completed_thought(self) -> Optional[str]:
+        if (
+            self.thought is None
+            or not self.thought.done()
+            or self.thought.cancelled()
+            or self.thought.exception() is not None
+        ):
+            return None
+        return self.thought.result()
+
+
+def retrieve_exception(task: "asyncio.Task[Any]"):
+    if not task.cancelled():
+        task.exception()
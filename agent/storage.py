@@ -0,0 +1,200 @@
+import heapq
+import itertools
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from agent.dedup import DEFAULT_DUPLICATE_THRESHOLD, TaskDedupIndex
+from agent.graph import TaskGraph
+from agent.indexes import unit_normalize
+from agent.models import Task
+
+DEFAULT_AGE_WEIGHT = 0.01
+
+
+# Task queue ordered by a locally computed priority instead of an LLM ranking
+# after every task. A task's priority is its embedding similarity to the
+# objective plus a bonus for how long it has been waiting. Every task ages at
+# the same rate, so the bonus is folded into a key fixed at insertion time
+# (similarity - age_weight * insertion number) and the heap stays valid.
+# Task ids are stable: LLM rankings reorder tasks without recreating them,
+# and new tasks equivalent to earlier ones are merged or dropped. Tasks
+# waiting on dependencies stay queued but out of the heap until the tasks
+# they depend on have executed.
+class PriorityTaskStorage:
+    def __init__(
+        self,
+        age_weight: float = DEFAULT_AGE_WEIGHT,
+        duplicate_threshold: Optional[float] = DEFAULT_DUPLICATE_THRESHOLD,
+    ):
+        self.age_weight = age_weight
+        self.dedup = TaskDedupIndex(duplicate_threshold)
+        self.graph = TaskGraph()
+        self.task_id_counter = 0
+        self.objective_vector: Optional[npt.NDArray[np.float32]] = None
+        self.heap: List[Tuple[float, int, str]] = []
+        self.entries: Dict[str, Tuple[float, int, Task]] = {}
+        self.sequence = itertools.count()
+        self.insertions = 0
+        # Queue churn since the last LLM ranking
+        self.added_since_ranking = 0
+        self.popped_since_ranking = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def tasks(self) -> Deque[Task]:
+        ranked = sorted(self.entries.values(), key=lambda e: (-e[0], e[1]))
+        return deque(task for _, _, task in ranked)
+
+    def set_objective(self, vector: List[float]):
+        self.objective_vector = unit_vector(vector)
+
+    def append(
+        self,
+        task: Task,
+        vector: Optional[List[float]] = None,
+        created_by: Optional[str] = None,
+    ) -> bool:
+        # Returns False for tasks equivalent to one queued or executed before.
+        # A duplicate of a queued task is merged into it: the queued task
+        # keeps its id and takes the higher of the two priorities.
+        unit = unit_vector(vector) if vector is not None else None
+        similarity = 0.0
+        if unit is not None and self.objective_vector is not None:
+            similarity = float(unit @ self.objective_vector)
+        key = similarity - self.age_weight * (self.insertions + 1)
+        duplicate = self.dedup.find(task.task_name, unit)
+        if duplicate is not None:
+            entry = self.entries.get(duplicate)
+            if entry is None:
+                self.dedup.stats.dropped += 1
+            else:
+                self.dedup.stats.merged += 1
+                if key > entry[0]:
+                    self.__push(entry[2], key)
+            return False
+        self.dedup.stats.misses += 1
+        self.dedup.add(task.task_id, task.task_name, unit)
+        self.graph.add([task], created_by)
+        self.insertions += 1
+        self.__push(task, key)
+        self.added_since_ranking += 1
+        return True
+
+    def replace(
+        self,
+        tasks: List[Task],
+        priorities: Optional[Dict[str, float]] = None,
+        insertions: int = 0,
+    ):
+        # The queue becomes exactly these tasks. Restored tasks keep the keys
+        # they were checkpointed with, and insertions carries on from where it
+        # was, so they still compare with tasks added after a resume. Tasks
+        # without a key slot in right after their predecessor.
+        self.entries = {}
+        self.heap = []
+        self.insertions = max(self.insertions, insertions)
+        for task in tasks:
+            if self.dedup.find(task.task_name, None) is None:
+                self.dedup.add(task.task_id, task.task_name, None)
+        self.graph.add(tasks)
+        previous = -self.age_weight * self.insertions
+        for task in tasks:
+            key = (priorities or {}).get(task.task_id)
+            if key is None:
+                key = previous - self.age_weight / 2
+            self.__push(task, key)
+            previous = key
+        self.added_since_ranking = 0
+        self.popped_since_ranking = 0
+
+    def priorities(self, tasks: List[Task]) -> Dict[str, float]:
+        # Current keys of the queued tasks among these, to checkpoint them
+        return {
+            t.task_id: self.entries[t.task_id][0]
+            for t in tasks
+            if t.task_id in self.entries
+        }
+
+    def reorder(self, ranked: List[Task]):
+        # Applies an LLM ranking by handing the ranked tasks' current keys
+        # back out in ranked order, so they keep their place relative to the
+        # rest of the queue and to tasks added later. Ranked tasks that are
+        # not queued yet slot in right after their predecessor.
+        keys = sorted(
+            (self.entries[t.task_id][0] for t in ranked if t.task_id in self.entries),
+            reverse=True,
+        )
+        previous = keys[0] if keys else 0.0
+        for task in ranked:
+            if task.task_id in self.entries:
+                key = keys.pop(0)
+            else:
+                key = previous - self.age_weight / 2
+            self.__push(task, key)
+            previous = key
+        self.added_since_ranking = 0
+        self.popped_since_ranking = 0
+
+    def popleft(self) -> Task:
+        while self.heap:
+            _, sequence, task_id = heapq.heappop(self.heap)
+            entry = self.entries.get(task_id)
+            # Skip entries superseded by a later push of the same task
+            if entry is not None and entry[1] == sequence:
+                del self.entries[task_id]
+                self.popped_since_ranking += 1
+                self.graph.start(task_id)
+                return entry[2]
+        raise IndexError("pop from an empty task queue")
+
+    def finish(self, task: Task, result: str):
+        # Releases the dependents of an executed task
+        for task_id in self.graph.finish(task.task_id, result):
+            entry = self.entries.get(task_id)
+            if entry is not None:
+                heapq.heappush(self.heap, (-entry[0], entry[1], task_id))
+
+    def peek(self) -> Optional[Task]:
+        # The task popleft would return, without removing it, or None when no
+        # queued task is ready
+        while self.heap:
+            _, sequence, task_id = self.heap[0]
+            entry = self.entries.get(task_id)
+            if entry is not None and entry[1] == sequence:
+                return entry[2]
+            heapq.heappop(self.heap)
+        return None
+
+    def is_empty(self):
+        return not self.entries
+
+    def next_task_id(self):
+        self.task_id_counter += 1
+        return self.task_id_counter
+
+    def get_task_names(self):
+        return [t.task_name for t in self.tasks]
+
+    def __push(self, task: Task, key: float):
+        sequence = next(self.sequence)
+        self.entries[task.task_id] = (key, sequence, task)
+        if self.graph.is_ready(task.task_id):
+            heapq.heappush(self.heap, (-key, sequence, task.task_id))
+        # Rankings leave superseded entries behind, drop them once they
+        # outnumber the live ones
+        if len(self.heap) > 2 * len(self.entries) + 32:
+            self.heap = [
+                (-k, seq, t.task_id)
+                for k, seq, t in self.entries.values()
+                if self.graph.is_ready(t.task_id)
+            ]
+            heapq.heapify(self.heap)
+
+
+def unit_vector(vector: List[float]) -> npt.NDArray[np.float32]:
+    return unit_normalize(np.asarray(vector, dtype=np.float32))
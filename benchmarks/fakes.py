@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import openai
+import openai.error
+import pinecone
+from pydantic import BaseModel
+
+from agent.indexes import LocalIndex
+from completions.models import (
+    ChatCompletionResponse,
+    ChatCompletionResponseChoice,
+    ChatCompletionResponseChoiceMessage,
+)
+
+DIMENSION = 1536
+
+# Markers in the agent prompts used to pick the recorded responses to replay
+PHASE_MARKERS = {
+    "memory_summary": "Condense these older memories",
+    "task_prioritization": "tasked with prioritizing",
+    "task_creation": "create new",
+    "execute_thought": "Return your response to the task",
+    "internal_thought": "internal thought",
+}
+
+INJECTED_ERRORS = [
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+]
+
+
+class Fixtures(BaseModel):
+    # Recorded chat completions per agent phase, replayed in order
+    chat: Dict[str, List[ChatCompletionResponse]] = {}
+    # Recorded embeddings keyed by input text
+    embeddings: Dict[str, List[float]] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "Fixtures":
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.model_dump(mode="json"), f, indent=2)
+
+
+class FakeSettings(BaseModel):
+    # Seconds added to every call of each service
+    chat_latency: float = 0.0
+    embedding_latency: float = 0.0
+    index_latency: float = 0.0
+    # Seconds added to each pinecone init, list and create call
+    provision_latency: float = 0.0
+    # Fraction of chat completions failing with a retryable OpenAI error
+    error_rate: float = 0.0
+    # Fraction of JSON mode completions cut short into invalid JSON
+    malformed_json_rate: float = 0.0
+    # Fraction of tasks in JSON task plans depending on the task before them
+    dependency_rate: float = 0.0
+    # Characters per streamed chunk
+    chunk_size: int = 16
+    seed: int = 0
+
+
+class CallCounts(BaseModel):
+    chat: int = 0
+    chat_errors: int = 0
+    embedding_requests: int = 0
+    embedding_inputs: int = 0
+    index_upserts: int = 0
+    index_queries: int = 0
+    index_deletes: int = 0
+
+
+def fallback_embedding(text: str) -> List[float]:
+    # Deterministic pseudo-embedding for texts missing from the fixtures;
+    # texts sharing their first words end up close to each other
+    def seeded(value: str) -> np.ndarray[Any, np.dtype[np.float64]]:
+        seed = int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(DIMENSION)
+
+    prefix = " ".join(text.split()[:3])
+    values: List[float] = (seeded(prefix) + 0.5 * seeded(text)).tolist()
+    return values
+
+
+# Local stand-in for the OpenAI chat and embedding endpoints, replaying the
+# fixtures with injected latency and errors
+class FakeOpenAI:
+    def __init__(self, fixtures: Fixtures, settings: FakeSettings, calls: CallCounts):
+        self.fixtures = fixtures
+        self.settings = settings
+        self.calls = calls
+        self.random = random.Random(settings.seed)
+        self.replayed: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def chat_create(self, **kwargs: Any) -> Any:
+        time.sleep(self.settings.chat_latency)
+        response = self.__chat_response(kwargs)
+        if kwargs.get("stream"):
+            return iter(self.__chunks(response))
+        return response.model_dump()
+
+    async def chat_acreate(self, **kwargs: Any) -> Any:
+        await asyncio.sleep(self.settings.chat_latency)
+        response = self.__chat_response(kwargs)
+        if kwargs.get("stream"):
+            return self.__achunks(self.__chunks(response))
+        return response.model_dump()
+
+    def embedding_create(self, input: List[str], **kwargs: Any) -> Dict[str, Any]:
+        time.sleep(self.settings.embedding_latency)
+        return self.__embedding_response(input)
+
+    async def embedding_acreate(
+        self, input: List[str], **kwargs: Any
+    ) -> Dict[str, Any]:
+        await asyncio.sleep(self.settings.embedding_latency)
+        return self.__embedding_response(input)
+
+    def __chat_response(self, kwargs: Dict[str, Any]) -> ChatCompletionResponse:
+        with self.lock:
+            self.calls.chat += 1
+            if self.random.random() < self.settings.error_rate:
+                self.calls.chat_errors += 1
+                error = self.random.choice(INJECTED_ERRORS)
+                raise error("Injected benchmark error", headers={"retry-after": "0"})
+        prompt = "\n".join(m["content"] for m in kwargs["messages"])
+        phase = next(
+            (p for p, marker in PHASE_MARKERS.items() if marker in prompt), "other"
+        )
+        if phase == "task_prioritization":
+            # A recorded ranking would not match the current task list, so
+            # echo the tasks from the prompt back in the same order
+            # Only the prioritization prompt itself, not any repair messages
+            content = self.__echo_task_list(
+                next(
+                    (
+                        m["content"]
+                        for m in kwargs["messages"]
+                        if PHASE_MARKERS[phase] in m["content"]
+                    ),
+                    prompt,
+                )
+            )
+        else:
+            content = self.__replay(phase)
+        if (kwargs.get("response_format") or {}).get("type") == "json_object":
+            content = self.__as_task_plan(content)
+        return ChatCompletionResponse(
+            id=f"fake-{self.calls.chat}",
+            created=int(time.time()),
+            model=kwargs["model"],
+            object="chat.completion",
+            usage={
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (len(prompt) + len(content)) // 4,
+            },
+            choices=[
+                ChatCompletionResponseChoice(
+                    finish_reason="stop",
+                    index=0,
+                    message=ChatCompletionResponseChoiceMessage(
+                        role="assistant", content=content
+                    ),
+                )
+            ],
+        )
+
+    def __replay(self, phase: str) -> str:
+        recorded = self.fixtures.chat.get(phase) or self.fixtures.chat.get("other")
+        if not recorded:
+            return f"Recorded {phase.replace('_', ' ')} response."
+        with self.lock:
+            index = self.replayed.get(phase, 0)
+            self.replayed[phase] = index + 1
+        return recorded[index % len(recorded)].choices[0].message.content or ""
+
+    def __echo_task_list(self, prompt: str) -> str:
+        match = re.search(
+            r"(?:prioritizing the following tasks:|Tasks to rank:)"
+            r"(.*?)(?:Consider the ultimate|$)",
+            prompt,
+            re.DOTALL,
+        )
+        lines = [line.strip() for line in (match.group(1) if match else "").split("\n")]
+        tasks = [line for line in lines if line]
+        return "\n".join(f"{i}. {task}" for i, task in enumerate(tasks, start=1))
+
+    def __as_task_plan(self, content: str) -> str:
+        # Recorded fixtures are numbered lists, JSON mode gets them as a plan
+        names = re.findall(r"^\s*\d+\.\s*(.+?)\s*$", content, re.MULTILINE)
+        with self.lock:
+            dependent = [
+                i > 0 and self.random.random() < self.settings.dependency_rate
+                for i in range(len(names))
+            ]
+            malformed = self.random.random() < self.settings.malformed_json_rate
+        plan = json.dumps(
+            {
+                "tasks": [
+                    {
+                        "name": name,
+                        "priority": i + 1,
+                        "depends_on": [names[i - 1]] if dependent[i] else [],
+                    }
+                    for i, name in enumerate(names)
+                ]
+            }
+        )
+        return plan[: len(plan) // 2] if malformed else plan
+
+    def __chunks(self, response: ChatCompletionResponse) -> List[Dict[str, Any]]:
+        content = response.choices[0].message.content or ""
+        size = max(1, self.settings.chunk_size)
+        return [
+            {
+                "id": response.id,
+                "created": response.created,
+                "model": response.model,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": content[i : i + size]}}],
+            }
+            for i in range(0, len(content), size)
+        ]
+
+    async def __achunks(
+        self, chunks: List[Dict[str, Any]]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        for chunk in chunks:
+            yield chunk
+
+    def __embedding_response(self, input: List[str]) -> Dict[str, Any]:
+        with self.lock:
+            self.calls.embedding_requests += 1
+            self.calls.embedding_inputs += len(input)
+        return {
+            "data": [
+                {
+                    "index": i,
+                    "embedding": self.fixtures.embeddings.get(text)
+                    or fallback_embedding(text),
+                }
+                for i, text in enumerate(input)
+            ]
+        }
+
+
+class FakePineconeIndex:
+    def __init__(self, index: LocalIndex, settings: FakeSettings, calls: CallCounts):
+        self.index = index
+        self.settings = settings
+        self.calls = calls
+
+    def upsert(self, vectors: List[Any], namespace: str = ""):
+        time.sleep(self.settings.index_latency)
+        self.calls.index_upserts += 1
+        self.index.upsert([tuple(v) for v in vectors], namespace=namespace)
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: str = "",
+        filter: Optional[Dict[str, Any]] = None,
+        include_metadata: bool = True,
+        include_values: bool = False,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        time.sleep(self.settings.index_latency)
+        self.calls.index_queries += 1
+        return self.index.query(
+            vector,
+            top_k=top_k,
+            namespace=namespace,
+            filter=filter,
+            include_metadata=include_metadata,
+            include_values=include_values,
+        )
+
+    def delete(self, ids: List[str], namespace: str = ""):
+        time.sleep(self.settings.index_latency)
+        self.calls.index_deletes += 1
+        self.index.delete(ids, namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str = "") -> Dict[str, Any]:
+        time.sleep(self.settings.index_latency)
+        return self.index.fetch(ids, namespace=namespace)
+
+
+# Local stand-in for the pinecone client, backed by the local vector index
+class FakePinecone:
+    def __init__(self, path: str, settings: FakeSettings, calls: CallCounts):
+        self.index = LocalIndex(path, dimension=DIMENSION)
+        self.settings = settings
+        self.calls = calls
+        self.names: List[str] = []
+
+    def init(self, **kwargs: Any):
+        time.sleep(self.settings.provision_latency)
+
+    def list_indexes(self) -> List[str]:
+        time.sleep(self.settings.provision_latency)
+        return self.names
+
+    def create_index(self, name: str, **kwargs: Any):
+        time.sleep(self.settings.provision_latency)
+        self.names.append(name)
+
+    def Index(self, name: str) -> FakePineconeIndex:
+        return FakePineconeIndex(self.index, self.settings, self.calls)
+
+
+# Swaps the openai and pinecone entry points the agent uses for the fakes
+# until the returned restore function is called. Without a fake openai only
+# the vector index is replaced.
+def install(
+    fake_openai: Optional[FakeOpenAI], fake_pinecone: FakePinecone
+) -> Callable[[], None]:
+    patches = [
+        (pinecone, "init", fake_pinecone.init),
+        (pinecone, "list_indexes", fake_pinecone.list_indexes),
+        (pinecone, "create_index", fake_pinecone.create_index),
+        (pinecone, "Index", fake_pinecone.Index),
+    ]
+    if fake_openai is not None:
+        patches += [
+            (openai.ChatCompletion, "create", fake_openai.chat_create),
+            (openai.ChatCompletion, "acreate", fake_openai.chat_acreate),
+            (openai.Embedding, "create", fake_openai.embedding_create),
+            (openai.Embedding, "acreate", fake_openai.embedding_acreate),
+        ]
+    return patch(patches)
+
+
+def patch(patches: List[Tuple[Any, str, Any]]) -> Callable[[], None]:
+    originals = [(target, name, getattr(target, name)) for target, name, _ in patches]
+    for target, name, replacement in patches:
+        setattr(target, name, replacement)
+
+    def restore():
+        for target, name, original in originals:
+            setattr(target, name, original)
+
+    return restore
+
+
+# Wraps the live (non-streaming, sync) openai calls and records their
+# responses as fixtures
+class Recorder:
+    def __init__(self):
+        self.fixtures = Fixtures()
+        self.lock = threading.Lock()
+
+    def install(self) -> Callable[[], None]:
+        chat_create = openai.ChatCompletion.create
+        embedding_create = openai.Embedding.create
+
+        def record_chat(**kwargs: Any) -> Any:
+            response = chat_create(**kwargs)
+            prompt = "\n".join(m["content"] for m in kwargs["messages"])
+            phase = next(
+                (p for p, marker in PHASE_MARKERS.items() if marker in prompt),
+                "other",
+            )
+            with self.lock:
+                self.fixtures.chat.setdefault(phase, []).append(
+                    ChatCompletionResponse(**response)
+                )
+            return response
+
+        def record_embedding(input: List[str], **kwargs: Any) -> Any:
+            response = embedding_create(input=input, **kwargs)
+            with self.lock:
+                for item in response["data"]:
+                    self.fixtures.embeddings[input[item["index"]]] = item["embedding"]
+            return response
+
+        return patch(
+            [
+                (openai.ChatCompletion, "create", record_chat),
+                (openai.Embedding, "create", record_embedding),
+            ]
+        )
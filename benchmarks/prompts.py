@@ -0,0 +1,115 @@
+import argparse
+import os
+from typing import Callable, List, Tuple
+
+from pydantic import BaseModel
+
+from agent.prompts import CompiledPromptTemplates, PromptTemplates
+from completions.tokens import count_tokens
+
+DEFAULT_OBJECTIVE = "Write a short market analysis of home espresso machines"
+TASKS = [
+    "Compare the prices of the five best selling machines",
+    "Summarize what reviewers dislike about entry level machines",
+]
+MEMORIES = [
+    f'Based on the task "Research machine {i}", \n            you executed the '
+    f'response "Machine {i} costs about {100 * i} dollars and is well reviewed." '
+    for i in range(1, 6)
+]
+TASK_LIST = [f"Research the market share of brand {i}" for i in range(1, 9)]
+
+
+class PromptTokens(BaseModel):
+    phase: str
+    tokens: int
+    compiled_tokens: int
+    # Leading tokens two calls of the phase for different tasks have in
+    # common, what provider-side prefix caching can reuse
+    shared_prefix_tokens: int
+    compiled_shared_prefix_tokens: int
+
+
+def render(templates: PromptTemplates, prompt: str) -> str:
+    # The messages as the provider sees them, system message first
+    system = f"system: {templates.system}\n" if templates.system else ""
+    return f"{system}user: {prompt}"
+
+
+def shared_prefix(a: str, b: str) -> str:
+    return os.path.commonprefix([a, b])
+
+
+def phases(
+    templates: PromptTemplates,
+) -> List[Tuple[str, Callable[[str], str]]]:
+    return [
+        (
+            "internal_thought",
+            lambda task: templates.internal_thought(task, MEMORIES),
+        ),
+        (
+            "execute_thought",
+            lambda task: templates.execute_thought(
+                task, "I should list the machines and their prices first.", MEMORIES
+            ),
+        ),
+        (
+            "task_creation",
+            lambda task: templates.task_creation(
+                "Machine 1 costs about 100 dollars.", task, TASK_LIST
+            ),
+        ),
+        (
+            "task_prioritization",
+            lambda task: templates.task_prioritization([task] + TASK_LIST),
+        ),
+        ("memory_summary", lambda task: templates.memory_summary(MEMORIES + [task])),
+    ]
+
+
+def measure(objective: str, structured: bool) -> List[PromptTokens]:
+    default = PromptTemplates(objective, structured)
+    compiled = CompiledPromptTemplates(objective, structured)
+    measured = []
+    for (phase, prompt), (_, compiled_prompt) in zip(phases(default), phases(compiled)):
+        first, second = (render(default, prompt(task)) for task in TASKS)
+        compiled_first, compiled_second = (
+            render(compiled, compiled_prompt(task)) for task in TASKS
+        )
+        measured.append(
+            PromptTokens(
+                phase=phase,
+                tokens=count_tokens(first),
+                compiled_tokens=count_tokens(compiled_first),
+                shared_prefix_tokens=count_tokens(shared_prefix(first, second)),
+                compiled_shared_prefix_tokens=count_tokens(
+                    shared_prefix(compiled_first, compiled_second)
+                ),
+            )
+        )
+    return measured
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the prompt tokens of every phase with and without "
+        "compiled prompts, and how much of each prompt two calls share."
+    )
+    parser.add_argument("--objective", default=DEFAULT_OBJECTIVE)
+    parser.add_argument("--structured-output", action="store_true")
+    args = parser.parse_args()
+    print(
+        f"{'phase':<22}{'tokens':>8}{'compiled':>10}{'saved':>8}"
+        f"{'shared prefix':>15}{'compiled':>10}"
+    )
+    for row in measure(args.objective, args.structured_output):
+        saved = 1 - row.compiled_tokens / row.tokens if row.tokens else 0.0
+        print(
+            f"{row.phase:<22}{row.tokens:>8}{row.compiled_tokens:>10}{saved:>8.0%}"
+            f"{row.shared_prefix_tokens:>15}{row.compiled_shared_prefix_tokens:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# Give the agent dummy keys and keep its caches and vectors in a scratch
+# directory that is thrown away after the run
+WORK_DIR = tempfile.mkdtemp(prefix="agentlebot-benchmark-")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("OPENAI_ORG_KEY", "benchmark")
+os.environ.update(
+    PINECONE_API_KEY="benchmark",
+    PINECONE_ENVIRONMENT="benchmark",
+    VECTOR_STORE_BACKEND="pinecone",
+    EMBEDDING_CACHE_PATH=os.path.join(WORK_DIR, "embeddings.sqlite3"),
+    COMPLETION_CACHE_PATH=os.path.join(WORK_DIR, "completions.sqlite3"),
+    PINECONE_INDEX_CACHE_PATH=os.path.join(WORK_DIR, "pinecone_indexes.json"),
+)
+
+from agent.agent import Agent  # noqa: E402
+from agent.compaction import CompactionStats  # noqa: E402
+from agent.dedup import TaskDedupStats  # noqa: E402
+from agent.graph import CriticalPath  # noqa: E402
+from agent.models import CreateAgentParams  # noqa: E402
+from agent.parsing import StructuredOutputStats  # noqa: E402
+from agent.speculation import SpeculationStats  # noqa: E402
+from completions.router import ModelUsage  # noqa: E402
+from benchmarks.fakes import (  # noqa: E402
+    CallCounts,
+    FakeOpenAI,
+    FakePinecone,
+    FakeSettings,
+    Fixtures,
+    Recorder,
+    install,
+)
+from tracing import format_summary, tracer  # noqa: E402
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "replay.json")
+DEFAULT_OBJECTIVE = "Write a short market analysis of home espresso machines"
+# Leave the harness, the fakes and module imports out of the allocation sites
+ALLOCATION_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib.*>"),
+    tracemalloc.Filter(False, os.path.join(os.path.dirname(__file__), "*")),
+]
+
+
+class AllocationSite(BaseModel):
+    location: str
+    size_bytes: int
+    blocks: int
+
+
+class BenchmarkReport(BaseModel):
+    mode: str
+    workers: int
+    stream: bool
+    completion_cache: bool
+    iterations: int
+    seconds: float
+    iterations_per_second: float
+    calls: CallCounts
+    task_dedup: TaskDedupStats
+    compaction: CompactionStats
+    speculate: bool
+    speculation: SpeculationStats
+    models: Dict[str, ModelUsage]
+    structured_output: bool
+    structured: StructuredOutputStats
+    critical_path: CriticalPath
+    compiled_prompts: bool
+    # Prompt tokens of every request the agent built, and per request
+    prompt_tokens: int
+    prompt_tokens_per_call: float
+    memories: int
+    phases: Dict[str, Dict[str, float]]
+    peak_memory_bytes: Optional[int] = None
+    allocated_bytes: Optional[int] = None
+    top_allocations: List[AllocationSite] = []
+
+
+def run_benchmark(args: argparse.Namespace, repeat: int) -> BenchmarkReport:
+    calls = CallCounts()
+    settings = FakeSettings(
+        chat_latency=args.chat_latency,
+        embedding_latency=args.embedding_latency,
+        index_latency=args.index_latency,
+        provision_latency=args.provision_latency,
+        error_rate=args.error_rate,
+        malformed_json_rate=args.malformed_json_rate,
+        dependency_rate=args.dependency_rate,
+        seed=args.seed + repeat,
+    )
+    fake_openai = FakeOpenAI(Fixtures.load(args.fixtures), settings, calls)
+    fake_pinecone = FakePinecone(
+        os.path.join(WORK_DIR, f"index-{repeat}"), settings, calls
+    )
+    restore = install(fake_openai, fake_pinecone)
+    tracer.configure(os.path.join(WORK_DIR, f"trace-{repeat}.jsonl"))
+    if args.tracemalloc:
+        tracemalloc.start()
+    try:
+        agent = Agent(
+            CreateAgentParams(
+                objective=args.objective,
+                stream=args.stream,
+                completion_cache=args.completion_cache,
+                workers=args.workers,
+                max_iterations=args.iterations,
+                max_memories=args.max_memories,
+                speculate=args.speculate,
+                structured_output=args.structured_output,
+                compiled_prompts=args.compiled_prompts,
+            )
+        )
+        started = time.perf_counter()
+        if args.mode == "async":
+            asyncio.run(agent.arun())
+        else:
+            agent.run()
+        seconds = time.perf_counter() - started
+        report = BenchmarkReport(
+            mode=args.mode,
+            workers=args.workers,
+            stream=args.stream,
+            completion_cache=args.completion_cache,
+            iterations=agent.iterations,
+            seconds=seconds,
+            iterations_per_second=agent.iterations / seconds if seconds else 0.0,
+            calls=calls,
+            task_dedup=agent.tasks_storage.dedup.stats,
+            compaction=agent.vector_store.compactor.stats,
+            speculate=args.speculate,
+            speculation=agent.speculation_stats,
+            models=agent.router.usage,
+            structured_output=args.structured_output,
+            structured=agent.structured_stats,
+            critical_path=agent.tasks_storage.graph.critical_path(),
+            compiled_prompts=args.compiled_prompts,
+            prompt_tokens=agent.prompt_tokens,
+            prompt_tokens_per_call=agent.prompt_tokens / max(1, calls.chat),
+            memories=len(agent.vector_store.compactor),
+            phases=tracer.stats(),
+        )
+        if args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            report.peak_memory_bytes = peak
+            report.allocated_bytes = current
+            report.top_allocations = [
+                AllocationSite(
+                    location=str(stat.traceback[0]),
+                    size_bytes=stat.size,
+                    blocks=stat.count,
+                )
+                for stat in tracemalloc.take_snapshot()
+                .filter_traces(ALLOCATION_FILTERS)
+                .statistics("lineno")[:5]
+            ]
+        return report
+    finally:
+        if args.tracemalloc:
+            tracemalloc.stop()
+        tracer.configure(None)
+        restore()
+
+
+def record_fixtures(args: argparse.Namespace):
+    # Runs the agent against the live OpenAI API (vectors stay local) and
+    # saves every completion and embedding it received as replay fixtures
+    calls = CallCounts()
+    settings = FakeSettings()
+    fake_pinecone = FakePinecone(os.path.join(WORK_DIR, "record"), settings, calls)
+    recorder = Recorder()
+    restore_openai = recorder.install()
+    restore = install(None, fake_pinecone)
+    try:
+        Agent(
+            CreateAgentParams(objective=args.objective, max_iterations=args.iterations)
+        ).run()
+    finally:
+        restore()
+        restore_openai()
+    recorder.fixtures.save(args.record)
+    print(f"Recorded fixtures to {args.record}")
+
+
+def print_report(report: BenchmarkReport):
+    print(
+        f"***Benchmark ({report.mode}, workers={report.workers}, "
+        f"stream={report.stream}, completion_cache={report.completion_cache}):***"
+    )
+    print(
+        f" {report.iterations} iterations in {report.seconds:.2f}s, "
+        f"{report.iterations_per_second:.2f} iterations/s"
+    )
+    print(f" Calls: {report.calls.model_dump()}")
+    print(
+        f" Prompt tokens: {report.prompt_tokens} "
+        f"({report.prompt_tokens_per_call:.0f} per call, "
+        f"compiled_prompts={report.compiled_prompts})"
+    )
+    print(
+        f" Task dedup: {report.task_dedup.hits} duplicates skipped "
+        f"({report.task_dedup.merged} merged, {report.task_dedup.dropped} dropped), "
+        f"{report.task_dedup.misses} tasks queued"
+    )
+    print(
+        f" Memory compaction: {report.compaction.memories_summarized} memories "
+        f"summarized into {report.compaction.summaries_written} summaries, "
+        f"{report.memories} memories in the namespace"
+    )
+    if report.speculate:
+        print(
+            f" Speculation: {report.speculation.hits} hits, "
+            f"{report.speculation.misses} misses "
+            f"({report.speculation.hit_rate:.0%} hit rate), "
+            f"{report.speculation.wasted_prompt_tokens} prompt and "
+            f"{report.speculation.wasted_completion_tokens} completion tokens wasted"
+        )
+    if report.structured_output:
+        print(
+            f" Structured output: {report.structured.parsed} parsed, "
+            f"{report.structured.repaired} repaired, "
+            f"{report.structured.failed} failed"
+        )
+    print(
+        f" Critical path: {len(report.critical_path.task_names)} tasks, "
+        f"{report.critical_path.seconds:.2f}s of "
+        f"{report.critical_path.total_seconds:.2f}s task time "
+        f"({report.critical_path.parallelism:.1f}x parallelism)"
+    )
+    if report.peak_memory_bytes is not None:
+        print(
+            f" Memory: peak {report.peak_memory_bytes / 1024:.0f} KiB, "
+            f"retained {(report.allocated_bytes or 0) / 1024:.0f} KiB"
+        )
+        for site in report.top_allocations:
+            print(
+                f"   {site.size_bytes / 1024:>8.0f} KiB {site.blocks:>7} blocks  "
+                f"{site.location}"
+            )
+    for model, usage in report.models.items():
+        print(
+            f" Model {model}: {usage.calls} calls ({usage.rejected} rejected), "
+            f"p50 {usage.p50_ms:.1f} ms, p95 {usage.p95_ms:.1f} ms, "
+            f"{usage.prompt_tokens} prompt and {usage.completion_tokens} "
+            f"completion tokens"
+        )
+    print(format_summary(report.phases))
+    print("---")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the agent loop offline against replayed OpenAI and "
+        "Pinecone responses and report throughput, latency and allocations."
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Later runs reuse the embedding and completion caches of earlier "
+        "ones, so they measure warm caches",
+    )
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--completion-cache", action="store_true")
+    parser.add_argument(
+        "--speculate",
+        action="store_true",
+        help="Async mode only: think ahead for the next task",
+    )
+    parser.add_argument(
+        "--structured-output",
+        action="store_true",
+        help="Ask for JSON task plans instead of numbered lists",
+    )
+    parser.add_argument(
+        "--compiled-prompts",
+        action="store_true",
+        help="Send compacted prompts that share a system message prefix",
+    )
+    parser.add_argument("--objective", default=DEFAULT_OBJECTIVE)
+    parser.add_argument("--max-memories", type=int, default=200)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--chat-latency", type=float, default=0.0)
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--index-latency", type=float, default=0.0)
+    parser.add_argument("--provision-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-json-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--dependency-rate",
+        type=float,
+        default=0.0,
+        help="With --structured-output, the fraction of created tasks that "
+        "depend on the task listed before them",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false")
+    parser.add_argument("--json", help="Write the reports to this file")
+    parser.add_argument(
+        "--record", help="Record live responses to this fixtures file instead"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        if args.record:
+            record_fixtures(args)
+            return
+        reports = []
+        for repeat in range(args.repeat):
+            report = run_benchmark(args, repeat)
+            print_report(report)
+            reports.append(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump([r.model_dump() for r in reports], f, indent=2)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
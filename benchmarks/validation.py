@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import timeit
+from typing import Any, Callable, Dict, List, Tuple
+
+from pydantic import BaseModel
+
+from agent.models import ExpectedAgentMetadata
+from agent.prompts import execute_thought
+from completions.cache import completion_key
+from completions.models import (
+    ChatCompletionChunk,
+    ChatCompletionCreateParams,
+    ChatCompletionResponse,
+    PromptMessage,
+    PromptMessageRoleEnum,
+)
+
+# A prompt and response about the size the agent sends and receives
+PROMPT = execute_thought(
+    objective="Write a short market analysis of home espresso machines",
+    task="Compare the prices of the five best selling machines",
+    internal_thought="I should list the machines and their prices first. " * 10,
+    context=[
+        f'Based on the task "task {i}", you noted a result. ' * 5 for i in range(5)
+    ],
+)
+RESPONSE: Dict[str, Any] = {
+    "id": "chatcmpl-benchmark",
+    "object": "chat.completion",
+    "created": 1700000000,
+    "model": "gpt-3.5-turbo-16k",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "The machines are... " * 40},
+        }
+    ],
+    "usage": {"prompt_tokens": 600, "completion_tokens": 200, "total_tokens": 800},
+}
+CHUNK: Dict[str, Any] = {
+    "id": "chatcmpl-benchmark",
+    "object": "chat.completion.chunk",
+    "created": 1700000000,
+    "model": "gpt-3.5-turbo-16k",
+    "choices": [{"index": 0, "finish_reason": None, "delta": {"content": "The ma"}}],
+}
+METADATA = {
+    "task": "Compare the prices of the five best selling machines",
+    "result": "The machines are... " * 20,
+    "thought_type": "EXECUTE_THOUGHT",
+}
+TEMPLATE = ChatCompletionCreateParams(temperature=0.7)
+
+
+class ValidationTiming(BaseModel):
+    operation: str
+    validated_us: float
+    fast_us: float
+
+    @property
+    def speedup(self) -> float:
+        return self.validated_us / self.fast_us if self.fast_us else 0.0
+
+
+def build_validated() -> ChatCompletionCreateParams:
+    return ChatCompletionCreateParams(
+        temperature=0.7,
+        messages=[PromptMessage(role=PromptMessageRoleEnum.user, content=PROMPT)],
+    )
+
+
+def build_fast() -> ChatCompletionCreateParams:
+    # Copying a prebuilt template and skipping validation of the message
+    return TEMPLATE.model_copy(
+        update={
+            "messages": [
+                PromptMessage.model_construct(
+                    role=PromptMessageRoleEnum.user, content=PROMPT
+                )
+            ]
+        }
+    )
+
+
+def read_validated() -> str:
+    return ChatCompletionResponse(**RESPONSE).choices[0].message.content or ""
+
+
+def read_fast() -> str:
+    return RESPONSE["choices"][0]["message"].get("content") or ""
+
+
+def read_chunk_validated() -> str:
+    return ChatCompletionChunk(**CHUNK).choices[0].delta.content or ""
+
+
+def read_chunk_fast() -> str:
+    return CHUNK["choices"][0]["delta"].get("content") or ""
+
+
+def metadata_validated() -> ExpectedAgentMetadata:
+    return ExpectedAgentMetadata(**METADATA)
+
+
+def metadata_fast() -> ExpectedAgentMetadata:
+    return ExpectedAgentMetadata.model_construct(
+        task=METADATA["task"],
+        result=METADATA["result"],
+        thought_type=METADATA["thought_type"],
+    )
+
+
+def key_validated(params: ChatCompletionCreateParams) -> str:
+    # The completion cache key as it was computed from a validated dump
+    dumped = params.model_dump(mode="json", exclude={"stream"})
+    return hashlib.sha256(
+        json.dumps(dumped, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def cases() -> List[Tuple[str, Callable[[], Any], Callable[[], Any]]]:
+    params = build_validated()
+    return [
+        ("build request", build_validated, build_fast),
+        ("serialize request", params.model_dump, params.to_request),
+        (
+            "cache key",
+            lambda: key_validated(params),
+            lambda: completion_key(params),
+        ),
+        ("read response", read_validated, read_fast),
+        ("read stream chunk", read_chunk_validated, read_chunk_fast),
+        ("memory hit metadata", metadata_validated, metadata_fast),
+    ]
+
+
+def time_us(operation: Callable[[], Any], number: int, repeat: int) -> float:
+    return min(timeit.repeat(operation, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number: int, repeat: int) -> List[ValidationTiming]:
+    # Both paths must agree before their speed is worth comparing
+    assert build_validated() == build_fast()
+    assert build_validated().model_dump(mode="json") == build_fast().to_request()
+    assert read_validated() == read_fast()
+    assert metadata_validated() == metadata_fast()
+    assert key_validated(build_validated()) == completion_key(build_validated())
+    return [
+        ValidationTiming(
+            operation=operation,
+            validated_us=time_us(validated, number, repeat),
+            fast_us=time_us(fast, number, repeat),
+        )
+        for operation, validated, fast in cases()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the cost of validating requests, responses and "
+        "memory metadata with pydantic against unvalidated alternatives that "
+        "produce the same result."
+    )
+    parser.add_argument("--number", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'operation':<22}{'validated us':>14}{'fast us':>10}{'speedup':>10}")
+    for timing in run(args.number, args.repeat):
+        print(
+            f"{timing.operation:<22}{timing.validated_us:>14.2f}"
+            f"{timing.fast_us:>10.2f}{timing.speedup:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Callable, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from completions.models import ChatCompletionCreateParams
+from completions.tokens import truncate_tokens
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10_000
+# Prompts are embedded with text-embedding-ada-002, which takes up to this
+# many tokens
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MAX_EMBEDDING_TOKENS = 8191
+
+
+class CompletionCacheStats(BaseModel):
+    exact_hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def completion_key(completion_in: ChatCompletionCreateParams) -> str:
+    request = completion_in.to_request()
+    del request["stream"]
+    return __hash(request)
+
+
+def settings_key(completion_in: ChatCompletionCreateParams) -> str:
+    # Everything but the messages, so near-duplicate prompts only match
+    # completions made with the same model and sampling settings
+    request = completion_in.to_request()
+    del request["stream"], request["messages"]
+    return __hash(request)
+
+
+def prompt_text(completion_in: ChatCompletionCreateParams) -> str:
+    return "\n".join(m.content for m in completion_in.messages)
+
+
+def __hash(value: object) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Persistent cache of completions keyed on the serialized request. When an
+# embedding function and similarity threshold are given, exact misses fall
+# back to the most similar cached prompt made with the same settings.
+class CompletionCache:
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        similarity_threshold: Optional[float] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.stats = CompletionCacheStats()
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                settings_key TEXT NOT NULL,
+                embedding BLOB,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_settings_key "
+            "ON completions (settings_key)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_last_used "
+            "ON completions (last_used)"
+        )
+        self.db.commit()
+
+    @property
+    def semantic(self) -> bool:
+        return self.embed is not None and self.similarity_threshold is not None
+
+    def exact_only(self) -> "CompletionCache":
+        # Same store and stats, without near-duplicate lookups, for prompts
+        # whose answer is only valid for exactly that prompt
+        view = copy.copy(self)
+        view.similarity_threshold = None
+        return view
+
+    def get(self, completion_in: ChatCompletionCreateParams) -> Optional[str]:
+        key = completion_key(completion_in)
+        with self.lock:
+            self.__expire()
+            row = self.db.execute(
+                "SELECT response FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.__touch(key)
+                self.stats.exact_hits += 1
+                return str(row[0])
+        if self.semantic:
+            response = self.__get_similar(completion_in)
+            if response is not None:
+                return response
+        with self.lock:
+            self.stats.misses += 1
+        return None
+
+    def put(self, completion_in: ChatCompletionCreateParams, response: str):
+        embedding = None
+        if self.semantic:
+            # get already embedded this prompt, so usually a cache hit
+            vector = self.__embed_prompt(completion_in)
+            if vector is not None:
+                embedding = array("f", vector).tobytes()
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO completions "
+                "(key, settings_key, embedding, response, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    completion_key(completion_in),
+                    settings_key(completion_in),
+                    embedding,
+                    response,
+                    now,
+                    now,
+                ),
+            )
+            self.__evict()
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __get_similar(self, completion_in: ChatCompletionCreateParams) -> Optional[str]:
+        assert self.similarity_threshold is not None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, embedding, response FROM completions "
+                "WHERE settings_key = ? AND embedding IS NOT NULL",
+                (settings_key(completion_in),),
+            ).fetchall()
+        # Nothing to compare against, so skip embedding the prompt
+        if not rows:
+            return None
+        vector = self.__embed_prompt(completion_in)
+        if vector is None:
+            return None
+        query = np.asarray(vector, dtype=np.float32)
+        matrix = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        scores = (matrix @ query) / np.where(norms == 0, 1, norms)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        with self.lock:
+            self.__touch(rows[best][0])
+            self.stats.semantic_hits += 1
+            return str(rows[best][2])
+
+    def __embed_prompt(
+        self, completion_in: ChatCompletionCreateParams
+    ) -> Optional[List[float]]:
+        # Packed prompts can be far longer than the embedding model takes. A
+        # failed embedding only skips the near-duplicate lookup or store, the
+        # completion itself already succeeded.
+        assert self.embed is not None
+        text = truncate_tokens(
+            prompt_text(completion_in), MAX_EMBEDDING_TOKENS, EMBEDDING_MODEL
+        )
+        try:
+            return self.embed(text)
+        except Exception:
+            return None
+
+    def __touch(self, key: str):
+        self.db.execute(
+            "UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self.db.commit()
+
+    def __expire(self):
+        cursor = self.db.execute(
+            "DELETE FROM completions WHERE created < ?",
+            (time.time() - self.ttl_seconds,),
+        )
+        if cursor.rowcount:
+            self.stats.evictions += cursor.rowcount
+            self.db.commit()
+
+    def __evict(self):
+        (count,) = self.db.execute("SELECT COUNT(*) FROM completions").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.db.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            self.stats.evictions += overflow
@@ -1,52 +1,310 @@
+import asyncio
+import random
 import time
-from typing import Optional
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional
 
 import openai
 import openai.error
 
-from completions.models import ChatCompletionCreateParams, ChatCompletionResponse
-
-
-def llm_call(completion_in: ChatCompletionCreateParams) -> str:
-    while True:
-        try:
-            response = openai.ChatCompletion.create(**completion_in.model_dump())
-            model_response = ChatCompletionResponse(**response)
-            return __read_response(model_response) or ""
-        except openai.error.RateLimitError:
-            print("Rate limit exceeded, waiting 10 seconds")
-            time.sleep(10)
-        except openai.error.Timeout:
-            print("OpenAI API timeout occurred. Waiting 10 seconds and trying again.")
-            time.sleep(10)
-        except openai.error.APIError:
-            print("OpenAI API error occurred. Waiting 10 seconds and trying again.")
-            time.sleep(10)
-        except openai.error.APIConnectionError:
-            print(
-                """OpenAI API connection error occurred. 
-                Check your network settings, proxy configuration, 
-                SSL certificates, or firewall rules. 
-                Waiting 10 seconds and trying again."""
+from completions.cache import CompletionCache
+from completions.models import (
+    ChatCompletionChunkDict,
+    ChatCompletionCreateParams,
+    ChatCompletionResponseDict,
+)
+from completions.rate_limit import rate_limiter
+from completions.tokens import count_prompt_tokens, count_tokens
+from tracing import Span, tracer
+
+MAX_RETRIES = 6
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+# Called with the prompt and completion tokens of every request that reached
+# the API, so completion cache hits are never reported, and the milliseconds
+# the successful attempt took, without rate limit waits and retries
+UsageCallback = Callable[[int, int, float], None]
+
+
+def llm_call(
+    completion_in: ChatCompletionCreateParams,
+    cache: Optional[CompletionCache] = None,
+    on_usage: Optional[UsageCallback] = None,
+) -> str:
+    if completion_in.stream:
+        return "".join(llm_stream(completion_in, cache=cache, on_usage=on_usage))
+    with tracer.span("llm_call", model=completion_in.model) as span:
+        if cache is not None:
+            cached = cache.get(completion_in)
+            if cached is not None:
+                span.set(cached=True, bytes=len(cached.encode("utf-8")))
+                return cached
+        estimated_tokens = __estimate_tokens(completion_in)
+        attempt = 0
+        while True:
+            span.add("rate_limit_wait", rate_limiter.acquire(estimated_tokens))
+            attempt_started = time.perf_counter()
+            try:
+                response = openai.ChatCompletion.create(**completion_in.to_request())
+            except openai.error.OpenAIError as e:
+                time.sleep(__retry_delay(e, attempt))
+                attempt += 1
+                span.set(retries=attempt)
+                continue
+            content = __read_response(
+                response, estimated_tokens, span, on_usage, attempt_started
+            )
+            if cache is not None:
+                cache.put(completion_in, content)
+            return content
+
+
+async def allm_call(
+    completion_in: ChatCompletionCreateParams,
+    cache: Optional[CompletionCache] = None,
+    on_usage: Optional[UsageCallback] = None,
+) -> str:
+    if completion_in.stream:
+        return "".join(
+            [
+                delta
+                async for delta in allm_stream(
+                    completion_in, cache=cache, on_usage=on_usage
+                )
+            ]
+        )
+    with tracer.span("llm_call", model=completion_in.model) as span:
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.get, completion_in)
+            if cached is not None:
+                span.set(cached=True, bytes=len(cached.encode("utf-8")))
+                return cached
+        estimated_tokens = __estimate_tokens(completion_in)
+        attempt = 0
+        while True:
+            span.add("rate_limit_wait", await rate_limiter.aacquire(estimated_tokens))
+            attempt_started = time.perf_counter()
+            try:
+                response: Any = await openai.ChatCompletion.acreate(
+                    **completion_in.to_request()
+                )
+            except openai.error.OpenAIError as e:
+                await asyncio.sleep(__retry_delay(e, attempt))
+                attempt += 1
+                span.set(retries=attempt)
+                continue
+            content = __read_response(
+                response, estimated_tokens, span, on_usage, attempt_started
             )
-            time.sleep(10)
-        except openai.error.InvalidRequestError:
-            print(
-                """OpenAI API invalid request. 
-                Check the documentation for the specific API method you are calling 
-                and make sure you are sending valid and complete parameters.
-                Waiting 10 seconds and trying again."""
+            if cache is not None:
+                await asyncio.to_thread(cache.put, completion_in, content)
+            return content
+
+
+# Yields content deltas as they arrive. Failures are only retried until the
+# first delta has been yielded, since the caller has already consumed it.
+def llm_stream(
+    completion_in: ChatCompletionCreateParams,
+    cache: Optional[CompletionCache] = None,
+    on_usage: Optional[UsageCallback] = None,
+) -> Iterator[str]:
+    completion_in = completion_in.model_copy(update={"stream": True})
+    with tracer.span("llm_stream", activate=False, model=completion_in.model) as span:
+        if cache is not None:
+            cached = cache.get(completion_in)
+            if cached is not None:
+                span.set(cached=True, bytes=len(cached.encode("utf-8")))
+                yield cached
+                return
+        estimated_tokens = __estimate_tokens(completion_in)
+        attempt = 0
+        while True:
+            span.add("rate_limit_wait", rate_limiter.acquire(estimated_tokens))
+            attempt_started = time.perf_counter()
+            streamed: List[str] = []
+            try:
+                for chunk in openai.ChatCompletion.create(**completion_in.to_request()):
+                    delta = __read_delta(chunk)
+                    if delta:
+                        if not streamed:
+                            span.set(first_delta_ms=__elapsed_ms(span))
+                        streamed.append(delta)
+                        yield delta
+            except openai.error.OpenAIError as e:
+                if streamed:
+                    raise
+                time.sleep(__retry_delay(e, attempt))
+                attempt += 1
+                span.set(retries=attempt)
+                continue
+            __record_streamed_usage(
+                completion_in,
+                estimated_tokens,
+                streamed,
+                span,
+                on_usage,
+                attempt_started,
             )
-            time.sleep(10)
-        except openai.error.ServiceUnavailableError:
-            print(
-                "OpenAI API service unavailable. Waiting 10 seconds and trying again."
+            if cache is not None:
+                cache.put(completion_in, "".join(streamed))
+            return
+
+
+async def allm_stream(
+    completion_in: ChatCompletionCreateParams,
+    cache: Optional[CompletionCache] = None,
+    on_usage: Optional[UsageCallback] = None,
+) -> AsyncIterator[str]:
+    completion_in = completion_in.model_copy(update={"stream": True})
+    with tracer.span("llm_stream", activate=False, model=completion_in.model) as span:
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.get, completion_in)
+            if cached is not None:
+                span.set(cached=True, bytes=len(cached.encode("utf-8")))
+                yield cached
+                return
+        estimated_tokens = __estimate_tokens(completion_in)
+        attempt = 0
+        while True:
+            span.add("rate_limit_wait", await rate_limiter.aacquire(estimated_tokens))
+            attempt_started = time.perf_counter()
+            streamed: List[str] = []
+            try:
+                response: Any = await openai.ChatCompletion.acreate(
+                    **completion_in.to_request()
+                )
+                async for chunk in response:
+                    delta = __read_delta(chunk)
+                    if delta:
+                        if not streamed:
+                            span.set(first_delta_ms=__elapsed_ms(span))
+                        streamed.append(delta)
+                        yield delta
+            except openai.error.OpenAIError as e:
+                if streamed:
+                    raise
+                await asyncio.sleep(__retry_delay(e, attempt))
+                attempt += 1
+                span.set(retries=attempt)
+                continue
+            __record_streamed_usage(
+                completion_in,
+                estimated_tokens,
+                streamed,
+                span,
+                on_usage,
+                attempt_started,
             )
-            time.sleep(10)
-        else:
-            break
+            if cache is not None:
+                await asyncio.to_thread(cache.put, completion_in, "".join(streamed))
+            return
+
+
+def __estimate_tokens(completion_in: ChatCompletionCreateParams) -> int:
+    return count_prompt_tokens(completion_in) + (completion_in.max_tokens or 0)
+
+
+def __retry_delay(error: openai.error.OpenAIError, attempt: int) -> float:
+    if not isinstance(error, RETRYABLE_ERRORS):
+        print(f"OpenAI API error is not retryable: {error}")
+        raise error
+    if attempt >= MAX_RETRIES:
+        print(f"OpenAI API error, giving up after {attempt} retries: {error}")
+        raise error
+
+    # Exponential backoff with full jitter, unless the API says how long to wait
+    delay = random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2**attempt))
+    retry_after = __retry_after(error)
+    if retry_after is not None:
+        delay = retry_after
+    if isinstance(error, openai.error.RateLimitError):
+        print(f"Rate limit exceeded, waiting {delay:.1f} seconds")
+        # Every caller sharing the limiter waits, not just this one
+        rate_limiter.backoff(delay)
+        return 0.0
+    print(
+        f"OpenAI API {type(error).__name__} occurred. "
+        f"Waiting {delay:.1f} seconds and trying again."
+    )
+    return delay
+
+
+def __retry_after(error: openai.error.OpenAIError) -> Optional[float]:
+    headers = error.headers or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def __read_delta(chunk: ChatCompletionChunkDict) -> Optional[str]:
+    if not chunk["choices"]:
+        return None
+    return chunk["choices"][0]["delta"].get("content")
+
+
+def __elapsed_ms(span: Span) -> float:
+    return (time.time() - span.start) * 1000
+
+
+def __elapsed_since(started: float) -> float:
+    return (time.perf_counter() - started) * 1000
+
+
+def __record_streamed_usage(
+    completion_in: ChatCompletionCreateParams,
+    estimated_tokens: int,
+    streamed: List[str],
+    span: Span,
+    on_usage: Optional[UsageCallback],
+    attempt_started: float,
+):
+    # Streamed responses carry no usage, so count the completion locally. The
+    # prompt was already counted for the estimate.
+    content = "".join(streamed)
+    prompt_tokens = estimated_tokens - (completion_in.max_tokens or 0)
+    completion_tokens = count_tokens(content, completion_in.model)
+    rate_limiter.record_usage(estimated_tokens, prompt_tokens + completion_tokens)
+    if on_usage is not None:
+        on_usage(prompt_tokens, completion_tokens, __elapsed_since(attempt_started))
+    span.set(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        bytes=len(content.encode("utf-8")),
+    )
 
 
-def __read_response(completion: ChatCompletionResponse) -> Optional[str]:
-    message = completion.choices[0].message
-    return message.content
+def __read_response(
+    completion: ChatCompletionResponseDict,
+    estimated_tokens: int,
+    span: Span,
+    on_usage: Optional[UsageCallback],
+    attempt_started: float,
+) -> str:
+    usage = completion.get("usage") or {}
+    used_tokens = usage.get("total_tokens")
+    if used_tokens is not None:
+        rate_limiter.record_usage(estimated_tokens, used_tokens)
+    if on_usage is not None:
+        on_usage(
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+            __elapsed_since(attempt_started),
+        )
+    content = completion["choices"][0]["message"].get("content") or ""
+    span.set(
+        prompt_tokens=usage.get("prompt_tokens"),
+        completion_tokens=usage.get("completion_tokens"),
+        bytes=len(content.encode("utf-8")),
+    )
+    return content
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+DEFAULT_REQUESTS_PER_MINUTE = 3500
+DEFAULT_TOKENS_PER_MINUTE = 180_000
+
+
+# Bucket that may go into debt: a reservation always succeeds and returns
+# how long the caller has to wait for the bucket to refill, which keeps
+# concurrent callers in arrival order
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.refill(now)
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+# Process wide request and token budget shared by every completion call,
+# sync or async
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE,
+    ):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute: float, tokens_per_minute: float):
+        with self.lock:
+            self.requests = TokenBucket(requests_per_minute)
+            self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            delay = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(tokens, now),
+                self.paused_until - now,
+            )
+            return max(0.0, delay)
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int):
+        # Settle the difference between the estimate and the reported usage
+        with self.lock:
+            self.tokens.refill(time.monotonic())
+            self.tokens.level -= used_tokens - estimated_tokens
+
+    def backoff(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, tokens: int) -> float:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def aacquire(self, tokens: int) -> float:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+rate_limiter = RateLimiter()
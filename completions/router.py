@@ -0,0 +1,238 @@
+from enum import Enum
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+
+from completions.cache import CompletionCache
+from completions.flows import (
+    UsageCallback,
+    allm_call,
+    allm_stream,
+    llm_call,
+    llm_stream,
+)
+from completions.models import ChatCompletionCreateParams, ModelEnum
+from tracing.tracer import percentile
+
+
+class PhaseEnum(str, Enum):
+    internal_thought = "internal_thought"
+    execute_thought = "execute_thought"
+    task_creation = "task_creation"
+    task_prioritization = "task_prioritization"
+    memory_summary = "memory_summary"
+
+
+# Cheapest model first. Only phases whose output is validated escalate, the
+# thoughts have no wrong answers to catch.
+DEFAULT_ROUTES: Dict[PhaseEnum, List[str]] = {
+    PhaseEnum.internal_thought: [ModelEnum.gpt_3_5_turbo_16k.value],
+    PhaseEnum.execute_thought: [ModelEnum.gpt_3_5_turbo_16k.value],
+    PhaseEnum.task_creation: [
+        ModelEnum.gpt_3_5_turbo_16k.value,
+        ModelEnum.gpt_4_1106_preview.value,
+    ],
+    PhaseEnum.task_prioritization: [
+        ModelEnum.gpt_3_5_turbo_16k.value,
+        ModelEnum.gpt_4_1106_preview.value,
+    ],
+    PhaseEnum.memory_summary: [ModelEnum.gpt_3_5_turbo_16k.value],
+}
+
+
+# JSON mode (response_format) needs the 1106 models
+JSON_ROUTES: Dict[PhaseEnum, List[str]] = {
+    PhaseEnum.task_creation: [
+        ModelEnum.gpt_3_5_turbo_1106.value,
+        ModelEnum.gpt_4_1106_preview.value,
+    ],
+    PhaseEnum.task_prioritization: [
+        ModelEnum.gpt_3_5_turbo_1106.value,
+        ModelEnum.gpt_4_1106_preview.value,
+    ],
+}
+
+
+class ModelUsage(BaseModel):
+    calls: int = 0
+    # Outputs that failed validation and were retried on the next model
+    rejected: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Of the successful API attempt, excluding rate limit waits and retries
+    latencies_ms: List[float] = []
+
+    @property
+    def p50_ms(self) -> float:
+        return percentile(sorted(self.latencies_ms), 50)
+
+    @property
+    def p95_ms(self) -> float:
+        return percentile(sorted(self.latencies_ms), 95)
+
+
+# Sends each agent phase to its configured models. A phase listing several
+# models tries them in order and only moves on to the next, larger model when
+# the output fails the caller's validation; the last model's output is
+# returned either way. Latency and token spend are recorded per model.
+class ModelRouter:
+    def __init__(self, routes: Optional[Dict[PhaseEnum, List[str]]] = None):
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.usage: Dict[str, ModelUsage] = {}
+
+    def route(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams
+    ) -> List[ChatCompletionCreateParams]:
+        return [
+            completion_in.model_copy(update={"model": model})
+            for model in self.routes[phase] or [completion_in.model]
+        ]
+
+    def complete(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        return self.__cascade(self.route(phase, completion_in), cache, validate)
+
+    async def acomplete(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        return await self.__acascade(self.route(phase, completion_in), cache, validate)
+
+    def escalate(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[str]:
+        # Retries a streamed output of the first model that failed validation
+        # on the remaining models, if there are any
+        routed = self.route(phase, completion_in)
+        self.__reject(routed[0])
+        if len(routed) == 1:
+            return None
+        return self.__cascade(routed[1:], cache, validate)
+
+    async def aescalate(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[str]:
+        routed = self.route(phase, completion_in)
+        self.__reject(routed[0])
+        if len(routed) == 1:
+            return None
+        return await self.__acascade(routed[1:], cache, validate)
+
+    def repair(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams
+    ) -> str:
+        # A single follow-up to an output that failed validation on every
+        # model, so it goes to the last one, the model that produced it,
+        # without escalating again
+        return self.__cascade(self.route(phase, completion_in)[-1:], None, None)
+
+    async def arepair(
+        self, phase: PhaseEnum, completion_in: ChatCompletionCreateParams
+    ) -> str:
+        return await self.__acascade(self.route(phase, completion_in)[-1:], None, None)
+
+    def stream(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+    ) -> Iterator[str]:
+        # Streams from the first model; validation, if any, is up to the
+        # caller once the stream is done
+        routed = self.route(phase, completion_in)[0]
+        yield from llm_stream(
+            routed, cache=cache, on_usage=self.__recorder(routed.model)
+        )
+
+    async def astream(
+        self,
+        phase: PhaseEnum,
+        completion_in: ChatCompletionCreateParams,
+        cache: Optional[CompletionCache] = None,
+    ) -> AsyncIterator[str]:
+        routed = self.route(phase, completion_in)[0]
+        async for delta in allm_stream(
+            routed, cache=cache, on_usage=self.__recorder(routed.model)
+        ):
+            yield delta
+
+    def summary(self) -> str:
+        lines = [
+            f"{'model':<24}{'calls':>7}{'rejected':>10}{'p50 ms':>10}"
+            f"{'p95 ms':>10}{'prompt tok':>12}{'completion tok':>16}"
+        ]
+        for model, usage in self.usage.items():
+            lines.append(
+                f"{model:<24}{usage.calls:>7}{usage.rejected:>10}"
+                f"{usage.p50_ms:>10.1f}{usage.p95_ms:>10.1f}"
+                f"{usage.prompt_tokens:>12}{usage.completion_tokens:>16}"
+            )
+        return "\n".join(lines)
+
+    def __cascade(
+        self,
+        routed: List[ChatCompletionCreateParams],
+        cache: Optional[CompletionCache],
+        validate: Optional[Callable[[str], bool]],
+    ) -> str:
+        content = ""
+        for index, completion_in in enumerate(routed):
+            content = llm_call(
+                completion_in,
+                cache=cache,
+                on_usage=self.__recorder(completion_in.model),
+            )
+            if validate is None or validate(content) or index == len(routed) - 1:
+                return content
+            self.__reject(completion_in)
+        return content
+
+    async def __acascade(
+        self,
+        routed: List[ChatCompletionCreateParams],
+        cache: Optional[CompletionCache],
+        validate: Optional[Callable[[str], bool]],
+    ) -> str:
+        content = ""
+        for index, completion_in in enumerate(routed):
+            content = await allm_call(
+                completion_in,
+                cache=cache,
+                on_usage=self.__recorder(completion_in.model),
+            )
+            if validate is None or validate(content) or index == len(routed) - 1:
+                return content
+            self.__reject(completion_in)
+        return content
+
+    def __recorder(self, model: str) -> UsageCallback:
+        # Records a call with the token counts and attempt latency the flow
+        # already has, once it reaches the API; completion cache hits are not
+        # model calls
+        def record(prompt_tokens: int, completion_tokens: int, latency_ms: float):
+            usage = self.usage.setdefault(model, ModelUsage())
+            usage.calls += 1
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            usage.latencies_ms.append(latency_ms)
+
+        return record
+
+    def __reject(self, completion_in: ChatCompletionCreateParams):
+        self.usage.setdefault(completion_in.model, ModelUsage()).rejected += 1
@@ -0,0 +1,58 @@
+from functools import lru_cache
+from typing import Any, Optional
+
+import tiktoken
+
+from completions.models import ChatCompletionCreateParams
+
+# Per message and per reply overhead of the chat format
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 2
+
+
+@lru_cache(maxsize=None)
+def __fallback_encoding() -> Optional[Any]:
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The BPE files could not be loaded (e.g. offline), so fall back
+        # to the character based estimate
+        return None
+
+
+@lru_cache(maxsize=None)
+def __encoding(model: str) -> Optional[Any]:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models tiktoken does not know, e.g. custom routes
+        return __fallback_encoding()
+    except Exception:
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    encoding = __encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    encoding = __encoding(model)
+    if encoding is None:
+        return text if len(text) <= max_tokens * 4 else text[: max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return str(encoding.decode(tokens[:max_tokens]))
+
+
+def count_prompt_tokens(completion_in: ChatCompletionCreateParams) -> int:
+    return (
+        sum(
+            TOKENS_PER_MESSAGE + count_tokens(m.content, completion_in.model)
+            for m in completion_in.messages
+        )
+        + TOKENS_PER_REPLY
+    )
@@ -1 +1 @@
-from config.config import Config
\ No newline at end of file
+from config.config import Config, get_config
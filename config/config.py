@@ -1,25 +1,48 @@
 import os
+from functools import lru_cache
 
 
 REQUIRED_ENV_VARS = [
-    "PINECONE_API_KEY",
-    "PINECONE_ENVIRONMENT",
     "OPENAI_API_KEY",
     "OPENAI_ORG_KEY",
 ]
 
+# Only required when the Pinecone vector store backend is selected
+PINECONE_ENV_VARS = [
+    "PINECONE_API_KEY",
+    "PINECONE_ENVIRONMENT",
+]
+
 
 class Config:
     def __init__(self):
         self.OPENAI_API_KEY = self.__get("OPENAI_API_KEY")
         self.OPENAI_ORG_KEY = self.__get("OPENAI_ORG_KEY")
-        self.PINECONE_API_KEY = self.__get("PINECONE_API_KEY")
-        self.PINECONE_ENVIRONMENT = self.__get("PINECONE_ENVIRONMENT")
+        self.PINECONE_API_KEY = self.__get("PINECONE_API_KEY", default="")
+        self.PINECONE_ENVIRONMENT = self.__get("PINECONE_ENVIRONMENT", default="")
+        self.COMPLETION_CACHE_PATH = self.__get(
+            "COMPLETION_CACHE_PATH", default=".agentlebot/completions.sqlite3"
+        )
+        self.VECTOR_STORE_BACKEND = self.__get(
+            "VECTOR_STORE_BACKEND", default="pinecone"
+        )
+        self.PINECONE_INDEX_CACHE_PATH = self.__get(
+            "PINECONE_INDEX_CACHE_PATH", default=".agentlebot/pinecone_indexes.json"
+        )
+        self.LOCAL_VECTOR_STORE_PATH = self.__get(
+            "LOCAL_VECTOR_STORE_PATH", default=".agentlebot/vectors"
+        )
+        self.EMBEDDING_CACHE_PATH = self.__get(
+            "EMBEDDING_CACHE_PATH", default=".agentlebot/embeddings.sqlite3"
+        )
 
         self.__raise_if_missing_required_env_vars()
 
     def __raise_if_missing_required_env_vars(self):
-        for var in REQUIRED_ENV_VARS:
+        required = REQUIRED_ENV_VARS
+        if self.VECTOR_STORE_BACKEND == "pinecone":
+            required = required + PINECONE_ENV_VARS
+        for var in required:
             if not getattr(self, var):
                 raise ValueError(f"Missing required environment variable: {var}")
 
@@ -29,4 +52,11 @@ class Config:
         if val is not None:
             return val
         else:
-            raise ValueError(f"Missing required environment variable: {key}")
\ No newline at end of file
+            raise ValueError(f"Missing required environment variable: {key}")
+
+
+# Resolved on first use rather than at import, so modules can be imported
+# without credentials in the environment
+@lru_cache(maxsize=None)
+def get_config() -> Config:
+    return Config()
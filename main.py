@@ -1,3 +1,4 @@
+import asyncio
 from agent.agent import Agent
 from agent.models import CreateAgentParams
 from dotenv import load_dotenv
@@ -9,5 +10,20 @@ if __name__ == "__main__":
     objective = sys.argv[1]
     if len(sys.argv) > 2:
         log = sys.argv[2].lower() == "true"
-    agent = Agent(CreateAgentParams(objective=objective, log=True))
-    agent.run()
+    run_async = len(sys.argv) > 3 and sys.argv[3].lower() == "async"
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    trace_path = sys.argv[5] if len(sys.argv) > 5 else None
+    checkpoint_path = sys.argv[6] if len(sys.argv) > 6 else None
+    agent = Agent(
+        CreateAgentParams(
+            objective=objective,
+            log=True,
+            workers=workers,
+            trace_path=trace_path,
+            checkpoint_path=checkpoint_path,
+        )
+    )
+    if run_async:
+        asyncio.run(agent.arun())
+    else:
+        agent.run()
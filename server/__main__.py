@@ -0,0 +1,35 @@
+import argparse
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from server.app import DEFAULT_CONNECTIONS, DEFAULT_SLOTS, AgentServer
+
+load_dotenv()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Serve a local HTTP/JSON API that runs many objectives at once."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=DEFAULT_SLOTS,
+        help="Tasks executed at once across all objectives",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=DEFAULT_CONNECTIONS,
+        help="Size of the HTTP connection pool shared by all objectives",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = AgentServer(slots=args.slots, connections=args.connections)
+    web.run_app(server.app(), host=args.host, port=args.port)
@@ -0,0 +1,197 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import aiohttp
+import openai
+from aiohttp import web
+from pydantic import BaseModel, Field, ValidationError
+
+from agent.agent import Agent
+from agent.models import CreateAgentParams
+from agent.resources import AgentResources
+
+DEFAULT_SLOTS = 8
+DEFAULT_CONNECTIONS = 32
+# How long finished objectives can still be looked up
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+
+
+class SubmitObjective(BaseModel):
+    objective: str = Field(min_length=1)
+    workers: int = Field(default=1, ge=1)
+    max_iterations: Optional[int] = Field(default=None, ge=1)
+    stream: bool = False
+    completion_cache: bool = False
+
+
+class ObjectiveStatus(BaseModel):
+    id: str
+    objective: str
+    # queued, running, done, failed or cancelled
+    status: str
+    iterations: int = 0
+    tasks_left: int = 0
+    next_tasks: List[str] = []
+    error: Optional[str] = None
+    submitted_at: float
+    finished_at: Optional[float] = None
+
+
+# One submitted objective and the asyncio task running its agent. Once the
+# agent stops only its final status is kept, not the agent itself.
+class HostedObjective:
+    def __init__(self, objective_id: str, params: SubmitObjective):
+        self.id = objective_id
+        self.params = params
+        self.agent: Optional[Agent] = None
+        self.task: Optional[asyncio.Task[None]] = None
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.final_status: Optional[ObjectiveStatus] = None
+
+    def describe(self) -> ObjectiveStatus:
+        if self.final_status is not None:
+            return self.final_status
+        status = ObjectiveStatus(
+            id=self.id,
+            objective=self.params.objective,
+            status=self.status,
+            error=self.error,
+            submitted_at=self.submitted_at,
+            finished_at=self.finished_at,
+        )
+        if self.agent is not None:
+            status.iterations = self.agent.iterations
+            status.tasks_left = len(self.agent.tasks_storage)
+            status.next_tasks = self.agent.tasks_storage.get_task_names()[:5]
+        return status
+
+    def release(self):
+        self.finished_at = time.time()
+        self.final_status = self.describe()
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+
+
+# Hosts many agents in one event loop. They share one HTTP connection pool
+# for OpenAI, the process wide rate limiter, one embedding cache and one
+# vector index (each objective gets its own namespace), and their tasks take
+# turns through a fair gate so a big objective cannot starve the others.
+class AgentServer:
+    def __init__(
+        self,
+        slots: int = DEFAULT_SLOTS,
+        connections: int = DEFAULT_CONNECTIONS,
+        resources: Optional[AgentResources] = None,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS,
+    ):
+        self.resources = resources or AgentResources.create(slots=slots)
+        self.connections = connections
+        self.retention_seconds = retention_seconds
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.objectives: Dict[str, HostedObjective] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/objectives", self.submit),
+                web.get("/objectives", self.list_objectives),
+                web.get("/objectives/{id}", self.get),
+                web.delete("/objectives/{id}", self.cancel),
+            ]
+        )
+        app.on_startup.append(self.__start)
+        app.on_cleanup.append(self.__stop)
+        return app
+
+    async def submit(self, request: web.Request) -> web.Response:
+        try:
+            params = SubmitObjective(**await request.json())
+        except (ValueError, TypeError, ValidationError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        self.__evict_finished()
+        hosted = HostedObjective(uuid.uuid4().hex[:12], params)
+        self.objectives[hosted.id] = hosted
+        hosted.task = asyncio.create_task(self.__run(hosted))
+        return web.json_response(hosted.describe().model_dump(), status=201)
+
+    async def list_objectives(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [o.describe().model_dump() for o in self.objectives.values()]
+        )
+
+    async def get(self, request: web.Request) -> web.Response:
+        hosted = self.objectives.get(request.match_info["id"])
+        if hosted is None:
+            return web.json_response({"error": "Unknown objective"}, status=404)
+        return web.json_response(hosted.describe().model_dump())
+
+    async def cancel(self, request: web.Request) -> web.Response:
+        hosted = self.objectives.get(request.match_info["id"])
+        if hosted is None:
+            return web.json_response({"error": "Unknown objective"}, status=404)
+        if hosted.task is not None and not hosted.task.done():
+            hosted.task.cancel()
+            await asyncio.gather(hosted.task, return_exceptions=True)
+        return web.json_response(hosted.describe().model_dump())
+
+    async def __run(self, hosted: HostedObjective):
+        # Completions made from this task use the shared connection pool
+        if self.session is not None:
+            openai.aiosession.set(self.session)
+        try:
+            # Building an agent can open its completion cache, keep that off
+            # the loop
+            hosted.agent = await asyncio.to_thread(
+                Agent,
+                CreateAgentParams(
+                    objective=hosted.params.objective,
+                    workers=hosted.params.workers,
+                    max_iterations=hosted.params.max_iterations,
+                    stream=hosted.params.stream,
+                    completion_cache=hosted.params.completion_cache,
+                    agent_id=hosted.id,
+                ),
+                self.resources,
+            )
+            hosted.status = "running"
+            await hosted.agent.arun()
+            hosted.status = "done"
+        except asyncio.CancelledError:
+            hosted.status = "cancelled"
+            raise
+        except Exception as e:
+            hosted.status = "failed"
+            hosted.error = f"{type(e).__name__}: {e}"
+        finally:
+            hosted.release()
+
+    def __evict_finished(self):
+        cutoff = time.time() - self.retention_seconds
+        self.objectives = {
+            id: o
+            for id, o in self.objectives.items()
+            if o.finished_at is None or o.finished_at > cutoff
+        }
+
+    async def __start(self, app: web.Application):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections)
+        )
+
+    async def __stop(self, app: web.Application):
+        running = [
+            o.task for o in self.objectives.values() if o.task and not o.task.done()
+        ]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+        self.resources.close()
@@ -0,0 +1 @@
+from tracing.tracer import Span, Tracer, format_summary, tracer
@@ -0,0 +1,153 @@
+import contextvars
+import itertools
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, IO, Iterator, List, Optional
+
+# Attributes summed per span name in the end-of-run summary
+SUMMED_ATTRIBUTES = ["retries", "prompt_tokens", "completion_tokens", "bytes"]
+
+
+class Span:
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int]):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = 0.0
+        self.attributes: Dict[str, Any] = {}
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount: float):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+
+# Records timed spans as JSON lines and aggregates them per name for an
+# end-of-run latency summary. Spans are cheap no-ops until a trace file is
+# configured.
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.file: Optional[IO[str]] = None
+        self.durations: Dict[str, List[float]] = {}
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+            "current_span", default=None
+        )
+
+    def configure(self, path: Optional[str]):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(path, "a") if path else None
+            self.enabled = path is not None
+            self.durations = {}
+            self.totals = {}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @contextmanager
+    def span(
+        self, name: str, activate: bool = True, **attributes: Any
+    ) -> Iterator[Span]:
+        # Generators should pass activate=False, since they may be resumed
+        # from a different context than the one they started in
+        parent = self.current.get()
+        span = Span(name, next(self.ids), parent.span_id if parent else None)
+        span.set(**attributes)
+        token = self.current.set(span) if activate else None
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            if token is not None:
+                self.current.reset(token)
+            if self.enabled:
+                self.__record(span)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        # Latency percentiles and summed attributes per span name, slowest
+        # phases (by total time) first
+        with self.lock:
+            rows = sorted(self.durations.items(), key=lambda r: -sum(r[1]))
+            return {
+                name: {
+                    "count": len(durations),
+                    "p50_ms": percentile(sorted(durations), 50) * 1000,
+                    "p95_ms": percentile(sorted(durations), 95) * 1000,
+                    "total_s": sum(durations),
+                    **self.totals.get(name, {}),
+                }
+                for name, durations in rows
+            }
+
+    def summary(self) -> str:
+        return format_summary(self.stats())
+
+    def __record(self, span: Span):
+        with self.lock:
+            self.durations.setdefault(span.name, []).append(span.duration)
+            totals = self.totals.setdefault(span.name, {})
+            for key in SUMMED_ATTRIBUTES:
+                value = span.attributes.get(key)
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+            if self.file is not None:
+                self.file.write(
+                    json.dumps(
+                        {
+                            "name": span.name,
+                            "span_id": span.span_id,
+                            "parent_id": span.parent_id,
+                            "start": span.start,
+                            "duration_ms": span.duration * 1000,
+                            "attributes": span.attributes,
+                        },
+                        default=str,
+                    )
+                    + "\n"
+                )
+                self.file.flush()
+
+
+def format_summary(stats: Dict[str, Dict[str, float]]) -> str:
+    lines = [
+        f"{'span':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'total s':>10}  totals"
+    ]
+    for name, row in stats.items():
+        totals = ", ".join(
+            f"{key}={int(row[key])}" for key in SUMMED_ATTRIBUTES if row.get(key)
+        )
+        lines.append(
+            f"{name:<28}{int(row['count']):>7}"
+            f"{row['p50_ms']:>10.1f}"
+            f"{row['p95_ms']:>10.1f}"
+            f"{row['total_s']:>10.2f}  {totals}"
+        )
+    return "\n".join(lines)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+tracer = Tracer()